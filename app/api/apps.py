@@ -3,3 +3,4 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+    default_auto_field = 'django.db.models.AutoField'
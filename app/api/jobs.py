@@ -0,0 +1,248 @@
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from dbmi_client.authn import get_jwt_email
+
+from api.models import RenderJob, RenderTask
+from api.outbox import outbox
+from api.participants import Participants
+from api.renders import renders, RenderExecutor
+from api.snapshots import snapshots
+from fhirquestionnaire.cache import patients
+from fhirquestionnaire.http import P2MD
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RenderJobs(object):
+    """
+    Runs bulk consent render jobs in the background. A job is expanded into
+    one task per participant and its tasks are rendered at bulk priority on
+    the process's render executor (see `api.renders`), so concurrent jobs
+    share RENDER_JOB_WORKERS threads and give way to participants' renders.
+
+    Jobs and tasks are stored in the database. Tasks are leased before they
+    run, so any number of processes can work on the same job, and jobs left
+    unfinished by a restart are resumed by `resume`. A runner sees its job
+    through, waiting on tasks other runners hold and taking them over once
+    their lease runs out, e.g. those a crashed process was rendering.
+
+    P2MD calls are made with the JWT of the request that started the job,
+    which is kept in memory only; resumed jobs fall back to P2MD_AUTH_TOKEN
+    and fail without it.
+    """
+
+    # Seconds between checks on tasks held by other runners
+    POLL_INTERVAL = 5
+
+    def __init__(self):
+        self._requests = {}
+
+    def submit(self, request, study, overwrite=False, ppm_ids=None):
+        """
+        Stores a render job and starts working on it in the background.
+
+        :param request: The request that started the job
+        :type request: HttpRequest
+        :param study: The study whose participants' consents are rendered
+        :type study: str
+        :param overwrite: Whether to replace existing renders
+        :type overwrite: bool
+        :param ppm_ids: Limits the job to these participants
+        :type ppm_ids: list, defaults to None
+        :return: The stored job
+        :rtype: RenderJob
+        """
+        job = RenderJob.objects.create(study=study, overwrite=bool(overwrite), ppm_ids=ppm_ids)
+        logger.debug(f'PPM/{study}: Queued {job}')
+
+        self._requests[job.id] = request
+        self._start(job.id)
+
+        return job
+
+    def defer(self, request, study, submission, ppm_id=None):
+        """
+        Stores the render of a consent just signed as a job of its own, e.g.
+        when the background render queue is full. The render waits for the
+        consent's submission to be delivered to FHIR, as it would have, and
+        keeps its background priority.
+
+        :param request: The participant's request
+        :type request: HttpRequest
+        :param study: The study consented to
+        :type study: str
+        :param submission: The queued consent submission
+        :type submission: Submission
+        :param ppm_id: The participant, defaults to the one making the request
+        :type ppm_id: str
+        :return: The stored job
+        :rtype: RenderJob
+        """
+        if not ppm_id:
+            ppm_id = patients.get_id(get_jwt_email(request=request, verify=False))
+
+        # It needs no listing of participants
+        job = RenderJob.objects.create(study=study, ppm_ids=[ppm_id], status=RenderJob.RUNNING,
+                                       started=timezone.now())
+        RenderTask.objects.create(job=job, ppm_id=ppm_id, submission=submission)
+        logger.debug(f'PPM/{study}: Deferred consent render of {submission} to {job}')
+
+        self._requests[job.id] = request
+        self._start(job.id)
+
+        return job
+
+    def resume(self):
+        """
+        Restarts jobs that are unfinished, e.g. after the process restarted,
+        releasing tasks whose runner died mid-render.
+        """
+        RenderJobs._release()
+
+        for job_id in RenderJob.objects.filter(status__in=[RenderJob.PENDING, RenderJob.RUNNING]).values_list(
+                'id', flat=True):
+            logger.debug(f'PPM/RenderJobs: Resuming RenderJob/{job_id}')
+            self._start(job_id)
+
+    def _start(self, job_id):
+        threading.Thread(target=self._run, args=(job_id, ), name=f'render-job-{job_id}', daemon=True).start()
+
+    def _run(self, job_id):
+        try:
+            close_old_connections()
+            job = RenderJob.objects.get(id=job_id)
+
+            # Resumed jobs have no user's JWT to call P2MD with
+            if job_id not in self._requests and not settings.P2MD_AUTH_TOKEN:
+                raise SystemError('P2MD_AUTH_TOKEN must be set to resume render jobs')
+
+            # Only one runner lists the participants
+            if RenderJob.objects.filter(id=job_id, status=RenderJob.PENDING).update(
+                    status=RenderJob.RUNNING, started=timezone.now()):
+                self._expand(job)
+
+            # Look up the study's current renders once rather than per participant
+            document_references = snapshots.document_references(job.study, ppm_ids=job.ppm_ids)
+
+            # Work through the tasks, then wait on those other runners hold, taking over any whose runner died
+            while self._work(job, document_references):
+                time.sleep(RenderJobs.POLL_INTERVAL)
+
+            RenderJob.objects.filter(id=job_id).update(status=RenderJob.DONE, finished=timezone.now())
+            logger.debug(f'PPM/{job.study}: Finished {job}')
+
+        except Exception as e:
+            logger.exception(f'PPM/RenderJobs: RenderJob/{job_id} failed: {e}', exc_info=True)
+            RenderJob.objects.filter(id=job_id).update(
+                status=RenderJob.FAILED, error=f'{type(e).__name__}: {e}', finished=timezone.now()
+            )
+
+        finally:
+            self._requests.pop(job_id, None)
+            close_old_connections()
+
+    def _work(self, job, document_references):
+        """
+        Renders the job's pending tasks and releases any whose runner died,
+        returning whether tasks are left to wait on.
+        """
+        # Hold no more tasks than the bulk workers can run
+        slots = threading.Semaphore(settings.RENDER_JOB_WORKERS)
+        futures = []
+        for task_id in list(job.tasks.filter(status=RenderTask.PENDING).values_list('id', flat=True)):
+            slots.acquire()
+            task = self._lease(task_id)
+            if not task:
+                slots.release()
+                continue
+
+            # A consent just signed is rendered once it is saved, waiting here rather than on a render thread
+            if task.submission_id and not outbox.wait(task.submission_id, settings.OUTBOX_RENDER_WAIT):
+                self._record(task, RenderTask.FAILED, error=f'Submission/{task.submission_id} was not delivered')
+                slots.release()
+                continue
+
+            # Deferred renders of consents just signed keep their priority
+            priority = RenderExecutor.BACKGROUND if task.submission_id else RenderExecutor.BULK
+            future = renders.submit(self._render, job, task, self._requests.get(job.id),
+                                    document_references.get(task.ppm_id), study=job.study, priority=priority)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        for future in futures:
+            future.result()
+
+        RenderJobs._release(job)
+        return job.tasks.filter(status__in=[RenderTask.PENDING, RenderTask.RUNNING]).exists()
+
+    @staticmethod
+    def _release(job=None):
+
+        # Return tasks whose runner died mid-render to the queue
+        tasks = RenderTask.objects.filter(status=RenderTask.RUNNING, leased_until__lt=timezone.now())
+        if job:
+            tasks = tasks.filter(job=job)
+
+        tasks.update(status=RenderTask.PENDING, leased_until=None)
+
+    def _expand(self, job):
+
+        # Add a task for every consented participant that was asked for
+        participants = snapshots.participants(job.study, ppm_ids=job.ppm_ids, enrollments=Participants.CONSENTED)
+        tasks = RenderTask.objects.bulk_create([
+            RenderTask(job=job, ppm_id=participant.ppm_id, enrollment=participant.enrollment)
+            for participant in participants.iterator()
+        ], ignore_conflicts=True)
+
+        logger.debug(f'PPM/{job.study}: {job} has {len(tasks)} participant(s)')
+
+    def _lease(self, task_id):
+        leased = RenderTask.objects.filter(id=task_id, status=RenderTask.PENDING).update(
+            status=RenderTask.RUNNING,
+            leased_until=timezone.now() + timedelta(seconds=settings.RENDER_JOB_LEASE),
+        )
+
+        return RenderTask.objects.get(id=task_id) if leased else None
+
+    def _render(self, job, task, request, document_reference=None):
+        from api.views import ConsentView
+
+        study, ppm_id = job.study, task.ppm_id
+        try:
+            if document_reference and not job.overwrite:
+                logger.debug(f'PPM/{study}/Patient/{ppm_id} already has consent PDF:'
+                             f' DocumentReference/{document_reference["id"]}')
+                return self._record(task, RenderTask.SKIPPED)
+
+            # Create their consent, unless someone else just did, replacing the current one if overwriting
+            logger.debug(f'{study}/Patient/{ppm_id}: Generating consent...')
+            if not ConsentView.render_consent_document_reference(request, study, ppm_id, job.overwrite):
+                return self._record(task, RenderTask.SKIPPED)
+
+            self._record(task, RenderTask.RENDERED, download_url=P2MD.get_consent_url(study=study, ppm_id=ppm_id))
+
+        except Exception as e:
+            logger.exception(f'PPM/{study}/Patient/{ppm_id}: Consent render failed: {e}', exc_info=True)
+            self._record(task, RenderTask.FAILED, error=f'{type(e).__name__}: {e}')
+
+        finally:
+            close_old_connections()
+
+    @staticmethod
+    def _record(task, status, error='', download_url=''):
+        task.status = status
+        task.error = error[:2000]
+        task.download_url = download_url
+        task.leased_until = None
+        task.save()
+
+
+# The render jobs for this process
+jobs = RenderJobs()
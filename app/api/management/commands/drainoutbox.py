@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Submission
+from api.outbox import outbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued FHIR submissions and prune old ones, optionally requeueing dead-lettered ones first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requeue', action='store_true', help='Requeue dead-lettered submissions')
+
+    def handle(self, *args, **options):
+
+        # Give dead submissions another chance
+        if options['requeue']:
+            count = outbox.requeue()
+            self.stdout.write(f'Requeued {count} dead submission(s)')
+
+        # Deliver everything that is due
+        delivered = 0
+        while True:
+            count = outbox.drain()
+            if not count:
+                break
+            delivered += count
+
+        # Delete old deliveries
+        pruned = outbox.prune()
+
+        # Report what is left
+        pending = Submission.objects.filter(status=Submission.PENDING).count()
+        dead = Submission.objects.filter(status=Submission.DEAD).count()
+        self.stdout.write(self.style.SUCCESS(
+            f'Delivered {delivered} submission(s), {pending} pending, {dead} dead, pruned {pruned}'
+        ))
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_render_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('study', models.CharField(max_length=64, unique=True)),
+                ('synced', models.DateTimeField(blank=True, null=True)),
+                ('scanned', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ParticipantSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('study', models.CharField(max_length=64)),
+                ('ppm_id', models.CharField(max_length=64)),
+                ('enrollment', models.CharField(blank=True, max_length=32)),
+                ('document_reference_id', models.CharField(blank=True, max_length=64)),
+                ('document_reference_url', models.TextField(blank=True)),
+                ('document_reference_timestamp', models.CharField(blank=True, max_length=64)),
+                ('synced', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ('id',),
+                'unique_together': {('study', 'ppm_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_participant_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rendertask',
+            name='submission',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='api.submission'),
+        ),
+    ]
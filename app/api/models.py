@@ -1,3 +1,202 @@
 from django.db import models
+from django.utils import timezone
 
-# Create your models here.
+
+class Submission(models.Model):
+    """
+    A participant's validated FHIR transaction Bundle waiting in the outbox
+    to be written to FHIR by the background writer. The Bundle is cleared
+    once delivered and the submission deleted after OUTBOX_RETENTION days.
+    """
+
+    # Delivery states
+    PENDING = 'pending'
+    DELIVERING = 'delivering'
+    DELIVERED = 'delivered'
+    DEAD = 'dead'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (DELIVERING, 'Delivering'),
+        (DELIVERED, 'Delivered'),
+        (DEAD, 'Dead'),
+    )
+
+    kind = models.CharField(max_length=32)
+    study = models.CharField(max_length=64, blank=True)
+    bundle = models.JSONField()
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    delivered = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id', )
+
+    def __str__(self):
+        return f'Submission/{self.id} ({self.kind}, {self.status})'
+
+
+class RenderJob(models.Model):
+    """
+    A request to render the consent PDFs of a study's participants, worked
+    through in the background one RenderTask per participant.
+    """
+
+    # Job states
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    study = models.CharField(max_length=64)
+    overwrite = models.BooleanField(default=False)
+    ppm_ids = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING, db_index=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('id', )
+
+    def __str__(self):
+        return f'RenderJob/{self.id} ({self.study}, {self.status})'
+
+    def as_dict(self, tasks=True):
+        """
+        Returns the job's state and progress for the status API
+
+        :param tasks: Whether to include each participant's task
+        :type tasks: bool
+        :rtype: dict
+        """
+        counts = dict.fromkeys([status for status, _ in RenderTask.STATUSES], 0)
+        counts.update(self.tasks.values_list('status').annotate(count=models.Count('id')).order_by())
+
+        data = {
+            'id': self.id,
+            'study': self.study,
+            'overwrite': self.overwrite,
+            'status': self.status,
+            'error': self.error or None,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'total': sum(counts.values()),
+            'progress': counts,
+        }
+        if tasks:
+            data['tasks'] = [task.as_dict() for task in self.tasks.all()]
+
+        return data
+
+
+class RenderTask(models.Model):
+    """
+    The consent render of one participant within a RenderJob
+    """
+
+    # Task states
+    PENDING = 'pending'
+    RUNNING = 'running'
+    RENDERED = 'rendered'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (RENDERED, 'Rendered'),
+        (SKIPPED, 'Skipped'),
+        (FAILED, 'Failed'),
+    )
+
+    job = models.ForeignKey(RenderJob, related_name='tasks', on_delete=models.CASCADE)
+    ppm_id = models.CharField(max_length=64)
+    submission = models.ForeignKey(Submission, null=True, blank=True, on_delete=models.SET_NULL)
+    enrollment = models.CharField(max_length=32, blank=True)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING, db_index=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    download_url = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('id', )
+        unique_together = (('job', 'ppm_id'), )
+
+    def __str__(self):
+        return f'RenderTask/{self.id} ({self.ppm_id}, {self.status})'
+
+    def as_dict(self):
+        return {
+            'ppm_id': self.ppm_id,
+            'enrollment': self.enrollment,
+            'status': self.status,
+            'download_url': self.download_url or None,
+            'error': self.error or None,
+            'updated': self.updated.isoformat(),
+        }
+
+
+class StudySnapshot(models.Model):
+    """
+    The state of a study's local ParticipantSnapshot: when it was last brought
+    up to date with FHIR, and when it was last rebuilt from a full scan.
+    """
+
+    study = models.CharField(max_length=64, unique=True)
+    synced = models.DateTimeField(null=True, blank=True)
+    scanned = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'StudySnapshot/{self.study} (synced {self.synced})'
+
+
+class ParticipantSnapshot(models.Model):
+    """
+    A local copy of a study participant's enrollment and consent render, as
+    last seen in FHIR, that the consent admin endpoints list from.
+    """
+
+    study = models.CharField(max_length=64)
+    ppm_id = models.CharField(max_length=64)
+    enrollment = models.CharField(max_length=32, blank=True)
+    document_reference_id = models.CharField(max_length=64, blank=True)
+    document_reference_url = models.TextField(blank=True)
+    document_reference_timestamp = models.CharField(max_length=64, blank=True)
+    synced = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('id', )
+        unique_together = (('study', 'ppm_id'), )
+
+    def __str__(self):
+        return f'ParticipantSnapshot/{self.study}/{self.ppm_id} ({self.enrollment})'
+
+    @property
+    def document_reference(self):
+        """
+        Returns the consent DocumentReference in the flattened form of
+        `FHIR.flatten_document_reference`, limited to what is kept here.
+
+        :rtype: dict, defaults to None
+        """
+        if not self.document_reference_id:
+            return None
+
+        return {
+            'id': self.document_reference_id,
+            'ppm_id': self.ppm_id,
+            'url': self.document_reference_url or None,
+            'timestamp': self.document_reference_timestamp or None,
+        }
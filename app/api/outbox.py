@@ -0,0 +1,454 @@
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from ppmutils.ppm import PPM
+from ppmutils.fhir import FHIR as PPMFHIR
+
+from api.models import Submission
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """
+    A durable queue of FHIR transactions. Submissions are stored in the
+    database and returned to the participant right away, while a background
+    writer delivers them to FHIR, retrying failures with exponential backoff
+    and dead-lettering those that cannot be delivered.
+
+    Any number of processes may run the writer; submissions are leased just
+    before delivery so each is sent by one writer at a time, and an outcome is
+    only recorded by the writer still holding the lease. Creates are made
+    conditional on an identifier unique to the submission, so a submission
+    sent twice, e.g. after its response was lost, is only written once.
+
+    Submissions holding a single resource, i.e. questionnaire responses, are
+    group-committed: those arriving within a short window are merged into one
+    FHIR `batch` and each entry's result is recorded on its own submission.
+
+    Work that needs a submission to be in FHIR first, e.g. a consent's render,
+    is handed to `on_delivered` rather than waiting on it, and is started by a
+    watcher thread once the submission is delivered, by whichever writer.
+    """
+
+    # Seconds between checks on the submissions being waited on
+    POLL_INTERVAL = 0.5
+
+    # Responses that are worth retrying
+    RETRY_STATUSES = (408, 429)
+
+    # Seconds between the writer's prunes of old submissions
+    PRUNE_INTERVAL = 3600
+
+    # The fields a delivery attempt updates
+    RECORDED_FIELDS = ('status', 'attempts', 'leased_until', 'next_attempt', 'last_error', 'delivered')
+
+    # Identifies the resources created by a submission, so resending it is harmless
+    IDENTIFIER_SYSTEM = 'https://peoplepoweredmedicine.org/fhir/submission'
+    SINGLE_IDENTIFIER_TYPES = ('QuestionnaireResponse', 'Composition')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._watches = []
+        self._watched = threading.Event()
+        self._watcher = None
+        self._pruned = None
+
+    def enqueue(self, bundle, kind, study=None):
+        """
+        Stores a transaction Bundle for delivery and wakes the writer.
+
+        :param bundle: The transaction Bundle
+        :type bundle: dict
+        :param kind: What the Bundle records, e.g. 'questionnaire' or 'consent'
+        :type kind: str
+        :param study: The study the submission is for
+        :type study: str
+        :return: The stored submission
+        :rtype: Submission
+        """
+        submission = Submission.objects.create(bundle=Outbox.conditional(bundle), kind=kind, study=study or '')
+        logger.debug(f'PPM/{study}: Queued {submission}')
+
+        # Make sure someone is delivering it
+        self.start()
+        self._wakeup.set()
+
+        return submission
+
+    def wait(self, submission_id, timeout):
+        """
+        Blocks until the submission is delivered or dead-lettered, or until the
+        timeout lapses.
+
+        :param submission_id: The ID of the submission
+        :type submission_id: int
+        :param timeout: The number of seconds to wait
+        :type timeout: float
+        :return: Whether the submission was delivered
+        :rtype: bool
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            status = Submission.objects.filter(id=submission_id).values_list('status', flat=True).first()
+            if status in (Submission.DELIVERED, Submission.DEAD, None):
+                return status == Submission.DELIVERED
+
+            if time.monotonic() >= deadline:
+                return False
+
+            time.sleep(Outbox.POLL_INTERVAL)
+
+    def on_delivered(self, submission_id, fn, timeout):
+        """
+        Calls `fn` with whether the submission was delivered once it is
+        delivered or dead-lettered, or once the timeout lapses. It is called
+        from the watcher thread, so nothing is held waiting in the meantime,
+        and must not block for long.
+
+        :param submission_id: The ID of the submission
+        :type submission_id: int
+        :param fn: Called with whether the submission was delivered
+        :type fn: callable
+        :param timeout: The number of seconds to wait
+        :type timeout: float
+        """
+        with self._lock:
+            self._watches.append((submission_id, time.monotonic() + timeout, fn))
+            if not self._watcher or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='outbox-watcher', daemon=True)
+                self._watcher.start()
+
+        self._watched.set()
+
+    def start(self):
+        """
+        Starts this process's writer thread, unless it is disabled or running.
+        """
+        if not settings.OUTBOX_WORKER or (self._thread and self._thread.is_alive()):
+            return
+
+        with self._lock:
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+                self._thread.start()
+
+    def drain(self, limit=None):
+        """
+        Delivers the submissions that are due, returning how many were sent.
+
+        :param limit: The most submissions to attempt
+        :type limit: int, defaults to None
+        :return: The number of submissions delivered
+        :rtype: int
+        """
+        now = timezone.now()
+
+        # Release submissions held by writers that died mid-delivery
+        Submission.objects.filter(status=Submission.DELIVERING, leased_until__lt=now).update(
+            status=Submission.PENDING, leased_until=None
+        )
+
+        # Find what is due and split out those that can share a batch
+        due = list(Submission.objects.filter(status=Submission.PENDING, next_attempt__lte=now)[
+            :limit or settings.OUTBOX_BATCH_SIZE])
+        grouped = [submission for submission in due if Outbox.groupable(submission)]
+        singles = [submission for submission in due if not Outbox.groupable(submission)]
+
+        # Lease each only as it is sent, so no lease runs out while it waits its turn
+        delivered = 0
+        size = settings.OUTBOX_GROUP_SIZE
+        for index in range(0, len(grouped), size):
+            group = [submission for submission in map(self._lease, grouped[index:index + size]) if submission]
+            if len(group) > 1:
+                delivered += self._deliver_batch(group)
+            elif group:
+                delivered += self._deliver(group[0])
+
+        for submission in singles:
+            submission = self._lease(submission)
+            if submission:
+                delivered += self._deliver(submission)
+
+        return delivered
+
+    @staticmethod
+    def groupable(submission):
+        """
+        Returns whether the submission can be merged into a batch with others.
+        Multi-resource transactions must stay atomic and are sent on their own.
+
+        :param submission: The submission
+        :type submission: Submission
+        :rtype: bool
+        """
+        return submission.kind == 'questionnaire' and len(submission.bundle.get('entry', [])) == 1
+
+    def prune(self):
+        """
+        Deletes delivered submissions older than OUTBOX_RETENTION days. Dead
+        submissions are kept, as they were never written to FHIR.
+
+        :return: The number of submissions deleted
+        :rtype: int
+        """
+        before = timezone.now() - timedelta(days=settings.OUTBOX_RETENTION)
+        count, _ = Submission.objects.filter(status=Submission.DELIVERED, delivered__lt=before).delete()
+        if count:
+            logger.debug(f'PPM/Outbox: Pruned {count} delivered submission(s)')
+
+        self._pruned = time.monotonic()
+        return count
+
+    def requeue(self, status=Submission.DEAD):
+        """
+        Returns dead-lettered submissions to the queue, e.g. after an outage.
+
+        :param status: The status of the submissions to requeue
+        :type status: str
+        :return: The number of submissions requeued
+        :rtype: int
+        """
+        count = Submission.objects.filter(status=status).update(
+            status=Submission.PENDING, attempts=0, next_attempt=timezone.now(), leased_until=None
+        )
+        self._wakeup.set()
+
+        return count
+
+    def _run(self):
+        logger.debug('PPM/Outbox: Writer started')
+        while True:
+            try:
+                close_old_connections()
+                while self.drain():
+                    pass
+
+                # Clear out old submissions now and then
+                if self._pruned is None or time.monotonic() - self._pruned >= Outbox.PRUNE_INTERVAL:
+                    self.prune()
+
+            except Exception as e:
+                logger.exception(f'PPM/Outbox: Writer error: {e}', exc_info=True)
+
+            # Sleep until something is queued or retries come due
+            if self._wakeup.wait(timeout=settings.OUTBOX_POLL_INTERVAL):
+
+                # Give concurrent submissions a moment to join the same batch
+                time.sleep(settings.OUTBOX_GROUP_WINDOW / 1000)
+
+            self._wakeup.clear()
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                idle = not self._watches
+
+            # Sleep until something is waited on or delivered here, checking for other writers' deliveries
+            self._watched.wait(timeout=None if idle else Outbox.POLL_INTERVAL)
+            self._watched.clear()
+
+            with self._lock:
+                watches, self._watches = self._watches, []
+
+            try:
+                close_old_connections()
+                statuses = dict(Submission.objects.filter(id__in=[watch[0] for watch in watches]).values_list(
+                    'id', 'status'))
+
+            except Exception as e:
+                logger.exception(f'PPM/Outbox: Watcher error: {e}', exc_info=True)
+                with self._lock:
+                    self._watches.extend(watches)
+                continue
+
+            # Hand off those that are done, keeping the rest
+            now = time.monotonic()
+            pending = []
+            for submission_id, deadline, fn in watches:
+                status = statuses.get(submission_id)
+                if status in (Submission.PENDING, Submission.DELIVERING) and now < deadline:
+                    pending.append((submission_id, deadline, fn))
+                    continue
+
+                try:
+                    fn(status == Submission.DELIVERED)
+                except Exception as e:
+                    logger.exception(f'PPM/Outbox: Submission/{submission_id} callback failed: {e}', exc_info=True)
+
+            with self._lock:
+                self._watches.extend(pending)
+
+    def _lease(self, submission):
+
+        # Only one writer can move it out of pending
+        leased = Submission.objects.filter(id=submission.id, status=Submission.PENDING).update(
+            status=Submission.DELIVERING,
+            leased_until=timezone.now() + timedelta(seconds=settings.OUTBOX_LEASE),
+        )
+
+        return Submission.objects.get(id=submission.id) if leased else None
+
+    def _deliver(self, submission):
+        try:
+            response = PPMFHIR.backend().request('post', url=PPM.fhir_url(), json=submission.bundle)
+            status = response.status_code
+            error = '' if response.ok else f'{status}: {response.text[:2000]}'
+
+        except Exception as e:
+            status, error = None, f'{type(e).__name__}: {e}'
+
+        return self._record(submission, status, error)
+
+    def _deliver_batch(self, submissions):
+
+        # Merge each submission's single entry into one batch
+        batch = {
+            'resourceType': 'Bundle',
+            'type': 'batch',
+            'entry': [submission.bundle['entry'][0] for submission in submissions],
+        }
+
+        try:
+            response = PPMFHIR.backend().request('post', url=PPM.fhir_url(), json=batch)
+            if not response.ok:
+                raise SystemError(f'{response.status_code}: {response.text[:2000]}')
+
+            entries = response.json().get('entry', [])
+            if len(entries) != len(submissions):
+                raise SystemError(f'Batch returned {len(entries)} entries for {len(submissions)} submissions')
+
+        except Exception as e:
+
+            # The batch as a whole failed, retry each
+            error = f'{type(e).__name__}: {e}'
+            logger.warning(f'PPM/Outbox: Batch of {len(submissions)} failed: {error}')
+            for submission in submissions:
+                self._record(submission, None, error)
+
+            return 0
+
+        logger.debug(f'PPM/Outbox: Delivered batch of {len(submissions)}')
+
+        # Fan the results back out
+        delivered = 0
+        for submission, entry in zip(submissions, entries):
+            result = entry.get('response', {})
+            status = int(result.get('status', '0').split(' ')[0] or 0)
+            error = '' if 200 <= status < 300 else f"{result.get('status')}: {result.get('outcome', '')}"[:2000]
+
+            delivered += self._record(submission, status, error)
+
+        return delivered
+
+    def _record(self, submission, status, error):
+        """
+        Records the outcome of a delivery attempt, scheduling a retry or
+        dead-lettering the submission if it failed.
+
+        :param submission: The submission that was sent
+        :type submission: Submission
+        :param status: The HTTP status returned for it, if any
+        :type status: int
+        :param error: A description of the failure
+        :type error: str
+        :return: Whether it was delivered
+        :rtype: bool
+        """
+        lease = submission.leased_until
+        submission.attempts += 1
+        submission.leased_until = None
+        if status and 200 <= status < 300:
+            submission.status = Submission.DELIVERED
+            submission.delivered = timezone.now()
+            submission.last_error = ''
+
+        else:
+
+            # Client errors will not succeed on retry
+            retry = not status or status >= 500 or status in Outbox.RETRY_STATUSES
+
+            submission.last_error = error
+            if retry and submission.attempts < settings.OUTBOX_MAX_ATTEMPTS:
+
+                # Back off exponentially
+                delay = min(settings.OUTBOX_BACKOFF * 2 ** (submission.attempts - 1), settings.OUTBOX_MAX_BACKOFF)
+                submission.status = Submission.PENDING
+                submission.next_attempt = timezone.now() + timedelta(seconds=delay)
+
+            else:
+                submission.status = Submission.DEAD
+
+        # Once delivered, FHIR holds the participant's data and it need not be kept here
+        fields = {field: getattr(submission, field) for field in Outbox.RECORDED_FIELDS}
+        if submission.status == Submission.DELIVERED:
+            submission.bundle = fields['bundle'] = {}
+
+        # Only record it while still holding its lease, as another writer may have taken it over
+        recorded = Submission.objects.filter(id=submission.id, status=Submission.DELIVERING, leased_until=lease).update(
+            **fields
+        )
+        if not recorded:
+            logger.warning(f'PPM/{submission.study}: Lost the lease on {submission}, leaving it to its new writer')
+            return False
+
+        if submission.status == Submission.DELIVERED:
+            logger.debug(f'PPM/{submission.study}: Delivered {submission} after {submission.attempts} attempt(s)')
+
+        elif submission.status == Submission.PENDING:
+            logger.warning(f'PPM/{submission.study}: {submission} failed, retrying at {submission.next_attempt}: '
+                           f'{error}')
+
+        else:
+            logger.error(f'PPM/{submission.study}: {submission} dead-lettered after {submission.attempts} attempt(s)',
+                         extra={'submission': submission.id, 'kind': submission.kind, 'error': error})
+
+        # Start anything waiting on it
+        if submission.status != Submission.PENDING:
+            self._watched.set()
+
+        return submission.status == Submission.DELIVERED
+
+    @staticmethod
+    def conditional(bundle):
+        """
+        Makes each create in the Bundle conditional on an identifier unique to
+        it, so a submission sent again, e.g. after its response was lost,
+        creates nothing new.
+
+        :param bundle: The transaction Bundle
+        :type bundle: dict
+        :return: The Bundle
+        :rtype: dict
+        """
+        key = uuid.uuid4()
+        for index, entry in enumerate(bundle.get('entry', [])):
+            request, resource = entry.get('request') or {}, entry.get('resource')
+            if request.get('method') != 'POST' or not resource or request.get('ifNoneExist'):
+                continue
+
+            # Some resources take only one identifier, leave those that have theirs
+            identifier = {'system': Outbox.IDENTIFIER_SYSTEM, 'value': f'{key}-{index}'}
+            if resource.get('resourceType') in Outbox.SINGLE_IDENTIFIER_TYPES:
+                if resource.get('identifier'):
+                    continue
+                resource['identifier'] = identifier
+            else:
+                resource.setdefault('identifier', []).append(identifier)
+
+            request['ifNoneExist'] = f'identifier={Outbox.IDENTIFIER_SYSTEM}|{identifier["value"]}'
+
+        return bundle
+
+
+# The outbox for this process
+outbox = Outbox()
@@ -0,0 +1,252 @@
+from datetime import timezone
+
+from furl import furl
+
+from ppmutils.fhir import FHIR
+from ppmutils.ppm import PPM
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Participants(object):
+    """
+    Study-wide lookups for the consent admin endpoints. Each of these fetches
+    a study's worth of resources with a paged FHIR search, so callers join
+    the results in memory instead of querying per participant. Filters are
+    passed to FHIR as search parameters so only the participants asked for
+    are fetched.
+
+    Pages are fetched lazily: the next page of results is only requested once
+    the caller has consumed the last, so participants can be worked through,
+    or streamed out, without holding the whole study in memory.
+    """
+
+    # Every enrollment past registration, i.e. participants that have consented
+    CONSENTED = [enrollment.value for enrollment in PPM.Enrollment if enrollment is not PPM.Enrollment.Registered]
+
+    # The most participant IDs to put in a single search
+    CHUNK_SIZE = 100
+
+    # The number of results to ask for per page
+    PAGE_SIZE = 999
+
+    @staticmethod
+    def pages(study, ppm_ids=None, enrollments=None, testing=False, since=None, count=None):
+        """
+        Yields the participants in the study a page of search results at a
+        time, optionally limited to the given PPM IDs and enrollments. The
+        search is made against the participants' enrollment Flags, with their
+        Patients included, so the filters are applied by FHIR rather than
+        after fetching the study.
+
+        Example:
+
+        {
+            "ppm_id": str,
+            "fhir_id": str,
+            "email": str,
+            "enrollment": str,
+            "study": str,
+        }
+
+        :param study: The study to list participants for
+        :type study: str
+        :param ppm_ids: Limits the results to these participants
+        :type ppm_ids: list, defaults to None
+        :param enrollments: Limits the results to these enrollments
+        :type enrollments: list, defaults to None
+        :param testing: Whether to include testing participants or not
+        :type testing: bool, defaults to False
+        :param since: Limits the results to enrollments updated after this
+        :type since: datetime, defaults to None
+        :param count: The number of results per page
+        :type count: int, defaults to PAGE_SIZE
+        :return: The flattened participants of each page
+        :rtype: generator
+        """
+        study = PPM.Study.get(study).value
+
+        # Build the search for the study's enrollment Flags and their Patients
+        query = {
+            "identifier": f"{FHIR.enrollment_flag_study_identifier_system}|{PPM.Study.fhir_id(study)}",
+            "_include": "Flag:subject",
+        }
+        if enrollments:
+            query["code"] = ",".join(
+                f"{FHIR.enrollment_flag_coding_system}|{PPM.Enrollment.get(enrollment).value}"
+                for enrollment in enrollments
+            )
+        if since:
+            query["_lastUpdated"] = Participants._last_updated(since)
+
+        for resources in Participants._search("Flag", query, "subject", ppm_ids, count=count):
+
+            # Index the included Patients
+            patients = {r["id"]: r for r in resources if r["resourceType"] == "Patient"}
+
+            participants = []
+            for flag in (r for r in resources if r["resourceType"] == "Flag"):
+                try:
+                    ppm_id = flag["subject"]["reference"].split("/")[1]
+                    patient = patients.get(ppm_id)
+                    if not patient:
+                        continue
+
+                    # Fetch their email
+                    email = next(
+                        identifier["value"]
+                        for identifier in patient.get("identifier", [])
+                        if identifier.get("system") == FHIR.patient_email_identifier_system
+                    )
+
+                    # Check if tester
+                    if not testing and PPM.is_tester(email):
+                        continue
+
+                    participants.append({
+                        "ppm_id": ppm_id,
+                        "fhir_id": ppm_id,
+                        "email": email,
+                        "enrollment": flag["code"]["coding"][0]["code"],
+                        "study": study,
+                    })
+
+                except (KeyError, IndexError, StopIteration) as e:
+                    logger.exception(f"PPM/{study}: Resources malformed for Flag/{flag.get('id')}: {e}")
+
+            if participants:
+                yield participants
+
+    @staticmethod
+    def iterate(study, ppm_ids=None, enrollments=None, testing=False):
+        """
+        Yields the participants in the study one at a time. See `pages`.
+
+        :return: The flattened participants
+        :rtype: generator
+        """
+        for participants in Participants.pages(study, ppm_ids=ppm_ids, enrollments=enrollments, testing=testing):
+            yield from participants
+
+    @staticmethod
+    def consent_document_references(study, ppm_ids=None, since=None):
+        """
+        Returns the flattened consent DocumentReference of every participant
+        in the study that has one, keyed by their PPM ID.
+
+        :param study: The study for which the consents were signed
+        :type study: str
+        :param ppm_ids: Limits the results to these participants
+        :type ppm_ids: list, defaults to None
+        :param since: Limits the results to those updated after this
+        :type since: datetime, defaults to None
+        :return: The DocumentReferences by PPM ID
+        :rtype: dict
+        """
+        # Search for every consent render for the study at once
+        query = {
+            "type": f"{FHIR.ppm_consent_type_system}|{FHIR.ppm_consent_type_value}",
+            "related": f"ResearchStudy/{PPM.Study.fhir_id(study)}",
+        }
+        if since:
+            query["_lastUpdated"] = Participants._last_updated(since)
+
+        document_references = {}
+        for resources in Participants._search("DocumentReference", query, "subject", ppm_ids):
+            for resource in resources:
+                document_reference = FHIR.flatten_document_reference(resource)
+                ppm_id = document_reference.get("ppm_id")
+                if not ppm_id:
+                    continue
+
+                # Keep the first, as the per-participant lookup does
+                if ppm_id in document_references:
+                    logger.error(f"PPM/{study}/Patient/{ppm_id}: Multiple consent DocumentReferences", extra={
+                        "document_references": [
+                            f"DocumentReference/{document_references[ppm_id]['id']}",
+                            f"DocumentReference/{document_reference['id']}",
+                        ],
+                    })
+                    continue
+
+                document_references[ppm_id] = document_reference
+
+        logger.debug(f"PPM/{study}: Found {len(document_references)} consent DocumentReference(s)")
+        return document_references
+
+    @staticmethod
+    def _last_updated(since):
+        """
+        Returns the `_lastUpdated` search for resources updated after the time
+
+        :param since: The time
+        :type since: datetime
+        :rtype: str
+        """
+        return f"gt{since.astimezone(timezone.utc):%Y-%m-%dT%H:%M:%SZ}"
+
+    @staticmethod
+    def _search(resource_type, query, key, ppm_ids=None, count=None):
+        """
+        Runs the search, once per chunk of PPM IDs when limited to them, and
+        yields the resources on each page of results.
+
+        :param resource_type: The type of resource to search for
+        :type resource_type: str
+        :param query: The search parameters
+        :type query: dict
+        :param key: The search parameter referencing the Patient
+        :type key: str
+        :param ppm_ids: Limits the search to these participants
+        :type ppm_ids: list, defaults to None
+        :param count: The number of results per page
+        :type count: int, defaults to PAGE_SIZE
+        :return: The resources of each page
+        :rtype: generator
+        """
+        if ppm_ids is None:
+            yield from Participants._pages(resource_type, query, count)
+            return
+
+        ppm_ids = sorted(set(ppm_ids))
+        for index in range(0, len(ppm_ids), Participants.CHUNK_SIZE):
+            chunk = ppm_ids[index:index + Participants.CHUNK_SIZE]
+            yield from Participants._pages(resource_type, dict(query, **{
+                key: ",".join(f"Patient/{ppm_id}" for ppm_id in chunk),
+            }), count)
+
+    @staticmethod
+    def _pages(resource_type, query, count=None):
+        """
+        Runs the search and yields the resources on each page of results,
+        only fetching a page once the one before it has been consumed.
+
+        :param resource_type: The type of resource to search for
+        :type resource_type: str
+        :param query: The search parameters
+        :type query: dict
+        :param count: The number of results per page
+        :type count: int, defaults to PAGE_SIZE
+        :return: The resources of each page
+        :rtype: generator
+        """
+        # Build the URL
+        url_builder = furl(PPM.fhir_url())
+        url_builder.path.add(resource_type)
+        url_builder.query.params.add("_count", count or Participants.PAGE_SIZE)
+        for key, value in query.items():
+            url_builder.query.params.add(key, value)
+
+        url = url_builder.url
+        while url is not None:
+            response = FHIR.get(url)
+            response.raise_for_status()
+
+            bundle = response.json()
+            yield [entry["resource"] for entry in bundle.get("entry", []) if entry.get("resource")]
+
+            # Check for a page, swapping the domain if necessary
+            url = next((link["url"] for link in bundle.get("link", []) if link["relation"] == "next"), None)
+            if url is not None and furl(url).host != furl(PPM.fhir_url()).host:
+                url = furl(url).set(host=furl(PPM.fhir_url()).host).url
@@ -0,0 +1,322 @@
+import fcntl
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from fhirquestionnaire.cache import SingleFlight
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RenderExecutor(object):
+    """
+    Runs consent renders on a process-wide pool of RENDER_WORKERS threads so
+    a burst of renders is worked through at a steady rate instead of starting
+    a renderer for each at once.
+
+    Renders are scheduled by priority: interactive renders, that a participant
+    or admin is waiting on, run before background renders, e.g. those started
+    once a participant signs, which run before the renders of bulk jobs. A
+    running render is never interrupted, but bulk jobs queue one render per
+    participant, so they yield to other work between participants, and they
+    may only take RENDER_JOB_WORKERS of the threads, keeping the rest free for
+    everyone else. Within a priority, studies take turns so no one study's
+    renders hold up another's.
+
+    At most RENDER_QUEUE_SIZE background or bulk renders wait at a time. Past
+    that, renders are handed to their overflow, e.g. the durable render job
+    queue, or the caller blocks until there is room. Interactive renders are
+    always queued. The queue depth and the time renders spend waiting and
+    running are tracked for `stats`.
+    """
+
+    # Priorities, from the most urgent
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    BULK = 2
+    PRIORITIES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BULK: 'bulk'}
+
+    PHASES = ('wait', 'render')
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._queues = {priority: OrderedDict() for priority in RenderExecutor.PRIORITIES}
+        self._threads = []
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the counters and timings, keeping the queue depth and the
+        number of renders running as they are.
+        """
+        with self._lock:
+            current = getattr(self, '_stats', {})
+            self._stats = {priority: {
+                'queued': 0, 'overflowed': 0, 'rendered': 0, 'failed': 0,
+                'depth': current.get(priority, {}).get('depth', 0),
+                'running': current.get(priority, {}).get('running', 0),
+                'totals': dict.fromkeys(RenderExecutor.PHASES, 0.0),
+                'maximums': dict.fromkeys(RenderExecutor.PHASES, 0.0),
+            } for priority in RenderExecutor.PRIORITIES}
+
+    def submit(self, fn, *args, study=None, priority=BACKGROUND, overflow=None):
+        """
+        Queues `fn(*args)` to run on the render threads. When the queue is
+        full the render is handed to `overflow` instead, or, without one,
+        this blocks until there is room.
+
+        :param fn: The render to run
+        :type fn: callable
+        :param study: The study the render is for
+        :type study: str
+        :param priority: The priority of the render
+        :type priority: int, defaults to BACKGROUND
+        :param overflow: Called in place of queueing when the queue is full
+        :type overflow: callable, defaults to None
+        :return: The render's future, unless it was overflowed
+        :rtype: Future
+        """
+        self._start()
+
+        with self._lock:
+            stats = self._stats[priority]
+
+            # Wait for room, unless it can go elsewhere
+            def full():
+                return priority != RenderExecutor.INTERACTIVE and stats['depth'] >= settings.RENDER_QUEUE_SIZE
+
+            while full() and overflow is None:
+                self._lock.wait()
+
+            if not full():
+                future = Future()
+                self._queues[priority].setdefault(study, deque()).append((time.monotonic(), fn, args, future))
+                stats['queued'] += 1
+                stats['depth'] += 1
+                self._lock.notify_all()
+
+                return future
+
+            stats['overflowed'] += 1
+
+        logger.warning(f'PPM/{study}: {RenderExecutor.PRIORITIES[priority].title()} render queue is full '
+                       f'({settings.RENDER_QUEUE_SIZE}), overflowing render')
+        overflow()
+
+    def run(self, fn, *args, study=None, priority=INTERACTIVE):
+        """
+        Runs `fn(*args)` on the render threads, ahead of lower priority
+        renders, and returns its result for a caller waiting on it.
+
+        :param fn: The render to run
+        :type fn: callable
+        :param study: The study the render is for
+        :type study: str
+        :param priority: The priority of the render
+        :type priority: int, defaults to INTERACTIVE
+        :return: Whatever `fn` returns
+        """
+        # Render threads run it themselves rather than wait on each other
+        if threading.current_thread() in self._threads:
+            return fn(*args)
+
+        return self.submit(fn, *args, study=study, priority=priority).result()
+
+    def stats(self):
+        """
+        Returns, for each priority, the queue depth, the number of renders
+        running and the counts of renders queued, overflowed, rendered and
+        failed, along with the mean and longest time renders waited and ran
+        in milliseconds.
+
+        :rtype: dict
+        """
+        stats = {'workers': settings.RENDER_WORKERS, 'bulk_workers': settings.RENDER_JOB_WORKERS}
+        with self._lock:
+            for priority, name in RenderExecutor.PRIORITIES.items():
+                counts = self._stats[priority]
+                finished = counts['rendered'] + counts['failed']
+                stats[name] = {key: value for key, value in counts.items() if key not in ('totals', 'maximums')}
+                for phase in RenderExecutor.PHASES:
+                    stats[name][f'{phase}_mean_ms'] = counts['totals'][phase] * 1000 / finished if finished else 0
+                    stats[name][f'{phase}_max_ms'] = counts['maximums'][phase] * 1000
+
+        return stats
+
+    def _start(self):
+        if self._threads:
+            return
+
+        with self._lock:
+            if not self._threads:
+                for index in range(settings.RENDER_WORKERS):
+                    thread = threading.Thread(target=self._work, name=f'render-{index}', daemon=True)
+                    self._threads.append(thread)
+                    thread.start()
+
+    def _next(self):
+        """
+        Takes the next render to run: the most urgent one that may run now,
+        from the study whose turn it is. The lock must be held.
+        """
+        for priority, studies in self._queues.items():
+            if not studies:
+                continue
+
+            # Leave threads for everyone else
+            if priority == RenderExecutor.BULK and self._stats[priority]['running'] >= settings.RENDER_JOB_WORKERS:
+                continue
+
+            # Take the next study's render and send the study to the back
+            study, renders = next(iter(studies.items()))
+            render = renders.popleft()
+            del studies[study]
+            if renders:
+                studies[study] = renders
+
+            return priority, study, render
+
+        return None
+
+    def _work(self):
+        while True:
+            with self._lock:
+                task = self._next()
+                while task is None:
+                    self._lock.wait()
+                    task = self._next()
+
+                priority, study, (queued, fn, args, future) = task
+                stats = self._stats[priority]
+                stats['depth'] -= 1
+                stats['running'] += 1
+                self._lock.notify_all()
+
+            started = time.monotonic()
+            failed = False
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(fn(*args))
+
+            except Exception as e:
+
+                # Interactive callers get the exception to handle themselves
+                if priority != RenderExecutor.INTERACTIVE:
+                    logger.exception(f'PPM/{study}: {RenderExecutor.PRIORITIES[priority].title()} render failed: '
+                                     f'{e}', exc_info=True)
+                future.set_exception(e)
+                failed = True
+
+            finally:
+                durations = {'wait': started - queued, 'render': time.monotonic() - started}
+                with self._lock:
+                    stats['running'] -= 1
+                    stats['failed' if failed else 'rendered'] += 1
+                    for phase, duration in durations.items():
+                        stats['totals'][phase] += duration
+                        stats['maximums'][phase] = max(stats['maximums'][phase], duration)
+                    self._lock.notify_all()
+
+                logger.debug(f'PPM/{study}: {RenderExecutor.PRIORITIES[priority].title()} render waited '
+                             f'{durations["wait"]:.3f}s, ran {durations["render"]:.3f}s')
+
+                connections.close_all()
+
+
+class RenderLocks(object):
+    """
+    Keeps a participant's consent from being rendered more than once at a
+    time, e.g. by the render started once they sign, their download and an
+    admin's download all finding no render and each making their own.
+
+    Renders of a participant's consent hold their lock, which is a lock in
+    this process and, with RENDER_LOCK_DIR set, a file lock shared with the
+    other worker processes. Renders must check for the participant's current
+    render once they hold it. Callers of `do` making the same render while
+    one is in flight in this process wait for it and share its result rather
+    than queueing up behind it.
+
+    Locks must only be taken on the render threads, as a render waiting on
+    one may hold the thread its holder would otherwise need. Lock files are
+    left in place, as removing them would race with processes waiting on them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._flights = SingleFlight()
+
+    def do(self, study, ppm_id, fn, *args, kind=None):
+        """
+        Runs `fn(*args)` holding the participant's render lock, unless the
+        same kind of render is already in flight for them in this process,
+        in which case this waits for and returns its result.
+
+        :param study: The study the render is for
+        :type study: str
+        :param ppm_id: The participant
+        :type ppm_id: str
+        :param fn: The render to run
+        :type fn: callable
+        :param kind: Distinguishes renders that may not share results
+        :type kind: hashable, defaults to None
+        :return: Whatever `fn` returns
+        """
+        return self._flights.do((study, ppm_id, kind), self._run, study, ppm_id, fn, *args)
+
+    @contextmanager
+    def lock(self, study, ppm_id):
+        """
+        Holds the participant's render lock, waiting for it if need be.
+
+        :param study: The study the render is for
+        :type study: str
+        :param ppm_id: The participant
+        :type ppm_id: str
+        """
+        key = (study, ppm_id)
+        with self._lock:
+            lock, holders = self._locks.get(key) or (threading.Lock(), 0)
+            self._locks[key] = (lock, holders + 1)
+
+        try:
+            with lock:
+                if not settings.RENDER_LOCK_DIR:
+                    yield
+                    return
+
+                # Take turns with the other processes
+                name = re.sub(r'[^\w.-]', '_', f'{study}-{ppm_id}')
+                with open(os.path.join(settings.RENDER_LOCK_DIR, f'{name}.lock'), 'a') as file:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(file, fcntl.LOCK_UN)
+
+        finally:
+
+            # Drop the lock once no one holds or waits on it
+            with self._lock:
+                lock, holders = self._locks[key]
+                if holders > 1:
+                    self._locks[key] = (lock, holders - 1)
+                else:
+                    del self._locks[key]
+
+    def _run(self, study, ppm_id, fn, *args):
+        with self.lock(study, ppm_id):
+            return fn(*args)
+
+
+# The render executor and render locks for this process
+renders = RenderExecutor()
+locks = RenderLocks()
@@ -0,0 +1,214 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from ppmutils.ppm import PPM
+
+from api.models import StudySnapshot, ParticipantSnapshot
+from api.participants import Participants
+from fhirquestionnaire.cache import SingleFlight
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ParticipantSnapshots(object):
+    """
+    Keeps a local snapshot of each study's participants and their consent
+    renders, so the consent admin endpoints need not scan the study in FHIR
+    on every call. A study's snapshot is built with one full scan and then
+    kept up to date by searching for only the enrollment Flags and consent
+    DocumentReferences updated since it was last synced (`_lastUpdated`).
+
+    Resources deleted from FHIR do not show up in those searches, so renders
+    this app deletes are removed from the snapshot as they are deleted, and
+    the snapshot is rebuilt with a full scan every
+    PARTICIPANT_SNAPSHOT_MAX_AGE seconds to catch any others. Concurrent
+    refreshes of a study are coalesced into one.
+
+    Lookups for a few participants do not wait on a full scan: while the
+    study's snapshot is due a rebuild, just those participants are searched
+    for in FHIR, and stored, instead.
+    """
+
+    # How far back each sync reaches past the last, to absorb clock skew with FHIR
+    OVERLAP = timedelta(minutes=1)
+
+    def __init__(self):
+        self._flights = SingleFlight()
+
+    def participants(self, study, ppm_ids=None, enrollments=None):
+        """
+        Brings the study's snapshot up to date and returns its participants,
+        optionally limited to the given PPM IDs and enrollments.
+
+        :param study: The study to list participants for
+        :type study: str
+        :param ppm_ids: Limits the results to these participants
+        :type ppm_ids: list, defaults to None
+        :param enrollments: Limits the results to these enrollments
+        :type enrollments: list, defaults to None
+        :return: The participants' snapshots
+        :rtype: QuerySet
+        """
+        study = PPM.Study.get(study).value
+
+        # Search for just the participants asked for rather than rescan the study for them
+        if ppm_ids is not None and ParticipantSnapshots._stale(StudySnapshot.objects.filter(study=study).first()):
+            return self._fetch(study, ppm_ids, enrollments)
+
+        study = self.refresh(study)
+
+        participants = ParticipantSnapshot.objects.filter(study=study)
+        if ppm_ids is not None:
+            participants = participants.filter(ppm_id__in=ppm_ids)
+        if enrollments:
+            participants = participants.filter(enrollment__in=enrollments)
+
+        return participants
+
+    def document_references(self, study, ppm_ids=None):
+        """
+        Brings the study's snapshot up to date and returns the consent
+        DocumentReference of every participant that has one, keyed by their
+        PPM ID, in the flattened form of `FHIR.flatten_document_reference`.
+
+        :param study: The study for which the consents were signed
+        :type study: str
+        :param ppm_ids: Limits the results to these participants
+        :type ppm_ids: list, defaults to None
+        :return: The DocumentReferences by PPM ID
+        :rtype: dict
+        """
+        participants = self.participants(study, ppm_ids=ppm_ids).exclude(document_reference_id='')
+
+        return {participant.ppm_id: participant.document_reference for participant in participants.iterator()}
+
+    def refresh(self, study):
+        """
+        Brings the study's snapshot up to date with FHIR, rebuilding it when
+        it has not been fully scanned for PARTICIPANT_SNAPSHOT_MAX_AGE.
+
+        :param study: The study to refresh
+        :type study: str
+        :return: The study
+        :rtype: str
+        """
+        study = PPM.Study.get(study).value
+        self._flights.do(study, self._refresh, study)
+
+        return study
+
+    def forget_render(self, study, ppm_id):
+        """
+        Removes the participant's consent render from the snapshot, e.g.
+        once it has been deleted from FHIR.
+
+        :param study: The study for which the consent was signed
+        :type study: str
+        :param ppm_id: The participant
+        :type ppm_id: str
+        """
+        ParticipantSnapshot.objects.filter(study=PPM.Study.get(study).value, ppm_id=ppm_id).update(
+            document_reference_id='', document_reference_url='', document_reference_timestamp='',
+        )
+
+    def _refresh(self, study):
+        snapshot, _ = StudySnapshot.objects.get_or_create(study=study)
+
+        # Rebuild it if it has not been fully scanned lately
+        started = timezone.now()
+        full = ParticipantSnapshots._stale(snapshot)
+        since = None if full else snapshot.synced - ParticipantSnapshots.OVERLAP
+
+        # Get the renders first so new participants are stored with theirs
+        document_references = Participants.consent_document_references(study, since=since)
+
+        # Store the participants, updating the enrollment of those already stored
+        count = 0
+        fields = ['enrollment', 'synced']
+        if full:
+            fields.extend(['document_reference_id', 'document_reference_url', 'document_reference_timestamp'])
+
+        for participants in Participants.pages(study, since=since):
+            ParticipantSnapshot.objects.bulk_create([
+                ParticipantSnapshots._snapshot(study, participant, document_references.get(participant['ppm_id']),
+                                               started)
+                for participant in participants
+            ], update_conflicts=True, unique_fields=['study', 'ppm_id'], update_fields=fields)
+            count += len(participants)
+
+        if full:
+
+            # Drop whoever is no longer in the study
+            ParticipantSnapshot.objects.filter(study=study, synced__lt=started).delete()
+
+        else:
+
+            # Update the renders that changed
+            for ppm_id, document_reference in document_references.items():
+                ParticipantSnapshot.objects.filter(study=study, ppm_id=ppm_id).update(
+                    document_reference_id=document_reference['id'],
+                    document_reference_url=document_reference.get('url') or '',
+                    document_reference_timestamp=document_reference.get('timestamp') or '',
+                )
+
+        snapshot.synced = started
+        if full:
+            snapshot.scanned = started
+        snapshot.save()
+
+        logger.debug(f'PPM/{study}: {"Rebuilt" if full else "Synced"} participant snapshot with {count} '
+                     f'participant(s) and {len(document_references)} consent render(s)')
+
+    def _fetch(self, study, ppm_ids, enrollments=None):
+        started = timezone.now()
+
+        # Search for the participants and their renders by ID, filtered by FHIR
+        document_references = Participants.consent_document_references(study, ppm_ids=ppm_ids)
+        participants = list(Participants.iterate(study, ppm_ids=ppm_ids, enrollments=enrollments))
+
+        # Store them, so the rebuild that is due need not be waited on
+        ParticipantSnapshot.objects.bulk_create([
+            ParticipantSnapshots._snapshot(study, participant, document_references.get(participant['ppm_id']), started)
+            for participant in participants
+        ], update_conflicts=True, unique_fields=['study', 'ppm_id'], update_fields=[
+            'enrollment', 'document_reference_id', 'document_reference_url', 'document_reference_timestamp', 'synced',
+        ])
+
+        logger.debug(f'PPM/{study}: Fetched {len(participants)} of {len(ppm_ids)} participant(s) for a stale snapshot')
+
+        # Only those found match, whatever else an outdated snapshot holds for the others
+        return ParticipantSnapshot.objects.filter(
+            study=study, ppm_id__in=[participant['ppm_id'] for participant in participants]
+        )
+
+    @staticmethod
+    def _stale(snapshot):
+        """
+        Returns whether the study's snapshot is due a rebuild from a full scan
+
+        :param snapshot: The study's snapshot
+        :type snapshot: StudySnapshot, defaults to None
+        :rtype: bool
+        """
+        return not snapshot or not snapshot.scanned or not snapshot.synced or \
+            snapshot.scanned < timezone.now() - timedelta(seconds=settings.PARTICIPANT_SNAPSHOT_MAX_AGE)
+
+    @staticmethod
+    def _snapshot(study, participant, document_reference, synced):
+        document_reference = document_reference or {}
+        return ParticipantSnapshot(
+            study=study,
+            ppm_id=participant['ppm_id'],
+            enrollment=participant['enrollment'],
+            document_reference_id=document_reference.get('id') or '',
+            document_reference_url=document_reference.get('url') or '',
+            document_reference_timestamp=document_reference.get('timestamp') or '',
+            synced=synced,
+        )
+
+
+# The participant snapshots for this process
+snapshots = ParticipantSnapshots()
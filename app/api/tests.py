@@ -1,3 +1,915 @@
-from django.test import TestCase
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.exceptions import PermissionDenied
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from furl import furl
+from ppmutils.fhir import FHIR as PPMFHIR, HAPIFHIR
+from ppmutils.ppm import PPM
+
+from api.jobs import RenderJobs
+from api.models import Submission, RenderJob, RenderTask, StudySnapshot, ParticipantSnapshot
+from fhirquestionnaire.http import P2MD, SessionRegistry, PooledHAPIFHIR, install
+from fhirquestionnaire.ppmauth import PPMAdminOrOwnerPermission
+from api.outbox import Outbox
+from api.participants import Participants
+from api.renders import RenderExecutor, RenderLocks
+from api.snapshots import ParticipantSnapshots
+from api.views import ConsentsView
+
+
+def response(status, body=None):
+    """
+    Builds a stand-in for the FHIR server's response to a POST.
+    """
+    return mock.Mock(status_code=status, ok=200 <= status < 300, text='', json=mock.Mock(return_value=body or {}))
+
+
+@override_settings(HTTP_RETRIES=2, HTTP_POOL_MAXSIZE=4, HTTP_CONNECT_TIMEOUT=1, HTTP_READ_TIMEOUT=2)
+class SessionRegistryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.sessions = SessionRegistry()
+        self.addCleanup(self.sessions.close)
+
+    def test_shares_a_session_per_origin(self):
+        session = self.sessions.session('https://fhir.example.com/Patient')
+
+        self.assertIs(self.sessions.session('https://fhir.example.com/Questionnaire?_id=1'), session)
+        self.assertIsNot(self.sessions.session('https://fhir.example.com:8443/Patient'), session)
+        self.assertIsNot(self.sessions.session('https://p2md.example.com/'), session)
+
+    def test_pools_and_retries_idempotent_requests(self):
+        adapter = self.sessions.session('https://fhir.example.com/').get_adapter('https://fhir.example.com/')
+
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 2)
+        self.assertIn('GET', adapter.max_retries.allowed_methods)
+        self.assertNotIn('POST', adapter.max_retries.allowed_methods)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+
+    def test_times_out_requests(self):
+        with mock.patch('requests.Session.request') as request:
+            self.sessions.get('https://fhir.example.com/Patient')
+            self.sessions.post('https://fhir.example.com/', timeout=10)
+
+        self.assertEqual(request.call_args_list[0].kwargs['timeout'], (1, 2))
+        self.assertEqual(request.call_args_list[1].kwargs['timeout'], 10)
+
+    def test_warmup_ignores_failures(self):
+        with mock.patch('requests.Session.request', side_effect=ConnectionError('Refused')) as request:
+            self.sessions.warmup(['https://fhir.example.com/', 'https://p2md.example.com/'])
+
+        self.assertEqual([call.kwargs['method'] for call in request.call_args_list], ['head', 'head'])
+
+    def test_pools_hapi_fhir_requests(self):
+        with mock.patch('fhirquestionnaire.http.Backend.instance', return_value=HAPIFHIR()), \
+                mock.patch.object(PPMFHIR, '_backend', None):
+            install()
+            self.assertIsInstance(PPMFHIR._backend, PooledHAPIFHIR)
+
+
+@override_settings(OUTBOX_WORKER=False, OUTBOX_MAX_ATTEMPTS=3, OUTBOX_BACKOFF=5, OUTBOX_MAX_BACKOFF=8)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.outbox = Outbox()
+
+        # Answer deliveries with the statuses a test sets
+        self.responses = []
+        backend = mock.patch('api.outbox.PPMFHIR.backend')
+        self.request = backend.start().return_value.request
+        self.request.side_effect = lambda *args, **kwargs: self.responses.pop(0)
+        self.addCleanup(backend.stop)
+
+    def enqueue(self, kind='consent', entries=2):
+        bundle = {'resourceType': 'Bundle', 'type': 'transaction', 'entry': [{'resource': {}}] * entries}
+        return self.outbox.enqueue(bundle, kind, 'neer')
+
+    def make_due(self, submission):
+        Submission.objects.filter(id=submission.id).update(next_attempt=timezone.now())
+
+    def test_delivers(self):
+        submission = self.enqueue()
+        self.responses = [response(201)]
+
+        self.assertEqual(self.outbox.drain(), 1)
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.DELIVERED)
+        self.assertEqual(submission.attempts, 1)
+        self.assertIsNotNone(submission.delivered)
+
+        # The participant's data is not kept once it is in FHIR
+        self.assertEqual(submission.bundle, {})
+
+    @override_settings(OUTBOX_RETENTION=7)
+    def test_prunes_old_deliveries(self):
+        old, recent, dead = self.enqueue(), self.enqueue(), self.enqueue()
+        Submission.objects.filter(id=old.id).update(status=Submission.DELIVERED,
+                                                    delivered=timezone.now() - timedelta(days=8))
+        Submission.objects.filter(id=recent.id).update(status=Submission.DELIVERED,
+                                                       delivered=timezone.now() - timedelta(days=6))
+        Submission.objects.filter(id=dead.id).update(status=Submission.DEAD)
+
+        self.assertEqual(self.outbox.prune(), 1)
+        self.assertEqual(set(Submission.objects.values_list('id', flat=True)), {recent.id, dead.id})
+
+    def test_retries_server_errors_with_backoff(self):
+        submission = self.enqueue()
+        self.responses = [response(500), response(503), response(200)]
+
+        # The first retry waits the base backoff
+        before = timezone.now()
+        self.assertEqual(self.outbox.drain(), 0)
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.PENDING)
+        self.assertEqual(submission.attempts, 1)
+        self.assertGreaterEqual((submission.next_attempt - before).total_seconds(), 5)
+
+        # It is not retried before then
+        self.assertEqual(self.outbox.drain(), 0)
+        self.assertEqual(self.request.call_count, 1)
+
+        # The next doubles, up to the maximum
+        self.make_due(submission)
+        before = timezone.now()
+        self.outbox.drain()
+        submission.refresh_from_db()
+        self.assertEqual(submission.attempts, 2)
+        self.assertGreaterEqual((submission.next_attempt - before).total_seconds(), 8)
+        self.assertLess((submission.next_attempt - before).total_seconds(), 10)
+
+        self.make_due(submission)
+        self.assertEqual(self.outbox.drain(), 1)
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.DELIVERED)
+        self.assertEqual(submission.last_error, '')
+
+    def test_retries_throttling(self):
+        submission = self.enqueue()
+        self.responses = [response(429)]
+
+        self.outbox.drain()
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.PENDING)
+
+    def test_retries_connection_errors(self):
+        submission = self.enqueue()
+        self.request.side_effect = ConnectionError('Refused')
+
+        self.outbox.drain()
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.PENDING)
+        self.assertIn('ConnectionError', submission.last_error)
+
+    def test_dead_letters_client_errors(self):
+        submission = self.enqueue()
+        self.responses = [response(400)]
+
+        self.outbox.drain()
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.DEAD)
+        self.assertEqual(submission.attempts, 1)
+        self.assertTrue(submission.last_error.startswith('400'))
+
+    def test_dead_letters_after_max_attempts(self):
+        submission = self.enqueue()
+        self.responses = [response(500), response(500), response(500)]
+
+        for _ in range(3):
+            self.make_due(submission)
+            self.outbox.drain()
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.DEAD)
+        self.assertEqual(submission.attempts, 3)
+
+        # Dead submissions are left alone until requeued
+        self.make_due(submission)
+        self.assertEqual(self.outbox.drain(), 0)
+        self.assertEqual(self.request.call_count, 3)
+
+        self.assertEqual(self.outbox.requeue(), 1)
+        self.responses = [response(200)]
+        self.assertEqual(self.outbox.drain(), 1)
+
+    def test_releases_expired_leases(self):
+        submission = self.enqueue()
+        Submission.objects.filter(id=submission.id).update(
+            status=Submission.DELIVERING, leased_until=timezone.now() - timedelta(seconds=1)
+        )
+        self.responses = [response(200)]
+
+        self.assertEqual(self.outbox.drain(), 1)
+
+    def test_batches_single_entry_questionnaires(self):
+        delivered, failed = self.enqueue('questionnaire', 1), self.enqueue('questionnaire', 1)
+        self.responses = [response(200, {'entry': [
+            {'response': {'status': '201 Created'}},
+            {'response': {'status': '400 Bad Request'}},
+        ]})]
+
+        self.assertEqual(self.outbox.drain(), 1)
+
+        # Each entry's result is recorded on its own submission
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.request.call_args.kwargs['json']['type'], 'batch')
+        delivered.refresh_from_db()
+        failed.refresh_from_db()
+        self.assertEqual(delivered.status, Submission.DELIVERED)
+        self.assertEqual(failed.status, Submission.DEAD)
+
+    def test_retries_failed_batches(self):
+        submissions = [self.enqueue('questionnaire', 1), self.enqueue('questionnaire', 1)]
+        self.responses = [response(200, {'entry': [{'response': {'status': '201 Created'}}]})]
+
+        # A short batch response is not trusted for either
+        self.assertEqual(self.outbox.drain(), 0)
+        for submission in submissions:
+            submission.refresh_from_db()
+            self.assertEqual(submission.status, Submission.PENDING)
+            self.assertEqual(submission.attempts, 1)
+
+    @override_settings(OUTBOX_GROUP_SIZE=2)
+    def test_limits_batch_size(self):
+        for _ in range(3):
+            self.enqueue('questionnaire', 1)
+        self.responses = [
+            response(200, {'entry': [{'response': {'status': '201 Created'}}] * 2}),
+            response(201),
+        ]
+
+        # The leftover is sent as it was queued
+        self.assertEqual(self.outbox.drain(), 3)
+        self.assertEqual([call.kwargs['json']['type'] for call in self.request.call_args_list],
+                         ['batch', 'transaction'])
+
+    def test_sends_transactions_on_their_own(self):
+        self.enqueue('consent', 1)
+        self.enqueue('questionnaire', 2)
+        self.responses = [response(201), response(201)]
+
+        # Neither can share a batch, a consent because of its kind and the other because of its size
+        self.assertEqual(self.outbox.drain(), 2)
+        self.assertEqual([call.kwargs['json']['type'] for call in self.request.call_args_list],
+                         ['transaction', 'transaction'])
+
+    def test_leases_each_submission_as_it_is_sent(self):
+        first, second = self.enqueue(), self.enqueue()
+
+        def post(*args, **kwargs):
+            self.assertEqual(Submission.objects.get(id=second.id).status, Submission.PENDING)
+            self.request.side_effect = lambda *args, **kwargs: response(200)
+            return response(200)
+
+        self.request.side_effect = post
+        self.assertEqual(self.outbox.drain(), 2)
+
+    def test_ignores_outcomes_after_losing_the_lease(self):
+        submission = self.enqueue()
+
+        # Another writer takes it over while this one is still sending it
+        def post(*args, **kwargs):
+            Submission.objects.filter(id=submission.id).update(leased_until=timezone.now() + timedelta(hours=1))
+            return response(500)
+
+        self.request.side_effect = post
+        self.assertEqual(self.outbox.drain(), 0)
+
+        submission.refresh_from_db()
+        self.assertEqual(submission.status, Submission.DELIVERING)
+        self.assertEqual(submission.attempts, 0)
+
+    def test_makes_creates_conditional(self):
+        submission = self.outbox.enqueue({'resourceType': 'Bundle', 'type': 'transaction', 'entry': [
+            {'resource': {'resourceType': 'QuestionnaireResponse'}, 'request': {'method': 'POST'}},
+            {'resource': {'resourceType': 'Consent', 'identifier': [{'value': 'x'}]}, 'request': {'method': 'POST'}},
+            {'resource': {'resourceType': 'Patient', 'id': '1'}, 'request': {'method': 'PUT'}},
+        ]}, 'consent')
+
+        response_entry, consent_entry, patient_entry = submission.bundle['entry']
+        identifier = response_entry['resource']['identifier']
+        self.assertEqual(identifier['system'], Outbox.IDENTIFIER_SYSTEM)
+        self.assertEqual(response_entry['request']['ifNoneExist'],
+                         f'identifier={Outbox.IDENTIFIER_SYSTEM}|{identifier["value"]}')
+        self.assertEqual(len(consent_entry['resource']['identifier']), 2)
+        self.assertNotEqual(consent_entry['request']['ifNoneExist'], response_entry['request']['ifNoneExist'])
+
+        # Updates are already idempotent
+        self.assertNotIn('ifNoneExist', patient_entry['request'])
+
+
+@override_settings(RENDER_WORKERS=1, RENDER_JOB_WORKERS=1, RENDER_QUEUE_SIZE=2)
+class RenderExecutorTests(SimpleTestCase):
+
+    def setUp(self):
+        self.executor = RenderExecutor()
+        self.order = []
+
+    def block(self):
+        """
+        Occupies the executor's only thread until the returned event is set.
+        """
+        started, release = threading.Event(), threading.Event()
+
+        def render():
+            started.set()
+            release.wait(5)
+
+        future = self.executor.submit(render)
+        self.assertTrue(started.wait(5))
+        self.addCleanup(release.set)
+
+        return release, future
+
+    def render(self, name):
+        return lambda: self.order.append(name)
+
+    def test_runs_by_priority(self):
+        release, blocker = self.block()
+
+        futures = [
+            self.executor.submit(self.render('bulk'), priority=RenderExecutor.BULK),
+            self.executor.submit(self.render('background'), priority=RenderExecutor.BACKGROUND),
+            self.executor.submit(self.render('interactive'), priority=RenderExecutor.INTERACTIVE),
+        ]
+        release.set()
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.order, ['interactive', 'background', 'bulk'])
+
+    @override_settings(RENDER_QUEUE_SIZE=3)
+    def test_studies_take_turns(self):
+        release, blocker = self.block()
+
+        futures = [
+            self.executor.submit(self.render(name), study=name[0], priority=RenderExecutor.BULK)
+            for name in ('a1', 'a2', 'b1')
+        ]
+        release.set()
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.order, ['a1', 'b1', 'a2'])
+
+    def test_overflows_when_full(self):
+        release, blocker = self.block()
+        overflow = mock.Mock()
+
+        futures = [self.executor.submit(self.render(index), overflow=overflow) for index in range(2)]
+        self.assertIsNone(self.executor.submit(self.render('overflowed'), overflow=overflow))
+        overflow.assert_called_once_with()
+
+        release.set()
+        for future in futures:
+            future.result(5)
+
+        self.assertEqual(self.order, [0, 1])
+        self.assertEqual(self.executor.stats()['background']['overflowed'], 1)
+
+    def test_blocks_when_full_without_overflow(self):
+        release, blocker = self.block()
+        for index in range(2):
+            self.executor.submit(self.render(index))
+
+        # The next waits for room rather than being dropped
+        submitted = threading.Event()
+        threading.Thread(target=lambda: (self.executor.submit(self.render('late')), submitted.set()),
+                         daemon=True).start()
+        self.assertFalse(submitted.wait(0.2))
+
+        release.set()
+        self.assertTrue(submitted.wait(5))
+
+    def test_tracks_queue_depth_and_timings(self):
+        release, blocker = self.block()
+        future = self.executor.submit(lambda: time.sleep(0.05))
+        self.assertEqual(self.executor.stats()['background']['depth'], 1)
+
+        release.set()
+        future.result(5)
+        blocker.result(5)
+
+        stats = self.executor.stats()['background']
+        self.assertEqual((stats['queued'], stats['rendered'], stats['depth'], stats['running']), (2, 2, 0, 0))
+        self.assertGreater(stats['wait_max_ms'], 0)
+        self.assertGreaterEqual(stats['render_max_ms'], 50)
+
+    def test_interactive_renders_are_always_queued(self):
+        release, blocker = self.block()
+        overflow = mock.Mock()
+        for index in range(2):
+            self.executor.submit(self.render(index))
+
+        # The queue is full, but a participant is waiting on this one
+        future = self.executor.submit(self.render('interactive'), priority=RenderExecutor.INTERACTIVE,
+                                      overflow=overflow)
+        release.set()
+        future.result(5)
+
+        overflow.assert_not_called()
+        self.assertEqual(self.order[0], 'interactive')
+
+    @override_settings(RENDER_WORKERS=2)
+    def test_bulk_leaves_threads_free(self):
+        started, release = threading.Event(), threading.Event()
+
+        def bulk():
+            self.order.append('bulk')
+            started.set()
+            release.wait(5)
+
+        self.addCleanup(release.set)
+        bulks = [self.executor.submit(bulk, priority=RenderExecutor.BULK) for _ in range(2)]
+        self.assertTrue(started.wait(5))
+
+        # Only one bulk render runs, the other thread takes the background render
+        background = self.executor.submit(self.render('background'))
+        background.result(5)
+        self.assertEqual(self.order, ['bulk', 'background'])
+
+        release.set()
+        for future in bulks:
+            future.result(5)
+
+    def test_interactive_failures_are_raised(self):
+        def render():
+            raise ValueError('Failed')
+
+        with self.assertRaises(ValueError):
+            self.executor.run(render)
+
+        self.assertEqual(self.executor.stats()['interactive']['failed'], 1)
+
+
+
+class RenderLocksTests(SimpleTestCase):
+
+    def setUp(self):
+        self.locks = RenderLocks()
+        self.started, self.release = threading.Event(), threading.Event()
+        self.addCleanup(self.release.set)
+        self.running, self.most = 0, 0
+        self.calls = []
+
+    def render(self, name):
+        self.running += 1
+        self.most = max(self.most, self.running)
+        self.calls.append(name)
+        self.started.set()
+        self.release.wait(5)
+        self.running -= 1
+        return name
+
+    def in_background(self, name, kind=None):
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.locks.do('neer', '1', self.render, name,
+                                                                                kind=kind)), daemon=True)
+        thread.start()
+        return thread, results
+
+    def test_shares_renders_in_flight(self):
+        first, first_results = self.in_background('first')
+        self.assertTrue(self.started.wait(5))
+        second, second_results = self.in_background('second')
+        second.join(0.1)
+
+        self.release.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual(self.calls, ['first'])
+        self.assertEqual(first_results + second_results, ['first', 'first'])
+        self.assertEqual(self.locks._locks, {})
+
+    def test_takes_turns_between_kinds(self):
+        first, first_results = self.in_background('first', kind='render')
+        self.assertTrue(self.started.wait(5))
+        second, second_results = self.in_background('second', kind='download')
+
+        # The second waits on the lock rather than sharing the first's result
+        second.join(0.1)
+        self.assertEqual(self.calls, ['first'])
+
+        self.release.set()
+        first.join(5)
+        second.join(5)
+
+        self.assertEqual((self.calls, self.most), (['first', 'second'], 1))
+        self.assertEqual(second_results, ['second'])
+
+    def test_locks_across_processes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        with override_settings(RENDER_LOCK_DIR=directory.name), self.locks.lock('neer', '../1'):
+
+            # Another process opening the lock file could not take it
+            with open(os.path.join(directory.name, 'neer-.._1.lock')) as file, self.assertRaises(BlockingIOError):
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with open(os.path.join(directory.name, 'neer-.._1.lock')) as file:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def inline(fn, *args, **kwargs):
+    """
+    Runs a render in place of the render executor.
+    """
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+@override_settings(P2MD_AUTH_TOKEN='service-token')
+class RenderJobsTests(TestCase):
+
+    def setUp(self):
+        self.jobs = RenderJobs()
+
+        # Run jobs in the test's thread and transaction
+        self.patch('api.jobs.RenderJobs._start', side_effect=self.jobs._run)
+        self.patch('api.jobs.RenderJobs.POLL_INTERVAL', 0.01)
+        self.patch('api.jobs.close_old_connections')
+        self.patch('api.jobs.renders.submit', side_effect=inline)
+        self.patch('api.jobs.snapshots.document_references', return_value={})
+        self.patch('api.jobs.P2MD.get_consent_url', return_value='https://p2md/consent')
+        self.render = self.patch('api.views.ConsentView.render_consent_document_reference', return_value=True)
+
+    def patch(self, target, new=mock.DEFAULT, **kwargs):
+        patcher = mock.patch(target, new, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def running_job(self, *tasks):
+        job = RenderJob.objects.create(study='neer', status=RenderJob.RUNNING, started=timezone.now())
+        for ppm_id, status, leased_until in tasks:
+            RenderTask.objects.create(job=job, ppm_id=ppm_id, status=status, leased_until=leased_until)
+
+        return job
+
+    def test_takes_over_tasks_once_their_lease_runs_out(self):
+
+        # A restarted process finds a task its previous self was rendering, still leased
+        job = self.running_job(
+            ('1', RenderTask.PENDING, None),
+            ('2', RenderTask.RUNNING, timezone.now() + timedelta(seconds=0.2)),
+        )
+
+        self.jobs.resume()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.DONE)
+        self.assertEqual(list(job.tasks.values_list('status', flat=True)), [RenderTask.RENDERED] * 2)
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_leaves_tasks_finished_by_other_runners(self):
+        job = self.running_job(('1', RenderTask.RUNNING, timezone.now() + timedelta(minutes=10)))
+
+        # The other runner finishes it while this one waits
+        def finish(seconds):
+            job.tasks.update(status=RenderTask.RENDERED, leased_until=None)
+
+        with mock.patch('api.jobs.time.sleep', side_effect=finish):
+            self.jobs.resume()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.DONE)
+        self.render.assert_not_called()
+
+    def test_records_failed_renders(self):
+        job = self.running_job(('1', RenderTask.PENDING, None))
+        self.render.side_effect = SystemError('P2MD is down')
+
+        self.jobs.resume()
+
+        task = job.tasks.get()
+        self.assertEqual(task.status, RenderTask.FAILED)
+        self.assertIn('P2MD is down', task.error)
+
+    def test_resumes_jobs_with_the_service_token(self):
+        job = self.running_job(('1', RenderTask.PENDING, None))
+
+        # The request that started it was lost with the process
+        self.jobs.resume()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.DONE)
+        self.assertIsNone(self.render.call_args.args[0])
+        self.assertEqual(P2MD.headers(None)['Authorization'].split()[-1], 'service-token')
+
+    @override_settings(P2MD_AUTH_TOKEN=None)
+    def test_fails_resumed_jobs_without_the_service_token(self):
+        job = self.running_job(('1', RenderTask.PENDING, None))
+
+        self.jobs.resume()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.FAILED)
+        self.assertIn('P2MD_AUTH_TOKEN', job.error)
+        self.render.assert_not_called()
+        with self.assertRaises(SystemError):
+            P2MD.headers(None)
+
+    def test_submitted_jobs_use_the_request(self):
+        request = mock.Mock()
+        participants = mock.Mock(iterator=lambda: [mock.Mock(ppm_id='1', enrollment='accepted')])
+        self.patch('api.jobs.snapshots.participants', return_value=participants)
+
+        job = self.jobs.submit(request, 'neer')
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RenderJob.DONE)
+        self.assertIs(self.render.call_args.args[0], request)
+        self.assertNotIn(job.id, self.jobs._requests)
+
+
+def searched(resources, next_url=None):
+    """
+    Builds a stand-in for a page of FHIR search results.
+    """
+    bundle = {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [{'resource': r} for r in resources]}
+    if next_url:
+        bundle['link'] = [{'relation': 'next', 'url': next_url}]
+
+    return mock.Mock(json=mock.Mock(return_value=bundle))
+
+
+def consent_reference(document_reference_id, ppm_id):
+    return {
+        'resourceType': 'DocumentReference', 'id': document_reference_id, 'date': '2026-01-02T03:04:05Z',
+        'subject': {'reference': f'Patient/{ppm_id}'},
+        'content': [{'attachment': {'url': f'https://p2md/{document_reference_id}.pdf'}}],
+    }
+
+
+class ParticipantsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.pages = []
+        patcher = mock.patch('api.participants.FHIR.get', side_effect=lambda url: self.pages.pop(0))
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def searched_for(self, index=0):
+        return furl(self.get.call_args_list[index].args[0])
+
+    def test_finds_consents_in_one_search(self):
+        self.pages = [searched([consent_reference('a', '1'), consent_reference('b', '2')])]
+
+        document_references = Participants.consent_document_references('neer')
+
+        self.assertEqual({ppm_id: d['id'] for ppm_id, d in document_references.items()}, {'1': 'a', '2': 'b'})
+        self.assertEqual(document_references['1']['url'], 'https://p2md/a.pdf')
+        self.get.assert_called_once()
+        self.assertEqual(self.searched_for().path.segments[-1], 'DocumentReference')
+        self.assertTrue(self.searched_for().args['related'].startswith('ResearchStudy/'))
+
+    def test_follows_pages(self):
+        self.pages = [
+            searched([consent_reference('a', '1')], next_url='https://internal.example.com/fhir?_page=2'),
+            searched([consent_reference('b', '2')]),
+        ]
+
+        self.assertEqual(sorted(Participants.consent_document_references('neer')), ['1', '2'])
+
+        # Pages are fetched from the configured host
+        self.assertEqual(self.searched_for(1).host, furl(PPM.fhir_url()).host)
+
+    def test_keeps_the_first_consent_of_each_participant(self):
+        self.pages = [searched([consent_reference('a', '1'), consent_reference('b', '1')])]
+
+        self.assertEqual(Participants.consent_document_references('neer')['1']['id'], 'a')
+
+
+    def enrollment(self, ppm_id, email=None, enrollment='consented'):
+        return [
+            {'resourceType': 'Flag', 'id': f'flag-{ppm_id}', 'subject': {'reference': f'Patient/{ppm_id}'},
+             'code': {'coding': [{'system': PPMFHIR.enrollment_flag_coding_system, 'code': enrollment}]}},
+            {'resourceType': 'Patient', 'id': ppm_id, 'identifier': [
+                {'system': PPMFHIR.patient_email_identifier_system, 'value': email or f'{ppm_id}@example.com'},
+            ]},
+        ]
+
+    def test_searches_enrollments_with_their_patients(self):
+        self.pages = [searched(self.enrollment('1') + self.enrollment('2', enrollment='accepted'))]
+
+        participants = list(Participants.iterate('neer', enrollments=['consented', 'accepted']))
+
+        self.assertEqual([(p['ppm_id'], p['email'], p['enrollment']) for p in participants],
+                         [('1', '1@example.com', 'consented'), ('2', '2@example.com', 'accepted')])
+
+        # The enrollments are filtered by FHIR
+        query = self.searched_for().args
+        self.assertEqual(query['_include'], 'Flag:subject')
+        self.assertEqual(query['code'], f'{PPMFHIR.enrollment_flag_coding_system}|consented,'
+                                        f'{PPMFHIR.enrollment_flag_coding_system}|accepted')
+
+    def test_fetches_pages_as_they_are_consumed(self):
+        self.pages = [
+            searched(self.enrollment('1'), next_url='http://fhir/Flag?_page=2'),
+            searched(self.enrollment('2')),
+        ]
+
+        participants = Participants.iterate('neer')
+        self.assertEqual(next(participants)['ppm_id'], '1')
+        self.get.assert_called_once()
+
+        self.assertEqual([p['ppm_id'] for p in participants], ['2'])
+        self.assertEqual(self.get.call_count, 2)
+
+    @override_settings(TEST_EMAIL_PATTERNS=[r'.*@test\.example\.com$'])
+    def test_skips_testers(self):
+        resources = self.enrollment('1') + self.enrollment('2', email='2@test.example.com')
+        self.pages = [searched(resources), searched(resources)]
+
+        self.assertEqual([p['ppm_id'] for p in Participants.iterate('neer')], ['1'])
+        self.assertEqual([p['ppm_id'] for p in Participants.iterate('neer', testing=True)], ['1', '2'])
+
+    @mock.patch('api.participants.Participants.CHUNK_SIZE', 2)
+    def test_searches_for_participants_in_chunks(self):
+        self.pages = [searched(self.enrollment('1') + self.enrollment('2')), searched(self.enrollment('3'))]
+
+        participants = list(Participants.iterate('neer', ppm_ids=['3', '1', '2', '1']))
+
+        self.assertEqual([p['ppm_id'] for p in participants], ['1', '2', '3'])
+        self.assertEqual([self.searched_for(index).args['subject'] for index in range(2)],
+                         ['Patient/1,Patient/2', 'Patient/3'])
+
+
+class ConsentsViewTests(SimpleTestCase):
+
+    def test_filters_by_the_ppm_ids_asked_for(self):
+        request = APIRequestFactory().get('/api/consent/neer', {'ppm_ids': '1,2'})
+        force_authenticate(request, user='admin@example.com')
+
+        with mock.patch('api.views.ConsentsView.check_permissions'), \
+                mock.patch('api.views.snapshots.participants', return_value=[
+                    ParticipantSnapshot(study='neer', ppm_id='1', enrollment='consented'),
+                ]) as participants:
+            response = ConsentsView.as_view()(request, study='neer')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([consent['ppm_id'] for consent in response.data], ['1'])
+        self.assertEqual(participants.call_args.kwargs['ppm_ids'], ['1', '2'])
+        self.assertEqual(participants.call_args.kwargs['enrollments'], Participants.CONSENTED)
+
+def participant(ppm_id, enrollment='consented'):
+    return {'ppm_id': ppm_id, 'fhir_id': ppm_id, 'email': f'{ppm_id}@example.com', 'enrollment': enrollment}
+
+
+class ParticipantSnapshotsTests(TestCase):
+
+    def setUp(self):
+        self.snapshots = ParticipantSnapshots()
+
+        # Answer searches with the participants and renders a test sets
+        self.flags, self.renders = [], {}
+        self.pages = self.patch('api.snapshots.Participants.pages', side_effect=lambda *args, **kwargs: [self.flags])
+        self.search = self.patch('api.snapshots.Participants.iterate', side_effect=lambda *args, **kwargs: self.flags)
+        self.patch('api.snapshots.Participants.consent_document_references',
+                   side_effect=lambda *args, **kwargs: self.renders)
+
+    def patch(self, target, new=mock.DEFAULT, **kwargs):
+        patcher = mock.patch(target, new, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def listing(self, **kwargs):
+        participants = self.snapshots.participants('neer', **kwargs)
+        return {p.ppm_id: (p.enrollment, p.document_reference_id) for p in participants}
+
+    def test_builds_from_a_full_scan(self):
+        self.flags, self.renders = [participant('1'), participant('2')], {'1': {'id': 'render-1'}}
+
+        self.assertEqual(self.listing(), {'1': ('consented', 'render-1'), '2': ('consented', '')})
+        self.assertIsNone(self.pages.call_args.kwargs['since'])
+
+    def test_syncs_only_what_changed(self):
+        self.flags = [participant('1'), participant('2')]
+        self.listing()
+        synced = StudySnapshot.objects.get(study='neer').synced
+
+        # Only the updated enrollments and renders are searched for
+        self.flags, self.renders = [participant('2', 'terminated')], {'1': {'id': 'render-1'}}
+        self.assertEqual(self.listing(), {'1': ('consented', 'render-1'), '2': ('terminated', '')})
+        self.assertEqual(self.pages.call_args.kwargs['since'], synced - ParticipantSnapshots.OVERLAP)
+
+    @override_settings(PARTICIPANT_SNAPSHOT_MAX_AGE=0)
+    def test_rebuilds_once_too_old(self):
+        self.flags = [participant('1'), participant('2')]
+        self.listing()
+
+        # Whoever the scan no longer finds is dropped
+        self.flags = [participant('2')]
+        self.assertEqual(self.listing(), {'2': ('consented', '')})
+        self.assertIsNone(self.pages.call_args.kwargs['since'])
+
+    def test_fetches_participants_asked_for_without_a_scan(self):
+        ParticipantSnapshot.objects.create(study='neer', ppm_id='3', enrollment='consented')
+        self.flags, self.renders = [participant('1')], {'1': {'id': 'render-1'}}
+
+        # The IDs and enrollments are searched for, rather than the whole study
+        listing = self.listing(ppm_ids=['1', '3'], enrollments=['consented'])
+        self.assertEqual(listing, {'1': ('consented', 'render-1')})
+        self.pages.assert_not_called()
+        self.search.assert_called_once_with('neer', ppm_ids=['1', '3'], enrollments=['consented'])
+
+        # They are kept for the rebuild that is still due
+        self.assertTrue(ParticipantSnapshot.objects.filter(study='neer', ppm_id='1').exists())
+        self.assertFalse(StudySnapshot.objects.filter(study='neer', scanned__isnull=False).exists())
+
+    def test_filters_fresh_snapshots_locally(self):
+        self.flags = [participant('1'), participant('2', 'terminated'), participant('3')]
+        self.listing()
+
+        self.flags = []
+        self.assertEqual(self.listing(ppm_ids=['1', '2'], enrollments=['consented']), {'1': ('consented', '')})
+        self.search.assert_not_called()
+
+
+    def test_streams_listings(self):
+        request = APIRequestFactory().get('/api/consent/neer', {'stream': 'jsonl'})
+        force_authenticate(request, user='admin@example.com')
+
+        participants = mock.Mock(iterator=lambda chunk_size: iter([
+            ParticipantSnapshot(study='neer', ppm_id='1', enrollment='consented'),
+        ]))
+        with mock.patch('api.views.ConsentsView.check_permissions'), \
+                mock.patch('api.views.snapshots.participants', return_value=participants):
+            response = ConsentsView.as_view()(request, study='neer')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row['ppm_id'] for row in rows], ['1'])
+
+@mock.patch('api.views.Participants.CHUNK_SIZE', 2)
+class StreamConsentsTests(SimpleTestCase):
+
+    def stream(self, count, fail=False, lines=True):
+
+        def iterator(chunk_size):
+            for ppm_id in range(count):
+                yield ParticipantSnapshot(study='neer', ppm_id=str(ppm_id), enrollment='consented')
+            if fail:
+                raise SystemError('Database went away')
+
+        participants = mock.Mock(iterator=iterator)
+        return ''.join(ConsentsView.stream_consents('neer', participants, lines=lines))
+
+    def test_streams_json_lines(self):
+        rows = [json.loads(line) for line in self.stream(3).splitlines()]
+        self.assertEqual([row['ppm_id'] for row in rows], ['0', '1', '2'])
+
+    def test_streams_a_json_array(self):
+        self.assertEqual([row['ppm_id'] for row in json.loads(self.stream(3, lines=False))], ['0', '1', '2'])
+        self.assertEqual(json.loads(self.stream(0, lines=False)), [])
+
+    def test_json_lines_end_with_an_error_on_failure(self):
+        rows = [json.loads(line) for line in self.stream(3, fail=True).splitlines()]
+        self.assertEqual([row.get('ppm_id') for row in rows], ['0', '1', None])
+        self.assertIn('error', rows[-1])
+
+    def test_json_arrays_are_closed_with_an_error_on_failure(self):
+        rows = json.loads(self.stream(3, fail=True, lines=False))
+        self.assertEqual([row.get('ppm_id') for row in rows], ['0', '1', None])
+        self.assertIn('error', rows[-1])
+
+        # Even when nothing was sent yet
+        self.assertEqual(list(json.loads(self.stream(1, fail=True, lines=False))[0]), ['error'])
+
+
+class PPMAdminOrOwnerPermissionTests(SimpleTestCase):
+
+    def setUp(self):
+        self.permission = PPMAdminOrOwnerPermission()
+        self.request = mock.Mock(user='participant@example.com')
+        patcher = mock.patch('fhirquestionnaire.ppmauth.is_admin', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_allows_owners(self):
+        with mock.patch('fhirquestionnaire.ppmauth.patients.get_id', return_value='1'):
+            self.assertTrue(self.permission.has_object_permission(self.request, None, '1'))
+            with self.assertRaises(PermissionDenied):
+                self.permission.has_object_permission(self.request, None, '2')
+
+    def test_denies_when_the_lookup_fails(self):
+
+        # A FHIR hiccup denies the request rather than erroring
+        lookup = mock.patch('fhirquestionnaire.ppmauth.patients.get_id', side_effect=SystemError('Lookup failed'))
+        with lookup, self.assertRaises(PermissionDenied):
+            self.permission.has_object_permission(self.request, None, '1')
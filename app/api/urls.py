@@ -11,6 +11,8 @@ app_name = ApiConfig.name
 urlpatterns = [
     re_path(r'^consent/(?P<study>[\w\d-]+)/(?P<ppm_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[\d]+)/?$', views.ConsentView.as_view(), name='consent'),
     re_path(r'^consent/(?P<study>[\w\d-]+)/?$', views.ConsentsView.as_view(), name='consents'),
+    re_path(r'^consent/(?P<study>[\w\d-]+)/jobs/(?P<job_id>[\d]+)/?$', views.ConsentJobView.as_view(), name='consent-job'),
+    re_path(r'^renders/metrics/?$', views.RenderMetricsView.as_view(), name='render-metrics'),
     re_path(r'^questionnaire/?$', views.QuestionnaireView.as_view(), name='questionnaire'),
     re_path(r'^questionnaire/(?P<questionnaire_id>[\w\d-]+)/?$', views.QuestionnaireView.as_view(), name='questionnaire'),
 ]
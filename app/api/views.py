@@ -1,13 +1,14 @@
-from datetime import datetime
-from django.http.response import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseServerError
+from django.http.response import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseServerError, \
+    StreamingHttpResponse
 from django.template.exceptions import TemplateDoesNotExist
 from fhirclient.models.fhirabstractbase import FHIRValidationError
-import requests
-import hashlib
+import base64
 import json
 import re
 from dateutil.parser import parse
+from django.conf import settings
 from django.template import loader
+from django.urls import reverse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
@@ -19,12 +20,19 @@ from furl import furl
 
 from dbmi_client.authz import DBMIAdminPermission
 from fhirquestionnaire.ppmauth import PPMAdminOrOwnerPermission
+from fhirquestionnaire.cache import patients, questionnaires
+from fhirquestionnaire.http import sessions, MultipartStream, P2MD
 from ppmutils.fhir import FHIR
-from ppmutils.p2md import P2MD
 from ppmutils.ppm import PPM
 from dbmi_client.authn import get_jwt_email
 
-from pdf.renderers import render_pdf
+from api.jobs import jobs
+from api.models import RenderJob
+from api.participants import Participants
+from api.renders import renders, locks
+from api.snapshots import snapshots
+from pdf.metrics import metrics
+from pdf.renderers import render_pdf_content
 
 import logging
 logger = logging.getLogger(__name__)
@@ -55,8 +63,8 @@ class ConsentView(APIView):
             # Check FHIR
             if not FHIR.get_consent_document_reference(patient=ppm_id, study=study, flatten_return=True):
 
-                # Save it
-                ConsentView.create_consent_document_reference(request=request, study=study, ppm_id=ppm_id)
+                # Save it, ahead of background and bulk renders
+                renders.run(ConsentView.render_consent_document_reference, request, study, ppm_id, study=study)
 
             return Response(P2MD.get_consent_url(study=study, ppm_id=ppm_id))
 
@@ -94,19 +102,13 @@ class ConsentView(APIView):
             # Check FHIR
             if not document_reference or overwrite:
 
-                # Remove currently PDF
-                if document_reference and overwrite:
-                    logger.debug(f'PPM/{study}/Patient/{ppm_id} has rendered PDF but will overwrite with a new'
-                                 f' render: DocumentReference/{document_reference["id"]}')
-                    if not ConsentView.delete_consent_document_reference(request, ppm_id=ppm_id, study=study,
-                                                                         document_reference=document_reference):
-                        logger.error(f'PPM/{study}/Patient/{ppm_id}: Could not fully remove consent render: '
-                                     f'DocumentReference/{document_reference["id"]}')
+                # Save it, replacing the current PDF, ahead of background and bulk renders
+                rendered = renders.run(ConsentView.render_consent_document_reference, request, study, ppm_id,
+                                       overwrite, study=study)
 
-                # Save it
-                ConsentView.create_consent_document_reference(request=request, study=study, ppm_id=ppm_id)
-
-                return Response(P2MD.get_consent_url(study=study, ppm_id=ppm_id), status=status.HTTP_201_CREATED)
+                # Someone else may have just rendered it
+                return Response(P2MD.get_consent_url(study=study, ppm_id=ppm_id),
+                                status=status.HTTP_201_CREATED if rendered else status.HTTP_200_OK)
 
             else:
                 logger.debug(f'PPM/{study}/Patient/{ppm_id} already has consent PDF:'
@@ -149,6 +151,7 @@ class ConsentView(APIView):
                 # Delete the DocumentReference
                 if P2MD.delete_consent(request, study=study, ppm_id=ppm_id,
                                        document_reference_id=document_reference['id']):
+                    snapshots.forget_render(study, ppm_id)
                     return True
 
             # Must have failed
@@ -161,6 +164,52 @@ class ConsentView(APIView):
             })
         return False
 
+    @staticmethod
+    def render_consent_document_reference(request, study, ppm_id=None, overwrite=False):
+        """
+        Renders the participant's consent unless it has been rendered already, or replaces the current
+        render if overwriting. Renders of a participant's consent take turns, each checking for the
+        render once it is their turn, and concurrent callers making the same render share it, so the
+        consent is rendered and stored once however many callers ask for it. This must be run on the
+        render threads.
+        :param request: The current request
+        :type request: HttpRequest
+        :param study: The study for which the consent was signed
+        :type study: str
+        :param ppm_id: The participant ID for which the consent render is being generated
+        :type ppm_id: str
+        :param overwrite: Whether to replace the current render, if any
+        :type overwrite: bool
+        :return: Whether the consent was rendered
+        :rtype: bool
+        """
+        # Get the participant ID if needed
+        if not ppm_id:
+            ppm_id = patients.get_id(get_jwt_email(request=request, verify=False))
+
+        return locks.do(PPM.Study.get(study).value, ppm_id, ConsentView._render_consent_document_reference,
+                        request, study, ppm_id, bool(overwrite), kind=bool(overwrite))
+
+    @staticmethod
+    def _render_consent_document_reference(request, study, ppm_id, overwrite):
+
+        # Check FHIR, now that no one else is rendering it
+        document_reference = FHIR.get_consent_document_reference(patient=ppm_id, study=study, flatten_return=True)
+        if document_reference and not overwrite:
+            logger.debug(f'PPM/{study}/Patient/{ppm_id} already has consent PDF:'
+                         f' DocumentReference/{document_reference["id"]}')
+            return False
+
+        # Remove the current PDF, rather than leave two
+        if document_reference:
+            logger.debug(f'PPM/{study}/Patient/{ppm_id} has rendered PDF but will overwrite with a new'
+                         f' render: DocumentReference/{document_reference["id"]}')
+            if not ConsentView.delete_consent_document_reference(request, ppm_id=ppm_id, study=study,
+                                                                 document_reference=document_reference):
+                raise SystemError(f'Could not remove the current render: DocumentReference/{document_reference["id"]}')
+
+        return ConsentView.create_consent_document_reference(request, study, ppm_id)
+
     @staticmethod
     def create_consent_document_reference(request, study, ppm_id=None):
         """
@@ -176,14 +225,11 @@ class ConsentView(APIView):
         """
         # Get the participant ID if needed
         if not ppm_id:
-            ppm_id = FHIR.query_patient_id(get_jwt_email(request=request, verify=False))
+            ppm_id = patients.get_id(get_jwt_email(request=request, verify=False))
 
         # Pull their record
         participant = FHIR.get_participant(patient=ppm_id, flatten_return=True)
 
-        # Get study title
-        study_title = PPM.Study.title(study)
-
         # Check for study-specific PDF
         try:
             template_name = f"consent/pdf/{PPM.Study.get(study).value}.html"
@@ -191,14 +237,10 @@ class ConsentView(APIView):
         except TemplateDoesNotExist:
             template_name = 'consent/pdf/consent.html'
 
-        # Submit consent PDF
+        # Render the consent PDF, or reuse an identical earlier render and its hash
         logger.debug(f"PPM/{study}: Rendering consent with template: {template_name}")
-        response = render_pdf(f'People-Powered Medicine {study_title} Consent', request, template_name,
-                              context=participant.get('composition'), options={})
-
-        # Hash the content
-        hash = hashlib.md5(response.content).hexdigest()
-        size = len(response.content)
+        content, hash = render_pdf_content(request, template_name, context=participant.get('composition'), options={})
+        size = len(content)
 
         # Create the file through P2MD
         uuid, upload_data = P2MD.create_consent_file(request, study, ppm_id, hash, size)
@@ -207,13 +249,21 @@ class ConsentView(APIView):
         location = upload_data['locationid']
         post = upload_data['post']
 
-        # Set the files dictionary
-        files = {'file': response.content}
+        # Have S3 check the upload against our hash, if its policy allows it
+        fields = dict(post['fields'])
+        if settings.CONSENT_UPLOAD_CONTENT_MD5:
+            fields['Content-MD5'] = base64.b64encode(bytes.fromhex(hash)).decode('ascii')
 
-        # Now that we have the file locally, send it to S3
-        response = requests.post(post['url'], data=post['fields'], files=files)
+        # Stream the PDF to S3 from the rendered buffer rather than an encoded copy
+        body = MultipartStream(fields, 'file', content)
+        response = sessions.post(post['url'], data=body, headers={'Content-Type': body.content_type})
         response.raise_for_status()
 
+        # Unencrypted and SSE-S3 uploads echo the MD5 back as the ETag
+        etag = response.headers.get('ETag', '').strip('"')
+        if etag and etag != hash:
+            logger.warning(f'PPM/{study}/Patient/{ppm_id}: Consent upload ETag "{etag}" does not match MD5 "{hash}"')
+
         # Set request data
         P2MD.uploaded_consent(request, study, ppm_id, uuid, location)
 
@@ -248,40 +298,23 @@ class ConsentsView(APIView):
 
         try:
             # Get optional parameters
-            ppm_ids = request.GET.get('ppm_ids').split(',') if request.data.get('ppm_ids', False) else None
+            ppm_ids = request.GET.get('ppm_ids').split(',') if request.GET.get('ppm_ids', False) else None
+            stream = request.GET.get('stream')
 
-            # Build response object details consents
-            response = []
-
-            # Get participants for study
-            participants = FHIR.query_participants(studies=[study])
-            for participant in participants:
-
-                # Pull their details
-                ppm_id = participant['ppm_id']
-                logger.debug(f'{study}/Patient/{ppm_id}: Checking consent render')
+            # Get the consented participants asked for from the study's snapshot, brought up to date first
+            participants = snapshots.participants(study, ppm_ids=ppm_ids, enrollments=Participants.CONSENTED)
 
-                # Toss out if not consented
-                if PPM.Enrollment.enum(participant['enrollment']) is PPM.Enrollment.Registered:
-                    continue
+            # Send large listings as they are built
+            if stream in ('jsonl', 'json'):
+                response = StreamingHttpResponse(
+                    ConsentsView.stream_consents(study, participants, lines=stream == 'jsonl'),
+                    content_type='application/x-ndjson' if stream == 'jsonl' else 'application/json',
+                )
+                response['X-Accel-Buffering'] = 'no'
+                return response
 
-                # If filtered, toss out
-                if ppm_ids and ppm_id not in ppm_ids:
-                    logger.debug(f'{study}/Patient/{ppm_id}: Filtered out')
-                    continue
-
-                # Check consent
-                document_reference = FHIR.get_consent_document_reference(patient=ppm_id,
-                                                                         study=study,
-                                                                         flatten_return=True)
-                # Add the URL
-                response.append({
-                    'ppm_id': ppm_id,
-                    'download_url': P2MD.get_consent_url(study=study, ppm_id=ppm_id) if document_reference else None,
-                    'url': document_reference['url'] if document_reference else None,
-                    'enrollment': participant['enrollment'],
-                    'created': document_reference.get('timestamp') if document_reference else None,
-                })
+            # Build response object details consents
+            response = [ConsentsView.consent(study, participant) for participant in participants]
 
             return Response(response)
 
@@ -294,6 +327,82 @@ class ConsentsView(APIView):
         return Response('An unexpected error occurred, please contact support',
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @staticmethod
+    def stream_consents(study, participants, lines=True):
+        """
+        Yields the consent listing of the participants a chunk of rows at a
+        time, reading them from the database as it goes, so the first rows
+        are sent right away and memory use does not grow with the study.
+        Rows are sent as JSON Lines or as the items of a JSON array. Should
+        the listing fail part way, either ends with an error row.
+        :param study: The study to list consents for
+        :type study: str
+        :param participants: The participants' snapshots
+        :type participants: QuerySet
+        :param lines: Whether to send JSON Lines rather than a JSON array
+        :type lines: bool
+        :return: The chunks of the listing
+        :rtype: generator
+        """
+        separator = '\n' if lines else ','
+        count = 0
+        rows = []
+
+        def chunk():
+            return ('' if lines or not count else ',') + separator.join(rows) + ('\n' if lines else '')
+
+        try:
+            if not lines:
+                yield '['
+
+            for participant in participants.iterator(chunk_size=Participants.CHUNK_SIZE):
+                rows.append(json.dumps(ConsentsView.consent(study, participant)))
+                if len(rows) == Participants.CHUNK_SIZE:
+                    yield chunk()
+                    count += len(rows)
+                    rows = []
+
+            if rows:
+                yield chunk()
+                count += len(rows)
+
+            if not lines:
+                yield ']'
+
+            logger.debug(f'PPM/{study}: Streamed {count} consent(s)')
+
+        except Exception as e:
+            logger.exception("Error while streaming consents: {}".format(e), exc_info=True, extra={
+                'project': study,
+            })
+
+            # End with an error row, closing the array so it still parses
+            error = json.dumps({'error': 'An unexpected error occurred, please contact support'})
+            if lines:
+                yield error + '\n'
+            else:
+                yield (',' if count else '') + error + ']'
+
+    @staticmethod
+    def consent(study, participant):
+        """
+        Returns the listing of a participant's consent render
+        :param study: The study the consent was signed for
+        :type study: str
+        :param participant: The participant's snapshot
+        :type participant: ParticipantSnapshot
+        :return: The participant's consent details
+        :rtype: dict
+        """
+        ppm_id, document_reference = participant.ppm_id, participant.document_reference
+        return {
+            'ppm_id': ppm_id,
+            'download_url': P2MD.get_consent_url(study=study, ppm_id=ppm_id) if document_reference else None,
+            'url': document_reference['url'] if document_reference else None,
+            'enrollment': participant.enrollment,
+            'created': document_reference.get('timestamp') if document_reference else None,
+        }
+
     def post(self, request, study, format=None):
         """
         Check if consent PDF exists, create it and store it if not, and then returns the download URL for consent
@@ -315,64 +424,20 @@ class ConsentsView(APIView):
         self.check_permissions(request)
 
         try:
-            # Build response object detailing operations
-            response = []
-
             # Check if we should overwrite
             overwrite = request.data.get('overwrite', request.GET.get('overwrite', False))
             ppm_ids = request.data.get('ppm_ids').split(',') if request.data.get('ppm_ids', False) else None
 
-            # Get participants for study
-            participants = FHIR.query_participants(studies=[study])
-            for participant in participants:
-
-                # Pull their details
-                ppm_id = participant['ppm_id']
-                logger.debug(f'{study}/Patient/{ppm_id}: Checking consent render')
+            # Render them in the background
+            job = jobs.submit(request, study, overwrite=overwrite, ppm_ids=ppm_ids)
 
-                # Toss out if not consented
-                if PPM.Enrollment.enum(participant['enrollment']) is PPM.Enrollment.Registered:
-                    continue
-
-                # If filtered, toss out
-                if ppm_ids and ppm_id not in ppm_ids:
-                    logger.debug(f'{study}/Patient/{ppm_id}: Filtered out')
-                    continue
-
-                # Check consents
-                document_reference = FHIR.get_consent_document_reference(patient=ppm_id,
-                                                                         study=study,
-                                                                         flatten_return=True)
-
-                # Check state of consent
-                if not document_reference or overwrite:
-
-                    # Remove currently PDF
-                    if document_reference and overwrite:
-                        logger.debug(f'PPM/{study}/Patient/{ppm_id} has rendered PDF but will overwrite with a new'
-                                     f' render: DocumentReference/{document_reference["id"]}')
-                        if not ConsentView.delete_consent_document_reference(request, ppm_id=ppm_id, study=study,
-                                                                             document_reference=document_reference):
-                            logger.error(f'PPM/{study}/Patient/{ppm_id} could not overwrite consent render with a new'
-                                         f' render: DocumentReference/{document_reference["id"]}')
-                            continue
-
-                    # Create their consent
-                    logger.debug(f'{study}/Patient/{ppm_id}: Generating consent...')
-                    ConsentView.create_consent_document_reference(request=request, study=study, ppm_id=ppm_id)
-
-                    # Add the URL
-                    response.append({
-                        'ppm_id': ppm_id,
-                        'download_url': P2MD.get_consent_url(study=study, ppm_id=ppm_id),
-                        'created': datetime.now().isoformat(),
-                        'enrollment': participant['enrollment'],
-                    })
-                else:
-                    logger.debug(f'PPM/{study}/Patient/{ppm_id} already has consent PDF:'
-                                 f' DocumentReference/{document_reference["id"]}')
-
-            return Response(response)
+            return Response({
+                'job': job.id,
+                'status': job.status,
+                'status_url': request.build_absolute_uri(reverse('api:consent-job', kwargs={
+                    'study': study, 'job_id': job.id,
+                })),
+            }, status=status.HTTP_202_ACCEPTED)
 
         except Exception as e:
             logger.exception("Error while rendering consent: {}".format(e), exc_info=True, extra={
@@ -384,6 +449,45 @@ class ConsentsView(APIView):
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+class ConsentJobView(APIView):
+    """
+    View to report the progress of a bulk consent render job
+    """
+    permission_classes = (DBMIAdminPermission, )
+
+    def get(self, request, study, job_id, format=None):
+        """
+        Returns the job's state and each participant's progress
+        """
+        # Check permissions.
+        self.check_permissions(request)
+
+        job = RenderJob.objects.filter(id=job_id, study=PPM.Study.get(study).value).first()
+        if not job:
+            return Response(f'Render job {job_id} does not exist', status=status.HTTP_404_NOT_FOUND)
+
+        return Response(job.as_dict(tasks=request.GET.get('tasks', 'true').lower() != 'false'))
+
+
+class RenderMetricsView(APIView):
+    """
+    View to report on this process's consent renders
+    """
+    permission_classes = (DBMIAdminPermission, )
+
+    def get(self, request, format=None):
+        """
+        Returns the background render queue's and the PDF renderer's metrics
+        """
+        # Check permissions.
+        self.check_permissions(request)
+
+        return Response({
+            'queue': renders.stats(),
+            'renderer': metrics.stats(),
+        })
+
+
 class QuestionnaireView(APIView):
     """
     View to manage FHIR Questionnaire resources
@@ -444,10 +548,14 @@ class QuestionnaireView(APIView):
 
         try:
             # Create the organization
-            response = requests.post(PPM.fhir_url(), json=bundle.as_json())
+            response = sessions.post(PPM.fhir_url(), json=bundle.as_json())
             logger.debug("Response: {}".format(response.status_code))
             response.raise_for_status()
 
+            # Drop any cached copy, should it reuse an ID
+            if questionnaire.id:
+                questionnaires.invalidate(questionnaire.id)
+
             return response.json()
 
         except Exception as e:
@@ -482,10 +590,13 @@ class QuestionnaireView(APIView):
 
         try:
             # Create the organization
-            response = requests.post(PPM.fhir_url(), json=bundle.as_json())
+            response = sessions.post(PPM.fhir_url(), json=bundle.as_json())
             logger.debug("Response: {}".format(response.status_code))
             response.raise_for_status()
 
+            # Stop serving the cached copy
+            questionnaires.invalidate(questionnaire_id)
+
             return response.json()
 
         except Exception as e:
@@ -518,10 +629,13 @@ class QuestionnaireView(APIView):
 
         try:
             # Create the organization
-            response = requests.post(PPM.fhir_url(), json=bundle.as_json())
+            response = sessions.post(PPM.fhir_url(), json=bundle.as_json())
             logger.debug("Response: {}".format(response.status_code))
             response.raise_for_status()
 
+            # Stop serving the cached copy
+            questionnaires.invalidate(questionnaire_id)
+
             return response.json()
 
         except Exception as e:
@@ -533,7 +647,7 @@ class QuestionnaireView(APIView):
                 },
             )
 
-    def patch(request, questionnaire_id, format=None):
+    def patch(self, request, questionnaire_id, format=None):
         """
         Uses FHIR+json patch to update a resource
         """
@@ -557,10 +671,13 @@ class QuestionnaireView(APIView):
 
         try:
             # Create the organization
-            response = requests.post(PPM.fhir_url(), json=bundle.as_json())
+            response = sessions.post(PPM.fhir_url(), json=bundle.as_json())
             logger.debug("Response: {}".format(response.status_code))
             response.raise_for_status()
 
+            # Stop serving the cached copy
+            questionnaires.invalidate(questionnaire_id)
+
             return response.json()
 
         except Exception as e:
@@ -0,0 +1,123 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.template import loader
+
+from pdf.backends import get_backend
+from pdf.pool import pool
+
+
+def peak_rss(pid='self'):
+    """
+    Returns the peak resident memory of the process in KB, where /proc is available
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return 0
+
+
+class Command(BaseCommand):
+    help = 'Render consent PDFs with each PDF backend and compare their latency and memory'
+
+    # The backends to compare by default
+    BACKENDS = [
+        'pdf.backends.PhantomJSBackend',
+        'pdf.backends.WeasyPrintBackend',
+    ]
+
+    # The standalone consent documents
+    TEMPLATES = [
+        'consent/pdf/consent.html',
+        'consent/pdf/rant.html',
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', help='Dotted path of a backend, may be repeated')
+        parser.add_argument('--template', action='append', help='Consent template to render, may be repeated')
+        parser.add_argument('--context', help='Path to a JSON consent composition to render with')
+        parser.add_argument('--iterations', type=int, default=20, help='Renders per backend and template')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed renders before measuring')
+
+    def handle(self, *args, **options):
+
+        # Build the context
+        if options['context']:
+            with open(options['context']) as f:
+                context = json.load(f)
+        else:
+            context = Command.sample_context()
+
+        for template_name in options['template'] or Command.TEMPLATES:
+            html = loader.render_to_string(template_name, context)
+            self.stdout.write(f'{template_name} ({len(html) // 1024} KB of HTML)')
+
+            for path in options['backend'] or Command.BACKENDS:
+                try:
+                    backend = get_backend(path)
+                except Exception as e:
+                    self.stdout.write(self.style.WARNING(f'  {path}: unavailable: {e}'))
+                    continue
+
+                try:
+                    self.stdout.write('  ' + self.benchmark(backend, html, options['iterations'], options['warmup']))
+                except Exception as e:
+                    self.stdout.write(self.style.ERROR(f'  {path}: failed to render: {e}'))
+
+        pool.close()
+
+    @staticmethod
+    def benchmark(backend, html, iterations, warmup):
+        for _ in range(warmup):
+            backend.render(html)
+
+        rss = peak_rss()
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            pdf = backend.render(html)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        # Count this process's growth and the peak of any renderer processes
+        memory = peak_rss() - rss
+        renderers = [peak_rss(renderer.process.pid) for renderer in list(pool._idle.queue)]
+
+        timings.sort()
+        return (
+            f'{backend.name or type(backend).__name__:<12} '
+            f'mean {statistics.mean(timings):7.1f} ms  '
+            f'p50 {timings[len(timings) // 2]:7.1f} ms  '
+            f'p95 {timings[min(int(len(timings) * 0.95), len(timings) - 1)]:7.1f} ms  '
+            f'pdf {len(pdf) // 1024} KB  '
+            f'memory +{memory // 1024} MB in process, {sum(renderers) // 1024} MB in {len(renderers)} renderer(s)'
+        )
+
+    @staticmethod
+    def sample_context():
+        """
+        Returns a consent composition of typical length
+        """
+        paragraph = ('<p>' + 'Participation in this study is voluntary and you may withdraw at any time. ' * 12
+                     + '</p>')
+        questions = [
+            {'text': f'I agree to item {index} of this consent.', 'answer': index % 2 == 0, 'type': 'boolean'}
+            for index in range(10)
+        ]
+
+        return {
+            'consent_text': ''.join(f'<h3>Section {index}</h3>{paragraph * 4}' for index in range(15)),
+            'consent_questionnaires': [
+                {'questionnaire': 'individual-signature-part-1', 'questions': questions},
+            ],
+            'participant_name': 'Jane Doe',
+            'signer_signature': 'Jane Doe',
+            'date_signed': time.strftime('%m/%d/%Y'),
+            'type': 'INDIVIDUAL',
+        }
@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.urls import re_path
 
 from consent import views
 
 app_name = "consent"
 
+# Use the async submission views when served by ASGI
+ConsentView = views.AsyncConsentView if settings.ASYNC_VIEWS else views.ConsentView
+ASDSignatureView = views.AsyncASDSignatureView if settings.ASYNC_VIEWS else views.ASDSignatureView
+
 # Add views.
 urlpatterns = [
     re_path(r'^p/(?P<study>[a-z\-_]+)/$', views.StudyView.as_view(), name='study'),
@@ -12,7 +17,7 @@ urlpatterns = [
 
     re_path(r'^c/asd/$', views.ASDView.as_view(), name='asd'),
     re_path(r'^c/asd/quiz/$', views.ASDQuizView.as_view(), name='asd-quiz'),
-    re_path(r'^c/asd/signature/$', views.ASDSignatureView.as_view(), name='asd-signature'),
-    re_path(r'^c/(?P<study>[a-z\-_]+)/$', views.ConsentView.as_view(), name='consent'),
+    re_path(r'^c/asd/signature/$', ASDSignatureView.as_view(), name='asd-signature'),
+    re_path(r'^c/(?P<study>[a-z\-_]+)/$', ConsentView.as_view(), name='consent'),
     re_path(r'^$', views.IndexView.as_view(), name='index'),
 ]
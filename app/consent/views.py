@@ -1,6 +1,6 @@
-import threading
 from distutils.util import strtobool
 
+from asgiref.sync import sync_to_async
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import render, redirect, reverse
 from django.conf import settings
@@ -12,9 +12,11 @@ from dbmi_client.auth import dbmi_user, dbmi_admin
 from dbmi_client.authn import get_jwt_email
 
 from ppmutils.ppm import PPM
-from ppmutils.p2md import P2MD
 from ppmutils.fhir import FHIR as PPMFHIR
 from fhirquestionnaire.fhir import FHIR
+from fhirquestionnaire.asyncfhir import AsyncFHIR
+from fhirquestionnaire.cache import patients
+from fhirquestionnaire.http import P2MD
 from consent.forms import ASDTypeForm
 from consent.forms import ASDGuardianQuiz
 from consent.forms import ASDIndividualQuiz
@@ -22,8 +24,11 @@ from consent.forms import ASDIndividualSignatureForm
 from consent.forms import ASDGuardianSignatureForm
 from consent.forms import ASDWardSignatureForm
 from consent import forms
-from questionnaire.views import get_return_url
+from questionnaire.views import get_return_url, render_patient_does_not_exist, AsyncViewMixin
 from api.views import ConsentView as APIConsentView
+from api.jobs import jobs
+from api.outbox import outbox
+from api.renders import renders
 
 import logging
 logger = logging.getLogger(__name__)
@@ -120,53 +125,81 @@ class ConsentView(View):
         # Proceed with super's implementation.
         return super(ConsentView, self).dispatch(request, *args, **kwargs)
 
-    @method_decorator(dbmi_user)
-    def get(self, request, *args, **kwargs):
-
-        # Get the patient email and ensure they exist
-        patient_email = get_jwt_email(request=request, verify=False)
-
-        try:
-            # If in demo mode, do not check participant and prior submissions
-            if not self.demo(request):
-
-                # Ensure the current user has a record
-                FHIR.check_patient(patient_email)
-
-                # Check response
-                FHIR.check_consent(self.study, patient_email)
-
-            # Create the form
-            form = self.Form()
-
-            context = {
-                'study': self.study,
-                'form': form,
-                'return_url': self.return_url
-            }
-
-            # Build the template response
-            response = render(request, template_name='consent/{}.html'.format(self.study), context=context)
-
-            return response
-
-        except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist')
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
-
-        except FHIR.QuestionnaireDoesNotExist:
+    def form_response(self, request, form):
+        """
+        Renders the consent's form, filled out or not.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param form: The consent's form
+        :type form: Form
+        :return: The response
+        :rtype: HttpResponse
+        """
+        context = {
+            'study': self.study,
+            'form': form,
+            'return_url': self.return_url
+        }
+
+        # Build the template response
+        return render(request, template_name='consent/{}.html'.format(self.study), context=context)
+
+    def success_response(self, request, submission):
+        """
+        Queues the render of the consent just signed and renders the page
+        shown once it was submitted.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param submission: The queued submission, if any
+        :type submission: Submission
+        :return: The response
+        :rtype: HttpResponse
+        """
+        if not self.demo(request):
+
+            # Submit consent PDF in the background
+            queue_consent_render(request, self.study, submission)
+
+        # Get the return URL
+        context = {
+            'study': self.study,
+            'return_url': self.return_url,
+            'demo': self.demo(request),
+            'queued': submission is not None,
+        }
+
+        # Get the passed parameters
+        return render(request, template_name='consent/success.html', context=context)
+
+    def error_response(self, request, error, patient_email, action):
+        """
+        Renders the error page for an exception raised while handling the
+        consent.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param error: The exception raised
+        :type error: Exception
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param action: What was being done, for logging
+        :type action: str
+        :return: The response
+        :rtype: HttpResponse
+        """
+        if isinstance(error, FHIR.PatientDoesNotExist):
+            return render_patient_does_not_exist(request, patient_email, render_error)
+
+        if isinstance(error, FHIR.QuestionnaireDoesNotExist):
             logger.warning('Consent does not exist: {}'.format(PPM.Study.title(self.study)))
             return render_error(request,
                                 title='Consent Does Not Exist: {}'.format(self.questionnaire_id),
                                 message='The requested consent does not exist!',
                                 support=False)
 
-        except FHIR.ConsentAlreadyExists:
+        if isinstance(error, FHIR.ConsentAlreadyExists):
             logger.warning('Consent already finished')
             return render_error(request,
                                 title='Consent Already Completed',
@@ -174,15 +207,33 @@ class ConsentView(View):
                                         'consent.',
                                 support=False)
 
+        logger.error("Error while {} consent: {}".format(action, error), exc_info=error, extra={
+            'request': request, 'project': self.study, 'questionnaire': self.questionnaire_id, 'form': self.Form
+        })
+        return render_error(request,
+                            title='Application Error',
+                            message='The application has experienced an unknown error{}'
+                            .format(': {}'.format(error) if settings.DEBUG else '.'),
+                            support=False)
+
+    @method_decorator(dbmi_user)
+    def get(self, request, *args, **kwargs):
+
+        # Get the patient email and ensure they exist
+        patient_email = get_jwt_email(request=request, verify=False)
+
+        try:
+            # If in demo mode, do not check participant and prior submissions
+            if not self.demo(request):
+
+                # Ensure the current user has a record and has not yet consented
+                FHIR.preflight_consent(self.study, patient_email)
+
+            # Create the form
+            return self.form_response(request, self.Form())
+
         except Exception as e:
-            logger.error("Error while rendering consent: {}".format(e), exc_info=True, extra={
-                'request': request, 'project': self.study, 'questionnaire': self.questionnaire_id, 'form': self.Form
-            })
-            return render_error(request,
-                                title='Application Error',
-                                message='The application has experienced an unknown error{}'
-                                .format(': {}'.format(e) if settings.DEBUG else '.'),
-                                support=False)
+            return self.error_response(request, e, patient_email, 'rendering')
 
     @method_decorator(dbmi_user)
     def post(self, request, *args, **kwargs):
@@ -195,59 +246,66 @@ class ConsentView(View):
         if not form.is_valid():
 
             # Return the form
-            context = {
-                'study': self.study,
-                'form': form,
-                'return_url': self.return_url
-            }
-
-            return render(request, template_name='consent/{}.html'.format(self.study), context=context)
+            return self.form_response(request, form)
 
         # Process the form
         try:
             # Submit the consent
-            FHIR.submit_consent(self.study, patient_email, form.cleaned_data, dry=self.demo(request))
+            submission = FHIR.submit_consent(self.study, patient_email, form.cleaned_data, dry=self.demo(request))
 
+            return self.success_response(request, submission)
+
+        except Exception as e:
+            return self.error_response(request, e, patient_email, 'submitting')
+
+
+class AsyncConsentView(AsyncViewMixin, ConsentView):
+    """
+    ConsentView for ASGI deployments: waiting on FHIR does not hold a worker
+    thread. Only the FHIR calls differ; responses are built by the
+    synchronous view's helpers.
+    """
+
+    async def get(self, request, *args, **kwargs):
+
+        # Get the patient email and ensure they exist
+        patient_email = get_jwt_email(request=request, verify=False)
+
+        try:
+            # If in demo mode, do not check participant and prior submissions
             if not self.demo(request):
 
-                # Submit consent PDF in the background
-                threading.Thread(target=APIConsentView.create_consent_document_reference,
-                                args=(request, self.study)).start()
+                # Ensure the current user has a record and has not yet consented
+                await AsyncFHIR.preflight_consent(self.study, patient_email)
 
-            # Get the return URL
-            context = {
-                'study': self.study,
-                'return_url': self.return_url,
-                'demo': self.demo(request)
-            }
+            # Create the form
+            return await sync_to_async(self.form_response)(request, self.Form())
 
-            # Get the passed parameters
-            return render(request, template_name='consent/success.html', context=context)
+        except Exception as e:
+            return await sync_to_async(self.error_response)(request, e, patient_email, 'rendering')
 
-        except FHIR.QuestionnaireDoesNotExist:
-            logger.warning('Consent does not exist: {}'.format(PPM.Study.title(self.study)))
-            return render_error(request,
-                                title='Consent Does Not Exist: {}'.format(self.questionnaire_id),
-                                message='The requested consent does not exist!',
-                                support=False)
+    async def post(self, request, *args, **kwargs):
+
+        # Get the patient email
+        patient_email = get_jwt_email(request=request, verify=False)
+
+        # Get the form
+        form = self.Form(request.POST)
+        if not form.is_valid():
+
+            # Return the form
+            return await sync_to_async(self.form_response)(request, form)
+
+        # Process the form
+        try:
+            # Submit the consent
+            submission = await AsyncFHIR.submit_consent(self.study, patient_email, form.cleaned_data,
+                                                        dry=self.demo(request))
+
+            return await sync_to_async(self.success_response)(request, submission)
 
-        except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist: {}'.format(patient_email[:3]+'****'+patient_email[-4:]))
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
         except Exception as e:
-            logger.error("Error while submitting consent: {}".format(e), exc_info=True, extra={
-                'request': request, 'project': self.study, 'questionnaire': self.questionnaire_id, 'form': self.Form
-            })
-            return render_error(request,
-                                title='Application Error',
-                                message='The application has experienced an unknown error {}'
-                                .format(': {}'.format(e) if settings.DEBUG else '.'),
-                                support=False)
+            return await sync_to_async(self.error_response)(request, e, patient_email, 'submitting')
 
 
 class ASDView(View):
@@ -294,10 +352,8 @@ class ASDView(View):
             # If in demo mode, do not check participant and prior submissions
             if not self.demo(request):
 
-                FHIR.check_patient(patient_email)
-
-                # Check response
-                FHIR.check_consent(PPM.Study.ASD.value, patient_email)
+                # Ensure the current user has a record and has not yet consented
+                FHIR.preflight_consent(PPM.Study.ASD.value, patient_email)
 
             # Create the form
             form = ASDTypeForm()
@@ -310,13 +366,7 @@ class ASDView(View):
             return render(request, template_name='consent/asd.html', context=context)
 
         except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist')
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
+            return render_patient_does_not_exist(request, patient_email, render_error)
 
         except FHIR.QuestionnaireDoesNotExist:
             logger.warning('Consent does not exist: NEER')
@@ -521,173 +571,229 @@ class ASDSignatureView(View):
         # Proceed with super's implementation.
         return super(ASDSignatureView, self).dispatch(request, *args, **kwargs)
 
-    @method_decorator(dbmi_user)
-    def post(self, request, *args, **kwargs):
-        logger.debug('Signature view')
-
-        # Get the patient's email
-        patient_email = get_jwt_email(request=request, verify=False)
+    def signature(self, request, client):
+        """
+        Handles the signature form posted for the current step of the consent.
+        Either there is another form to show, returned as the response, or the
+        consent is complete and the client's submit method and the forms to
+        pass it are returned.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param client: The FHIR client to submit with, FHIR or AsyncFHIR
+        :type client: type
+        :return: The response, or the submit method and the forms to submit
+        :rtype: HttpResponse, callable, dict
+        """
+        # Check form type
+        if request.session['individual']:
+            logger.debug('Individual signature')
 
-        # Process the form
-        try:
-            # Check form type
-            if request.session['individual']:
-                logger.debug('Individual signature')
+            # Get the form
+            form = ASDIndividualSignatureForm(request.POST)
+            if not form.is_valid():
+                logger.debug('Individual signature invalid: {}'.format(form.errors.as_json()))
 
-                # Get the form
-                form = ASDIndividualSignatureForm(request.POST)
-                if not form.is_valid():
-                    logger.debug('Individual signature invalid: {}'.format(form.errors.as_json()))
+                # Return the form
+                context = {
+                    'form': form,
+                    'return_url': self.return_url
+                }
 
-                    # Return the form
-                    context = {
-                        'form': form,
-                        'return_url': self.return_url
-                    }
+                return render(
+                    request, template_name='consent/asd/individual-signature-part-1.html', context=context
+                ), None, None
 
-                    return render(
-                        request, template_name='consent/asd/individual-signature-part-1.html', context=context
-                    )
+            # Build the data
+            user_forms = dict({'individual': form.cleaned_data, 'quiz': request.session['quiz']})
 
-                # Build the data
-                user_forms = dict({'individual': form.cleaned_data, 'quiz': request.session['quiz']})
+            return None, client.submit_asd_individual, user_forms
 
-                # Submit the data
-                FHIR.submit_asd_individual(patient_email, user_forms, dry=self.demo(request))
+        logger.debug('Guardian/ward signature')
 
-                # If in demo mode, do not create PDF
-                if not self.demo(request):
+        # Check which signature
+        if request.session.get('guardian'):
+            logger.debug('Ward signature')
 
-                    # Submit consent PDF in the background
-                    threading.Thread(target=APIConsentView.create_consent_document_reference,
-                                    args=(request, PPM.Study.ASD.value)).start()
+            # Get the form
+            form = ASDWardSignatureForm(request.POST)
+            if not form.is_valid():
+                logger.debug('Ward signature invalid: {}'.format(form.errors.as_json()))
 
-                # Get the return URL
+                # Return the form
                 context = {
-                    'return_url': self.return_url,
-                    'demo': self.demo(request)
+                    'form': form,
+                    'return_url': self.return_url
                 }
 
-                # Get the passed parameters
-                return render(request, template_name='consent/success.html', context=context)
-
-            else:
-                logger.debug('Guardian/ward signature')
-
-                # Check which signature
-                if request.session.get('guardian'):
-                    logger.debug('Ward signature')
-
-                    # Get the form
-                    form = ASDWardSignatureForm(request.POST)
-                    if not form.is_valid():
-                        logger.debug('Ward signature invalid: {}'.format(form.errors.as_json()))
+                return render(
+                    request, template_name='consent/asd/guardian-signature-part-3.html', context=context
+                ), None, None
+
+            # Build the data
+            user_forms = dict({
+                'ward': form.cleaned_data,
+                'guardian': request.session['guardian'],
+                'quiz': request.session['quiz']
+            })
 
-                        # Return the form
-                        context = {
-                            'form': form,
-                            'return_url': self.return_url
-                        }
+            return None, client.submit_asd_guardian, user_forms
 
-                        return render(request, template_name='consent/asd/guardian-signature-part-3.html',
-                                      context=context)
+        logger.debug('Guardian signature')
 
-                    # Build the data
-                    user_forms = dict({
-                        'ward': form.cleaned_data,
-                        'guardian': request.session['guardian'],
-                        'quiz': request.session['quiz']
-                    })
+        # Get the form
+        form = ASDGuardianSignatureForm(request.POST)
+        if not form.is_valid():
+            logger.debug('Guardian signature invalid: {}'.format(form.errors.as_json()))
 
-                    # Submit the data
-                    FHIR.submit_asd_guardian(patient_email, user_forms, dry=self.demo(request))
+            # Return the form
+            context = {
+                'form': form,
+                'return_url': self.return_url
+            }
 
-                    # If in demo mode, do not create PDF
-                    if not self.demo(request):
+            return render(
+                request, template_name='consent/asd/guardian-signature-part-1-2.html', context=context
+            ), None, None
+
+        # Fix the date
+        date = form.cleaned_data['date'].isoformat()
+        form.cleaned_data['date'] = date
+
+        # Retain their responses
+        request.session['guardian'] = form.cleaned_data
+
+        # Make the ward signature form
+        form = ASDWardSignatureForm()
+
+        # Get the return URL
+        context = {
+            'form': form,
+            'return_url': self.return_url,
+        }
+
+        # Get the passed parameters
+        return render(
+            request, template_name='consent/asd/guardian-signature-part-3.html', context=context
+        ), None, None
+
+    def success_response(self, request, submission):
+        """
+        Queues the render of the consent just signed and renders the page
+        shown once it was submitted.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param submission: The queued submission, if any
+        :type submission: Submission
+        :return: The response
+        :rtype: HttpResponse
+        """
+        # If in demo mode, do not create PDF
+        if not self.demo(request):
+
+            # Submit consent PDF in the background
+            queue_consent_render(request, PPM.Study.ASD.value, submission)
+
+        # Get the return URL
+        context = {
+            'return_url': self.return_url,
+            'demo': self.demo(request),
+            'queued': submission is not None,
+        }
+
+        # Get the passed parameters
+        return render(request, template_name='consent/success.html', context=context)
+
+    def error_response(self, request, error, patient_email):
+        """
+        Renders the error page for an exception raised while handling a
+        signature.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param error: The exception raised
+        :type error: Exception
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :return: The response
+        :rtype: HttpResponse
+        """
+        if isinstance(error, FHIR.PatientDoesNotExist):
+            return render_patient_does_not_exist(request, patient_email, render_error)
+
+        if isinstance(error, FHIR.QuestionnaireDoesNotExist):
+            logger.warning('Consent does not exist: ASD')
+            return render_error(request,
+                                title='Consent Does Not Exist',
+                                message='The requested consent does not exist!',
+                                support=False)
 
-                        # Submit consent PDF in the background
-                        threading.Thread(target=APIConsentView.create_consent_document_reference,
-                                        args=(request, PPM.Study.ASD.value)).start()
+        if isinstance(error, FHIR.QuestionnaireResponseAlreadyExists):
+            logger.warning('Consent already finished')
+            return render_error(request,
+                                title='Consent Already Completed',
+                                message='You have already filled out and submitted this '
+                                        'consent.',
+                                support=False)
 
-                    # Get the return URL
-                    context = {
-                        'return_url': self.return_url,
-                        'demo': self.demo(request)
-                    }
+        logger.error("Error while submitting consent signature: {}".format(error), exc_info=error, extra={
+            'project': 'asd', 'request': request,
+        })
+        return render_error(request,
+                            title='Application Error',
+                            message='The application has experienced an unknown error{}'
+                            .format(': {}'.format(error) if settings.DEBUG else '.'),
+                            support=False)
 
-                    # Get the passed parameters
-                    return render(request, template_name='consent/success.html', context=context)
+    @method_decorator(dbmi_user)
+    def post(self, request, *args, **kwargs):
+        logger.debug('Signature view')
 
-                else:
-                    logger.debug('Guardian signature')
+        # Get the patient's email
+        patient_email = get_jwt_email(request=request, verify=False)
 
-                    # Get the form
-                    form = ASDGuardianSignatureForm(request.POST)
-                    if not form.is_valid():
-                        logger.debug('Guardian signature invalid: {}'.format(form.errors.as_json()))
+        # Process the form
+        try:
+            response, submit, user_forms = self.signature(request, FHIR)
+            if response:
+                return response
 
-                        # Return the form
-                        context = {
-                            'form': form,
-                            'return_url': self.return_url
-                        }
+            # Submit the data
+            submission = submit(patient_email, user_forms, dry=self.demo(request))
 
-                        return render(
-                            request, template_name='consent/asd/guardian-signature-part-1-2.html', context=context
-                        )
+            return self.success_response(request, submission)
 
-                    # Fix the date
-                    date = form.cleaned_data['date'].isoformat()
-                    form.cleaned_data['date'] = date
+        except Exception as e:
+            return self.error_response(request, e, patient_email)
 
-                    # Retain their responses
-                    request.session['guardian'] = form.cleaned_data
 
-                    # Make the ward signature form
-                    form = ASDWardSignatureForm()
+class AsyncASDSignatureView(AsyncViewMixin, ASDSignatureView):
+    """
+    ASDSignatureView for ASGI deployments: waiting on FHIR does not hold a
+    worker thread. Only the FHIR calls differ; responses are built by the
+    synchronous view's helpers.
+    """
 
-                    # Get the return URL
-                    context = {
-                        'form': form,
-                        'return_url': self.return_url,
-                    }
+    async def post(self, request, *args, **kwargs):
+        logger.debug('Signature view')
 
-                    # Get the passed parameters
-                    return render(request, template_name='consent/asd/guardian-signature-part-3.html', context=context)
+        # Get the patient's email
+        patient_email = get_jwt_email(request=request, verify=False)
 
-        except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist')
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
+        # Process the form
+        try:
+            response, submit, user_forms = await sync_to_async(self.signature)(request, AsyncFHIR)
+            if response:
+                return response
 
-        except FHIR.QuestionnaireDoesNotExist:
-            logger.warning('Consent does not exist: ASD')
-            return render_error(request,
-                                title='Consent Does Not Exist',
-                                message='The requested consent does not exist!',
-                                support=False)
+            # Submit the data
+            submission = await submit(patient_email, user_forms, dry=self.demo(request))
 
-        except FHIR.QuestionnaireResponseAlreadyExists:
-            logger.warning('Consent already finished')
-            return render_error(request,
-                                title='Consent Already Completed',
-                                message='You have already filled out and submitted this '
-                                        'consent.',
-                                support=False)
+            return await sync_to_async(self.success_response)(request, submission)
 
         except Exception as e:
-            logger.error("Error while submitting consent signature: {}".format(e), exc_info=True, extra={
-                'project': 'asd', 'request': request,
-            })
-            return render_error(request,
-                                title='Application Error',
-                                message='The application has experienced an unknown error{}'
-                                .format(': {}'.format(e) if settings.DEBUG else '.'),
-                                support=False)
+            return await sync_to_async(self.error_response)(request, e, patient_email)
 
 
 class DownloadView(View):
@@ -710,11 +816,11 @@ class DownloadView(View):
             # Check FHIR
             if not PPMFHIR.get_consent_document_reference(patient=patient_email, study=study, flatten_return=True):
 
-                # Save it
-                APIConsentView.create_consent_document_reference(request=request, study=study)
+                # Save it, ahead of background and bulk renders
+                renders.run(APIConsentView.render_consent_document_reference, request, study, study=study)
 
             # Get their ID
-            ppm_id = PPMFHIR.query_patient_id(email=patient_email)
+            ppm_id = patients.get_id(patient_email)
 
             return HttpResponseRedirect(redirect_to=P2MD.get_consent_url(study=study, ppm_id=ppm_id))
 
@@ -745,8 +851,8 @@ class AdminDownloadView(View):
             # Check FHIR
             if not PPMFHIR.get_consent_document_reference(patient=ppm_id, study=study, flatten_return=True):
 
-                # Save it
-                APIConsentView.create_consent_document_reference(request=request, study=study, ppm_id=ppm_id)
+                # Save it, ahead of background and bulk renders
+                renders.run(APIConsentView.render_consent_document_reference, request, study, ppm_id, study=study)
 
             return HttpResponseRedirect(redirect_to=P2MD.get_consent_url(study=study, ppm_id=ppm_id))
 
@@ -758,6 +864,46 @@ class AdminDownloadView(View):
         raise SystemError('Could not render consent document')
 
 
+def queue_consent_render(request, study, submission):
+    """
+    Queues the render of the participant's consent PDF on the background
+    render executor once their consent has been written to FHIR, deferring
+    it to a render job of its own when the executor's queue is full. Nothing
+    holds a render thread while the consent is being written.
+
+    :param request: The current HttpRequest
+    :type request: HttpRequest
+    :param study: The study consented to
+    :type study: str
+    :param submission: The queued consent submission
+    :type submission: Submission
+    """
+    def delivered(ok):
+
+        # The PDF is rendered from the saved consent
+        if not ok:
+            logger.warning(f'PPM/{study}: {submission} was not delivered, PDF will be rendered on download')
+            return
+
+        renders.submit(render_consent, request, study, study=study,
+                       overflow=lambda: jobs.defer(request, study, submission))
+
+    outbox.on_delivered(submission.id, delivered, settings.OUTBOX_RENDER_WAIT)
+
+
+def render_consent(request, study):
+    """
+    Renders and uploads the participant's consent PDF. This is meant to be
+    run in the background, once their consent has been written to FHIR.
+
+    :param request: The current HttpRequest
+    :type request: HttpRequest
+    :param study: The study consented to
+    :type study: str
+    """
+    APIConsentView.render_consent_document_reference(request, study)
+
+
 def render_error(request, title=None, message=None, error=None, support=False):
 
     # Set default values
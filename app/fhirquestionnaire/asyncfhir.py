@@ -0,0 +1,267 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from fhirclient.models.patient import Patient
+from ppmutils.ppm import PPM
+
+from fhirquestionnaire.fhir import FHIR
+from fhirquestionnaire.cache import questionnaires
+from api.outbox import outbox
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The threads blocking FHIR calls are handed off to
+_executor = None
+
+
+def run(fn, *args, **kwargs):
+    """
+    Runs a blocking FHIR call on the FHIR executor and returns an awaitable
+    for its result. The calls themselves go through the pooled HTTP sessions.
+
+    This is for calls that only wait on FHIR; anything touching the database
+    must go through `sync_to_async` instead so it runs on the thread Django's
+    connections belong to.
+
+    :param fn: The blocking callable
+    :type fn: callable
+    :return: An awaitable resolving to the callable's result
+    :rtype: asyncio.Future
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.FHIR_ASYNC_WORKERS, thread_name_prefix='fhir')
+
+    return sync_to_async(fn, thread_sensitive=False, executor=_executor)(*args, **kwargs)
+
+
+class AsyncFHIR:
+    """
+    The asyncio counterpart of `fhirquestionnaire.fhir.FHIR`. Each method
+    mirrors its synchronous namesake, raises the same exceptions and runs
+    independent lookups concurrently.
+    """
+
+    # Share exceptions so callers handle either client the same way
+    Preflight = FHIR.Preflight
+    QuestionnaireDoesNotExist = FHIR.QuestionnaireDoesNotExist
+    PatientDoesNotExist = FHIR.PatientDoesNotExist
+    QuestionnaireResponseAlreadyExists = FHIR.QuestionnaireResponseAlreadyExists
+    ConsentAlreadyExists = FHIR.ConsentAlreadyExists
+
+    @staticmethod
+    async def submit_consent(study, patient_email, form, pdf=None, dry=False):
+        """
+        Accepts the filled out form for the given study and submits the data to FHIR for retaining
+        :param study: The study for which the consent was completed
+        :type study: str
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param form: The form filled out for the consent
+        :type form: Form
+        :param pdf: The generated PDF of the consent as raw data
+        :type pdf: bytearray
+        :param dry: If True, do not persist questionnaire response to store
+        :type dry: bool
+        :return: The queued submission, unless in dry mode
+        :rtype: Submission
+        """
+        # Check if consent has questionnaire
+        questionnaire = None
+        if PPM.Questionnaire.consent_questionnaire_for_study(study):
+
+            # Get the questionnaire
+            questionnaire, patient = await AsyncFHIR.get_resources(
+                PPM.Questionnaire.consent_questionnaire_for_study(study), patient_email, dry
+            )
+        else:
+
+            # Get patient
+            patient = Patient(await AsyncFHIR.get_patient(patient_email))
+
+        # Build the resources
+        bundle = await run(FHIR.consent_bundle, study, patient, form, questionnaire)
+
+        # Queue it for saving
+        if dry:
+            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
+        else:
+            return await sync_to_async(outbox.enqueue)(bundle.as_json(), 'consent', study)
+
+    @staticmethod
+    async def submit_questionnaire(study, patient_email, form, dry=False):
+        """
+        Accepts the filled out form for the given study and submits the data to FHIR for retaining
+        :param study: The study for which the questionnaire was completed
+        :type study: str
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param form: The form filled out for the questionnaire
+        :type form: Form
+        :param dry: If True, do not persist questionnaire response to store
+        :type dry: bool
+        :return: The queued submission, unless in dry mode
+        :rtype: Submission
+        """
+        # Get the questionnaire
+        questionnaire, patient = await AsyncFHIR.get_resources(
+            PPM.Questionnaire.questionnaire_for_study(study), patient_email, dry
+        )
+
+        # Build the response
+        bundle = FHIR.questionnaire_bundle(questionnaire, patient, form)
+
+        # Queue it for saving
+        if dry:
+            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
+        else:
+            return await sync_to_async(outbox.enqueue)(bundle.as_json(), 'questionnaire', study)
+
+    @staticmethod
+    async def submit_asd_individual(patient_email, forms, dry=False):
+        """
+        Accepts the filled out form for the given study and submits the data to FHIR for retaining
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param forms: The forms filled out for the questionnaire
+        :type forms: dict
+        :param dry: If True, do not persist questionnaire response to store
+        :type dry: bool
+        :return: The queued submission
+        :rtype: Submission
+        """
+        # Get the questionnaires and patient at once
+        quiz_questionnaire, signature_questionnaire, patient = await asyncio.gather(
+            AsyncFHIR.get_questionnaire('ppm-asd-consent-individual-quiz'),
+            AsyncFHIR.get_questionnaire('individual-signature-part-1'),
+            AsyncFHIR._get_patient_or_demo(patient_email, dry),
+        )
+
+        # Build the resources
+        bundle = await run(FHIR.asd_individual_bundle, patient, quiz_questionnaire, signature_questionnaire, forms)
+
+        # Queue it for saving
+        return await sync_to_async(outbox.enqueue)(bundle.as_json(), 'consent', PPM.Study.ASD.value)
+
+    @staticmethod
+    async def submit_asd_guardian(patient_email, forms, dry=False):
+        """
+        Accepts the filled out form for the given study and submits the data to FHIR for retaining
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param forms: The forms filled out for the questionnaire
+        :type forms: dict
+        :param dry: If True, do not persist questionnaire response to store
+        :type dry: bool
+        :return: The queued submission
+        :rtype: Submission
+        """
+        # Get the questionnaires and patient at once
+        (quiz_questionnaire, guardian_signature_questionnaire, guardian_reason_questionnaire,
+         ward_signature_questionnaire, patient) = await asyncio.gather(
+            AsyncFHIR.get_questionnaire('ppm-asd-consent-guardian-quiz'),
+            AsyncFHIR.get_questionnaire('guardian-signature-part-1'),
+            AsyncFHIR.get_questionnaire('guardian-signature-part-2'),
+            AsyncFHIR.get_questionnaire('guardian-signature-part-3'),
+            AsyncFHIR._get_patient_or_demo(patient_email, dry),
+        )
+
+        # Build the resources
+        bundle = await run(FHIR.asd_guardian_bundle, patient, quiz_questionnaire, guardian_signature_questionnaire,
+                           guardian_reason_questionnaire, ward_signature_questionnaire, forms)
+
+        # Queue it for saving
+        return await sync_to_async(outbox.enqueue)(bundle.as_json(), 'consent', PPM.Study.ASD.value)
+
+    @staticmethod
+    async def _query_resources(queries=[], type='transaction'):
+        return await run(FHIR._query_resources, queries, type)
+
+    @staticmethod
+    async def get_questionnaire(questionnaire_id):
+        """
+        Returns the Questionnaire for the given ID without leaving the event
+        loop when it is already cached.
+
+        :param questionnaire_id: The ID of the Questionnaire to fetch
+        :type questionnaire_id: str
+        :raises FHIR.QuestionnaireDoesNotExist: If does not exist
+        :return: The Questionnaire object
+        :rtype: Questionnaire
+        """
+        questionnaire = questionnaires.peek(questionnaire_id)
+        if questionnaire is not None:
+            return questionnaire
+
+        return await run(FHIR.get_questionnaire, questionnaire_id)
+
+    @staticmethod
+    async def get_patient(patient_email):
+        return await run(FHIR.get_patient, patient_email)
+
+    @staticmethod
+    async def get_resources(questionnaire_id, patient_email, dry=False):
+
+        # Get the questionnaire and search for the patient at once
+        questionnaire, patient = await asyncio.gather(
+            AsyncFHIR.get_questionnaire(questionnaire_id),
+            AsyncFHIR.get_patient(patient_email),
+        )
+
+        # Check for the patient
+        if not dry:
+            if not patient:
+                logger.error("Patient could not be fetched", extra={
+                    'patient': FHIR.obfuscate_email(patient_email),
+                    'questionnaires': questionnaire_id,
+                })
+                raise FHIR.PatientDoesNotExist()
+
+            patient = Patient(patient)
+        else:
+            # In dry mode, use a fake patient
+            patient = FHIR.get_demo_patient(patient_email)
+
+        return questionnaire, patient
+
+    @staticmethod
+    async def _get_patient_or_demo(patient_email, dry=False):
+
+        # Search for the patient
+        patient = await AsyncFHIR.get_patient(patient_email)
+        if patient:
+            return Patient(patient)
+
+        # Check if this is testing/dry
+        if not dry:
+            logger.error("Patient could not be fetched", extra={
+                'patient': FHIR.obfuscate_email(patient_email),
+            })
+            raise FHIR.PatientDoesNotExist
+
+        return FHIR.get_demo_patient(patient_email)
+
+    @staticmethod
+    async def preflight_questionnaire(questionnaire_id, patient_email):
+        return await run(FHIR.preflight_questionnaire, questionnaire_id, patient_email)
+
+    @staticmethod
+    async def preflight_consent(study, patient_email):
+        return await run(FHIR.preflight_consent, study, patient_email)
+
+    @staticmethod
+    async def check_patient(patient_email):
+        return await run(FHIR.check_patient, patient_email)
+
+    @staticmethod
+    async def check_consent(study, patient_email):
+        return await run(FHIR.check_consent, study, patient_email)
+
+    @staticmethod
+    async def check_response(questionnaire_id, patient_email):
+        return await run(FHIR.check_response, questionnaire_id, patient_email)
@@ -0,0 +1,336 @@
+import threading
+import time
+from collections import namedtuple, OrderedDict
+
+from django.conf import settings
+from furl import furl
+
+from fhirclient.models.questionnaire import Questionnaire
+from ppmutils.ppm import PPM
+from ppmutils.fhir import FHIR as PPMFHIR
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key into one execution. The first
+    caller for a key performs the work while any callers arriving before it
+    finishes wait and share its result (or its exception).
+    """
+
+    class _Call(object):
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Runs `fn` for the given key unless a call for that key is already in
+        flight, in which case this waits for and returns that call's result.
+
+        :param key: The key identifying the work being done
+        :type key: hashable
+        :param fn: The callable to run
+        :type fn: callable
+        :return: Whatever `fn` returns
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = SingleFlight._Call()
+
+        # Wait on the leader
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+
+        except Exception as e:
+            call.error = e
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+
+class QuestionnaireCache(object):
+    """
+    A process-local cache of Questionnaire resources keyed by their ID and
+    `meta.versionId`. Entries are served from memory until their TTL lapses,
+    after which they are revalidated with a conditional read so unchanged
+    Questionnaires cost a 304 rather than a full fetch. Concurrent misses for
+    the same Questionnaire are coalesced into a single FHIR request.
+
+    Cached Questionnaire objects are shared between requests and must be
+    treated as read-only.
+    """
+
+    Entry = namedtuple('Entry', ['questionnaire', 'version_id', 'etag', 'expires'])
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._flights = SingleFlight()
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = getattr(settings, 'QUESTIONNAIRE_CACHE_TTL', 300)
+        return self._ttl
+
+    def get(self, questionnaire_id):
+        """
+        Returns the Questionnaire for the given ID, fetching or revalidating
+        it against FHIR only when the cached copy has expired.
+
+        :param questionnaire_id: The ID of the Questionnaire
+        :type questionnaire_id: str
+        :return: The Questionnaire object, or None if it does not exist
+        :rtype: Questionnaire
+        """
+        entry = self._entries.get(questionnaire_id)
+        if entry and entry.expires > time.monotonic():
+            return entry.questionnaire
+
+        # Refresh it, sharing the request with any concurrent callers
+        entry = self._flights.do(questionnaire_id, self._refresh, questionnaire_id)
+
+        return entry.questionnaire if entry else None
+
+    def peek(self, questionnaire_id):
+        """
+        Returns the cached Questionnaire for the given ID if present and
+        unexpired, without making any requests.
+
+        :param questionnaire_id: The ID of the Questionnaire
+        :type questionnaire_id: str
+        :return: The Questionnaire object, if cached
+        :rtype: Questionnaire, defaults to None
+        """
+        entry = self._entries.get(questionnaire_id)
+        if entry and entry.expires > time.monotonic():
+            return entry.questionnaire
+
+        return None
+
+    def put(self, resource, etag=None):
+        """
+        Stores a Questionnaire resource fetched elsewhere, e.g. as part of a
+        batch request.
+
+        :param resource: The Questionnaire resource
+        :type resource: dict
+        :param etag: The ETag returned with the resource, if any
+        :type etag: str
+        :return: The cached Questionnaire object
+        :rtype: Questionnaire
+        """
+        return self._store(resource, etag).questionnaire
+
+    def invalidate(self, questionnaire_id=None):
+        """
+        Drops the given Questionnaire, or all Questionnaires, from the cache.
+
+        :param questionnaire_id: The ID of the Questionnaire to drop
+        :type questionnaire_id: str, defaults to None
+        """
+        with self._lock:
+            if questionnaire_id:
+                self._entries.pop(questionnaire_id, None)
+            else:
+                self._entries.clear()
+
+    def _store(self, resource, etag=None):
+
+        # Use the versionId as the ETag if the server did not send one
+        version_id = resource.get('meta', {}).get('versionId')
+        if not etag and version_id:
+            etag = f'W/"{version_id}"'
+
+        entry = QuestionnaireCache.Entry(
+            questionnaire=Questionnaire(resource),
+            version_id=version_id,
+            etag=etag,
+            expires=time.monotonic() + self.ttl,
+        )
+        with self._lock:
+            self._entries[resource['id']] = entry
+
+        return entry
+
+    def _refresh(self, questionnaire_id):
+
+        # Check for a stale copy to revalidate
+        entry = self._entries.get(questionnaire_id)
+        headers = {'If-None-Match': entry.etag} if entry and entry.etag else None
+
+        # Build the URL
+        url = furl(PPM.fhir_url())
+        url.path.segments.extend(['Questionnaire', questionnaire_id])
+
+        # Make the request
+        response = PPMFHIR.get(url.url, headers=headers, fail=True)
+        if response is None:
+
+            # Serve the stale copy rather than failing outright
+            if entry:
+                logger.warning(f'PPM/FHIR: Could not revalidate Questionnaire/{questionnaire_id}, using cached '
+                               f'version {entry.version_id}')
+                return entry
+
+            return None
+
+        # Unchanged, extend the current entry
+        if response.status_code == 304 and entry:
+            logger.debug(f'PPM/FHIR: Questionnaire/{questionnaire_id} not modified')
+            entry = entry._replace(expires=time.monotonic() + self.ttl)
+            with self._lock:
+                self._entries[questionnaire_id] = entry
+
+            return entry
+
+        logger.debug(f'PPM/FHIR: Fetched Questionnaire/{questionnaire_id}')
+        return self._store(response.json(), response.headers.get('ETag'))
+
+
+class PatientCache(object):
+    """
+    A bounded, process-local LRU cache resolving participant emails to their
+    Patient resource. Found Patients are kept for a short TTL; emails with no
+    Patient are remembered for an even shorter one so repeated lookups for
+    unknown users do not each hit FHIR. Only searches that succeed and find
+    nothing are cached as misses; failed lookups are never cached.
+
+    Patients are created by the PPM dashboard rather than this app, so a
+    participant's miss is dropped once they are told to go and register.
+    """
+
+    Entry = namedtuple('Entry', ['patient', 'expires'])
+
+    def __init__(self, size=None, ttl=None, negative_ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flights = SingleFlight()
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = getattr(settings, 'PATIENT_CACHE_SIZE', 1024)
+        return self._size
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = getattr(settings, 'PATIENT_CACHE_TTL', 60)
+        return self._ttl
+
+    @property
+    def negative_ttl(self):
+        if self._negative_ttl is None:
+            self._negative_ttl = getattr(settings, 'PATIENT_CACHE_NEGATIVE_TTL', 10)
+        return self._negative_ttl
+
+    def get(self, email):
+        """
+        Returns the Patient resource for the given email, or None if no
+        Patient exists for it.
+
+        :param email: The participant's email
+        :type email: str
+        :return: The Patient resource
+        :rtype: dict, defaults to None
+        """
+        key = email.lower()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry.expires > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry.patient
+
+        return self._flights.do(key, self._fetch, email)
+
+    def get_id(self, email):
+        """
+        Returns the Patient ID (PPM ID) for the given email, if any.
+
+        :param email: The participant's email
+        :type email: str
+        :return: The Patient ID
+        :rtype: str, defaults to None
+        """
+        patient = self.get(email)
+        return patient['id'] if patient else None
+
+    def put(self, email, patient):
+        """
+        Stores the result of a lookup made elsewhere, e.g. as part of a batch
+        request. Pass None to record that no Patient exists for the email.
+
+        :param email: The participant's email
+        :type email: str
+        :param patient: The Patient resource
+        :type patient: dict
+        """
+        ttl = self.ttl if patient else self.negative_ttl
+        with self._lock:
+            self._entries[email.lower()] = PatientCache.Entry(patient, time.monotonic() + ttl)
+            self._entries.move_to_end(email.lower())
+
+            # Evict the least recently used
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, email=None):
+        """
+        Drops the given email, or all emails, from the cache. Call this when a
+        participant's Patient is created or changed.
+
+        :param email: The participant's email
+        :type email: str, defaults to None
+        """
+        with self._lock:
+            if email:
+                self._entries.pop(email.lower(), None)
+            else:
+                self._entries.clear()
+
+    def _fetch(self, email):
+
+        # Search for the patient
+        bundle = PPMFHIR.fhir_get(['Patient'], query={
+            'identifier': f'{PPMFHIR.patient_email_identifier_system}|{email}',
+        })
+        if not bundle or bundle.get('resourceType') != 'Bundle':
+            raise SystemError('Patient lookup failed')
+
+        patient = next((entry['resource'] for entry in bundle.get('entry', [])), None)
+        self.put(email, patient)
+
+        return patient
+
+
+# The shared caches for this process
+questionnaires = QuestionnaireCache()
+patients = PatientCache()
@@ -1,14 +1,18 @@
 import datetime
-from urllib.parse import quote
+from collections import namedtuple
+from urllib.parse import quote, urlencode
 
 from django.template.loader import render_to_string
+from furl import furl
 
 from fhirclient.models.patient import Patient
-from fhirclient.models.questionnaire import Questionnaire
 from fhirclient.models.bundle import Bundle
 from ppmutils.ppm import PPM
 from ppmutils.fhir import FHIR as PPMFHIR
 
+from fhirquestionnaire.cache import questionnaires, patients
+from api.outbox import outbox
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -33,10 +37,45 @@ class FHIR:
         :type pdf: bytearray
         :param dry: If True, do not persist questionnaire response to store
         :type dry: bool
-        :return: Whether the operation succeeded or not
-        :rtype: bool
+        :return: The queued submission, unless in dry mode
+        :rtype: Submission
         """
 
+        # Check if consent has questionnaire
+        questionnaire = None
+        if PPM.Questionnaire.consent_questionnaire_for_study(study):
+
+            # Get the questionnaire
+            questionnaire, patient = FHIR.get_resources(PPM.Questionnaire.consent_questionnaire_for_study(study), patient_email, dry)
+        else:
+
+            # Get patient
+            patient = Patient(FHIR.get_patient(patient_email))
+
+        # Build the resources
+        bundle = FHIR.consent_bundle(study, patient, form, questionnaire)
+
+        # Queue it for saving
+        if dry:
+            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
+        else:
+            return outbox.enqueue(bundle.as_json(), 'consent', study)
+
+    @staticmethod
+    def consent_bundle(study, patient, form, questionnaire=None):
+        """
+        Builds the transaction of resources recording a signed consent
+        :param study: The study for which the consent was completed
+        :type study: str
+        :param patient: The participant's Patient
+        :type patient: Patient
+        :param form: The form filled out for the consent
+        :type form: Form
+        :param questionnaire: The consent's Questionnaire, if it has one
+        :type questionnaire: Questionnaire
+        :return: The transaction Bundle
+        :rtype: Bundle
+        """
         # Get the exception codes from the form
         data = dict(form)
         codes = data.get('exceptions', [])
@@ -51,10 +90,7 @@ class FHIR:
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         # Check if consent has questionnaire
-        if PPM.Questionnaire.consent_questionnaire_for_study(study):
-
-            # Get the questionnaire
-            questionnaire, patient = FHIR.get_resources(PPM.Questionnaire.consent_questionnaire_for_study(study), patient_email, dry)
+        if questionnaire is not None:
 
             # Map exception codes to linkId
             # TODO: Figure out how to generalize the handling of exceptions per consent
@@ -72,9 +108,6 @@ class FHIR:
             resources.extend([questionnaire_response, consent, contract])
         else:
 
-            # Get patient
-            patient = Patient(PPMFHIR.get_patient(patient_email))
-
             # Create needed resources
             contract = PPMFHIR.Resources.contract(patient, timestamp, name, signature)
             consent = PPMFHIR.Resources.consent(patient, timestamp)
@@ -91,13 +124,7 @@ class FHIR:
         resources.append(composition)
 
         # Bundle it into a transaction
-        bundle = PPMFHIR.Resources.bundle(resources)
-
-        # Save it
-        if dry:
-            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
-        else:
-            PPMFHIR.fhir_transaction(bundle.as_json())
+        return PPMFHIR.Resources.bundle(resources)
 
     @staticmethod
     def submit_questionnaire(study, patient_email, form, dry=False):
@@ -111,12 +138,34 @@ class FHIR:
         :type form: Form
         :param dry: If True, do not persist questionnaire response to store
         :type dry: bool
-        :return: Whether the operation succeeded or not
-        :rtype: bool
+        :return: The queued submission, unless in dry mode
+        :rtype: Submission
         """
         # Get the questionnaire
         questionnaire, patient = FHIR.get_resources(PPM.Questionnaire.questionnaire_for_study(study), patient_email, dry)
 
+        # Build the response
+        bundle = FHIR.questionnaire_bundle(questionnaire, patient, form)
+
+        # Queue it for saving
+        if dry:
+            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
+        else:
+            return outbox.enqueue(bundle.as_json(), 'questionnaire', study)
+
+    @staticmethod
+    def questionnaire_bundle(questionnaire, patient, form):
+        """
+        Builds the transaction recording a participant's questionnaire response
+        :param questionnaire: The Questionnaire that was completed
+        :type questionnaire: Questionnaire
+        :param patient: The participant's Patient
+        :type patient: Patient
+        :param form: The form filled out for the questionnaire
+        :type form: dict
+        :return: The transaction Bundle
+        :rtype: Bundle
+        """
         # Just use now
         date = datetime.datetime.now(datetime.timezone.utc)
 
@@ -124,13 +173,7 @@ class FHIR:
         questionnaire_response = PPMFHIR.Resources.questionnaire_response(questionnaire, patient, date, form)
 
         # Bundle it into a transaction
-        bundle = PPMFHIR.Resources.bundle([questionnaire_response])
-
-        # Save it
-        if dry:
-            logger.warning('PPM/{}: Dry mode, not persisting responses'.format(study))
-        else:
-            PPMFHIR.fhir_transaction(bundle.as_json())
+        return PPMFHIR.Resources.bundle([questionnaire_response])
 
     @staticmethod
     def submit_asd_individual(patient_email, forms, dry=False):
@@ -142,8 +185,8 @@ class FHIR:
         :type form: [Form]
         :param dry: If True, do not persist questionnaire response to store
         :type dry: bool
-        :return: Whether the operation succeeded or not
-        :rtype: bool
+        :return: The queued submission
+        :rtype: Submission
         """
 
         # Get the questionnaires and patient
@@ -179,6 +222,27 @@ class FHIR:
             else:
                 patient = FHIR.get_demo_patient(patient_email)
 
+        # Build the resources
+        bundle = FHIR.asd_individual_bundle(patient, quiz_questionnaire, signature_questionnaire, forms)
+
+        # Queue it for saving
+        return outbox.enqueue(bundle.as_json(), 'consent', PPM.Study.ASD.value)
+
+    @staticmethod
+    def asd_individual_bundle(patient, quiz_questionnaire, signature_questionnaire, forms):
+        """
+        Builds the transaction of resources recording an individual's ASD consent
+        :param patient: The participant's Patient
+        :type patient: Patient
+        :param quiz_questionnaire: The individual quiz Questionnaire
+        :type quiz_questionnaire: Questionnaire
+        :param signature_questionnaire: The individual signature Questionnaire
+        :type signature_questionnaire: Questionnaire
+        :param forms: The forms filled out for the consent
+        :type forms: dict
+        :return: The transaction Bundle
+        :rtype: Bundle
+        """
         # Get the current timestamp
         timestamp = datetime.datetime.now(datetime.timezone.utc)
 
@@ -213,10 +277,7 @@ class FHIR:
         composition = PPMFHIR.Resources.composition(patient, timestamp, text, PPM.Study.ASD, [consent, contract])
 
         # Bundle it into a transaction
-        bundle = PPMFHIR.Resources.bundle([questionnaire_response, consent, contract, composition, quiz_questionnaire_response])
-
-        # Save it
-        PPMFHIR.fhir_transaction(bundle.as_json())
+        return PPMFHIR.Resources.bundle([questionnaire_response, consent, contract, composition, quiz_questionnaire_response])
 
     @staticmethod
     def submit_asd_guardian(patient_email, forms, dry=False):
@@ -228,8 +289,8 @@ class FHIR:
         :type form: [Form]
         :param dry: If True, do not persist questionnaire response to store
         :type dry: bool
-        :return: Whether the operation succeeded or not
-        :rtype: bool
+        :return: The queued submission
+        :rtype: Submission
         """
 
         # Get the questionnaires and patient
@@ -271,6 +332,34 @@ class FHIR:
             else:
                 patient = FHIR.get_demo_patient(patient_email)
 
+        # Build the resources
+        bundle = FHIR.asd_guardian_bundle(patient, quiz_questionnaire, guardian_signature_questionnaire,
+                                          guardian_reason_questionnaire, ward_signature_questionnaire, forms)
+
+        # Queue it for saving
+        return outbox.enqueue(bundle.as_json(), 'consent', PPM.Study.ASD.value)
+
+    @staticmethod
+    def asd_guardian_bundle(patient, quiz_questionnaire, guardian_signature_questionnaire,
+                            guardian_reason_questionnaire, ward_signature_questionnaire, forms):
+        """
+        Builds the transaction of resources recording a guardian's ASD consent
+        and their ward's assent
+        :param patient: The participant's Patient
+        :type patient: Patient
+        :param quiz_questionnaire: The guardian quiz Questionnaire
+        :type quiz_questionnaire: Questionnaire
+        :param guardian_signature_questionnaire: The guardian signature Questionnaire
+        :type guardian_signature_questionnaire: Questionnaire
+        :param guardian_reason_questionnaire: The guardian explanation Questionnaire
+        :type guardian_reason_questionnaire: Questionnaire
+        :param ward_signature_questionnaire: The ward signature Questionnaire
+        :type ward_signature_questionnaire: Questionnaire
+        :param forms: The forms filled out for the consent
+        :type forms: dict
+        :return: The transaction Bundle
+        :rtype: Bundle
+        """
         # Process the guardian's resources first
 
         # Get the current timestamp
@@ -356,7 +445,7 @@ class FHIR:
         ward_composition = PPMFHIR.Resources.composition(patient, timestamp, ward_text, [ward_contract])
 
         # Bundle it into a transaction
-        bundle = PPMFHIR.Resources.bundle([related_person,
+        return PPMFHIR.Resources.bundle([related_person,
                                quiz_questionnaire_response,
                                guardian_signature_questionnaire_response,
                                guardian_explained_questionnaire_response,
@@ -368,9 +457,6 @@ class FHIR:
                                ward_contract,
                                ward_composition])
 
-        # Save it
-        PPMFHIR.fhir_transaction(bundle.as_json())
-
     @staticmethod
     def get_demo_patient(email):
         """
@@ -392,12 +478,12 @@ class FHIR:
         })
 
     @staticmethod
-    def _query_resources(queries=[]):
+    def _query_resources(queries=[], type='transaction'):
 
         # Build the transaction
         transaction = {
             'resourceType': 'Bundle',
-            'type': 'transaction',
+            'type': type,
             'entry': []
         }
 
@@ -420,14 +506,206 @@ class FHIR:
 
         return bundle
 
+    @staticmethod
+    def get_questionnaire(questionnaire_id):
+        """
+        Returns the Questionnaire for the given ID. Questionnaires are served
+        from the process-local cache and only fetched from FHIR when missing
+        or due for revalidation.
+
+        :param questionnaire_id: The ID of the Questionnaire to fetch
+        :type questionnaire_id: str
+        :raises FHIR.QuestionnaireDoesNotExist: If does not exist
+        :return: The Questionnaire object
+        :rtype: Questionnaire
+        """
+        questionnaire = questionnaires.get(questionnaire_id)
+        if not questionnaire:
+            logger.warning(f"PPM/FHIR: Questionnaire/{questionnaire_id} not found")
+            raise FHIR.QuestionnaireDoesNotExist
+
+        return questionnaire
+
+    @staticmethod
+    def _preflight(patient_email, queries=None, questionnaire_id=None):
+        """
+        Fetches the participant's Patient, the first result of each of the
+        passed searches and, unless it is already cached, the Questionnaire,
+        all in a single FHIR batch request.
+
+        :param patient_email: The email of the participant
+        :type patient_email: str
+        :param queries: Searches to include, keyed by name
+        :type queries: dict
+        :param questionnaire_id: The Questionnaire to fetch, if any
+        :type questionnaire_id: str
+        :return: The Patient, the search results by name and the Questionnaire
+        :rtype: tuple
+        """
+        # Always search for the patient
+        query = {'identifier': f'{PPMFHIR.patient_email_identifier_system}|{patient_email}'}
+        names = ['patient']
+        urls = ['Patient?{}'.format(urlencode(query))]
+        for name, url in (queries or {}).items():
+            names.append(name)
+            urls.append(url)
+
+        # Only fetch the questionnaire if it is not cached
+        questionnaire = questionnaires.peek(questionnaire_id) if questionnaire_id else None
+        if questionnaire_id and not questionnaire:
+            names.append('questionnaire')
+            urls.append(f'Questionnaire/{questionnaire_id}')
+
+        # Run them all as a batch
+        bundle = FHIR._query_resources(urls, type='batch')
+
+        # A short batch must not be mistaken for searches that found nothing
+        if not bundle or not bundle.entry or len(bundle.entry) != len(names):
+            logger.error(f"PPM/FHIR: Preflight batch returned {len(bundle.entry or []) if bundle else 0} of "
+                         f"{len(names)} entries")
+            raise SystemError("Preflight batch was incomplete")
+
+        results = {}
+        complete = True
+        for name, entry in zip(names, bundle.entry):
+
+            # Check the status of each
+            status = entry.response.status if entry.response else None
+            succeeded = bool(status and status.startswith('2') and entry.resource)
+            complete = complete and succeeded
+            if name == 'questionnaire':
+
+                # Cache it for the form and submission to use
+                if succeeded:
+                    results[name] = questionnaires.put(entry.resource.as_json(), entry.response.etag)
+                else:
+                    logger.debug(f"PPM/FHIR: Preflight Questionnaire/{questionnaire_id} returned {status}")
+                    results[name] = None
+
+            elif not succeeded:
+
+                # A failed search must not be mistaken for an empty one
+                logger.error(f"PPM/FHIR: Preflight search '{name}' failed: {status}")
+                raise SystemError(f"Preflight search '{name}' failed")
+
+            else:
+                results[name] = next((e.resource for e in entry.resource.entry or []), None)
+
+        # Share the patient lookup with later requests, once the whole batch succeeded
+        patient = results.pop('patient', None)
+        if complete:
+            patients.put(patient_email, patient.as_json() if patient else None)
+
+        return patient, results, questionnaire or results.pop('questionnaire', None)
+
+    @staticmethod
+    def preflight_questionnaire(questionnaire_id, patient_email):
+        """
+        Checks the participant, their prior responses and the Questionnaire
+        needed to render the form, all in a single FHIR request.
+
+        :param questionnaire_id: The Questionnaire the participant is filling out
+        :type questionnaire_id: str
+        :param patient_email: The email of the participant to check
+        :type patient_email: str
+        :raises FHIR.PatientDoesNotExist: If the Patient does not exist
+        :raises FHIR.QuestionnaireResponseAlreadyExists: If a response exists already
+        :raises FHIR.QuestionnaireDoesNotExist: If the Questionnaire does not exist
+        :return: The fetched resources
+        :rtype: FHIR.Preflight
+        """
+        # Build the search for an existing response
+        query = {
+            'questionnaire': (furl(PPM.fhir_url()) / 'Questionnaire' / questionnaire_id).url,
+            'source:Patient.identifier': f'{PPMFHIR.patient_email_identifier_system}|{patient_email}',
+        }
+
+        patient, results, questionnaire = FHIR._preflight(
+            patient_email,
+            queries={'response': 'QuestionnaireResponse?{}'.format(urlencode(query))},
+            questionnaire_id=questionnaire_id,
+        )
+
+        # Check results in the same order as the individual checks
+        if not patient:
+            logger.warning(
+                f"PPM/{FHIR.obfuscate_email(patient_email)}: "
+                "Patient NOT found"
+            )
+            raise FHIR.PatientDoesNotExist
+
+        if results['response']:
+            logger.warning(
+                f"PPM/{FHIR.obfuscate_email(patient_email)}: "
+                f"QuestionnaireResponse found for '{questionnaire_id}'"
+            )
+            raise FHIR.QuestionnaireResponseAlreadyExists
+
+        if not questionnaire:
+            logger.warning(f"PPM/FHIR: Questionnaire/{questionnaire_id} not found")
+            raise FHIR.QuestionnaireDoesNotExist
+
+        return FHIR.Preflight(patient=patient, response=None, composition=None, questionnaire=questionnaire)
+
+    @staticmethod
+    def preflight_consent(study, patient_email):
+        """
+        Checks the participant and their prior consent for the study in a
+        single FHIR request. The study's consent Questionnaire, if it has one,
+        is fetched along with them so the submission need not fetch it.
+
+        :param study: The study for which the consent would be signed
+        :type study: str
+        :param patient_email: The email of the participant to check
+        :type patient_email: str
+        :raises FHIR.PatientDoesNotExist: If the Patient does not exist
+        :raises FHIR.ConsentAlreadyExists: If the consent exists already
+        :return: The fetched resources
+        :rtype: FHIR.Preflight
+        """
+        # Build the search for an existing consent
+        query = {
+            'type': f'{PPMFHIR.ppm_consent_type_system}|{PPMFHIR.ppm_consent_type_value}',
+            'entry': f'ResearchStudy/{PPM.Study.fhir_id(study)}',
+            'subject:Patient.identifier': f'{PPMFHIR.patient_email_identifier_system}|{patient_email}',
+        }
+
+        # Guardian consents span several questionnaires, only prefetch single ones
+        questionnaire_id = PPM.Questionnaire.consent_questionnaire_for_study(study)
+        if not isinstance(questionnaire_id, str):
+            questionnaire_id = None
+
+        patient, results, questionnaire = FHIR._preflight(
+            patient_email,
+            queries={'composition': 'Composition?{}'.format(urlencode(query))},
+            questionnaire_id=questionnaire_id,
+        )
+
+        # Check results in the same order as the individual checks
+        if not patient:
+            logger.warning(
+                f"PPM/{FHIR.obfuscate_email(patient_email)}: "
+                "Patient NOT found"
+            )
+            raise FHIR.PatientDoesNotExist
+
+        if results['composition']:
+            logger.debug(
+                f"PPM/{study}/{FHIR.obfuscate_email(patient_email)}: "
+                "Consent composition already exists"
+            )
+            raise FHIR.ConsentAlreadyExists
+
+        return FHIR.Preflight(patient=patient, response=None, composition=None, questionnaire=questionnaire)
+
     @staticmethod
     def get_resources(questionnaire_id, patient_email, dry=False):
 
         # Get the questionnaire
-        questionnaire = Questionnaire(PPMFHIR.fhir_read("Questionnaire", questionnaire_id))
+        questionnaire = FHIR.get_questionnaire(questionnaire_id)
 
         # Search for the patient
-        patient = Patient(PPMFHIR.get_patient(patient_email))
+        patient = FHIR.get_patient(patient_email)
 
         # Check for the patient
         if not dry:
@@ -437,12 +715,27 @@ class FHIR:
                     'questionnaires': questionnaire_id,
                 })
                 raise FHIR.PatientDoesNotExist()
+
+            patient = Patient(patient)
         else:
             # In dry mode, use a fake patient
             patient = FHIR.get_demo_patient(patient_email)
 
         return questionnaire, patient
 
+    @staticmethod
+    def get_patient(patient_email):
+        """
+        Returns the Patient resource for the given email. Lookups are served
+        from the process-local patient cache where possible.
+
+        :param patient_email: The email of the participant
+        :type patient_email: str
+        :return: The Patient resource, if it exists
+        :rtype: dict, defaults to None
+        """
+        return patients.get(patient_email)
+
     @staticmethod
     def check_patient(patient_email):
         """
@@ -454,7 +747,7 @@ class FHIR:
         """
 
         # Search for Patient
-        if not PPMFHIR.get_patient(patient_email):
+        if not FHIR.get_patient(patient_email):
             logger.warning(
                 f"PPM/{FHIR.obfuscate_email(patient_email)}: "
                 "Patient NOT found"
@@ -510,6 +803,9 @@ class FHIR:
                 f"QuestionnaireResponse NOT found for '{questionnaire_id}'"
             )
 
+    # The resources fetched by a preflight check
+    Preflight = namedtuple('Preflight', ['patient', 'response', 'composition', 'questionnaire'])
+
     class QuestionnaireDoesNotExist(Exception):
         pass
 
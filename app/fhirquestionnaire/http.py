@@ -0,0 +1,344 @@
+import json
+import socket
+import threading
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+from furl import furl
+
+from ppmutils.ppm import PPM
+from ppmutils.p2md import P2MD as PPMP2MD
+from ppmutils.fhir import FHIR as PPMFHIR, Backend, HAPIFHIR, GCPHealthcareAPI
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter that enables TCP keep-alive on its pooled connections so
+    idle sockets are not silently dropped by load balancers between requests.
+    """
+
+    def __init__(self, keepalive=None, **kwargs):
+        self.keepalive = keepalive
+        super(KeepAliveAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = KeepAliveAdapter.socket_options(self.keepalive)
+
+        super(KeepAliveAdapter, self).init_poolmanager(*args, **kwargs)
+
+    @staticmethod
+    def socket_options(keepalive):
+        from urllib3.connection import HTTPConnection
+
+        options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            options += [
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, keepalive),
+            ]
+
+        return options
+
+
+class SessionRegistry(object):
+    """
+    Holds one pooled `requests.Session` per upstream origin (scheme, host and
+    port) so connections, and their TLS handshakes, are reused across requests.
+    Idempotent requests are retried on connection errors and gateway failures;
+    POST and PATCH are only retried when the connection could not be made.
+    """
+
+    # Methods that are safe to retry after the request may have been sent
+    IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+    # Responses worth retrying an idempotent request for
+    RETRY_STATUSES = frozenset([502, 503, 504])
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    @staticmethod
+    def origin(url):
+        """
+        Returns the origin of the URL that sessions are keyed by
+
+        :param url: The URL
+        :type url: str
+        :return: The scheme, host and port of the URL
+        :rtype: str
+        """
+        url = furl(url)
+        return f'{url.scheme}://{url.host}:{url.port}'
+
+    def session(self, url):
+        """
+        Returns the pooled session for the origin of the given URL, creating it
+        if needed.
+
+        :param url: The URL a request will be made to
+        :type url: str
+        :return: The session for the URL's origin
+        :rtype: requests.Session
+        """
+        origin = SessionRegistry.origin(url)
+        session = self._sessions.get(origin)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(origin)
+                if session is None:
+                    session = self._sessions[origin] = self._create()
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes a request through the pooled session for the URL's origin. Takes
+        the same arguments as `requests.request`.
+
+        :param method: The HTTP method
+        :type method: str
+        :param url: The URL to make the request to
+        :type url: str
+        :return: The response
+        :rtype: requests.Response
+        """
+        kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+        return self.session(url).request(method=method, url=url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
+
+    def warmup(self, urls=None):
+        """
+        Opens a connection to each upstream so the first real requests made by
+        this worker do not pay for the TCP and TLS handshakes. Failures are
+        logged and otherwise ignored.
+
+        :param urls: The URLs to connect to, defaults to the configured upstreams
+        :type urls: list, defaults to None
+        """
+        for url in urls if urls is not None else SessionRegistry.upstreams():
+            try:
+                response = self.request('head', url, allow_redirects=False)
+                logger.debug(f'PPM/HTTP: Warmed up {SessionRegistry.origin(url)} ({response.status_code})')
+
+            except Exception as e:
+                logger.warning(f'PPM/HTTP: Could not warm up {SessionRegistry.origin(url)}: {e}')
+
+    def close(self):
+        """
+        Closes all pooled sessions and their connections
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    @staticmethod
+    def upstreams():
+        """
+        Returns the base URLs of the services this app talks to
+        """
+        urls = [PPM.fhir_url()]
+        try:
+            urls.append(PPMP2MD.service_url())
+        except Exception:
+            logger.debug('PPM/HTTP: P2MD is not configured, skipping')
+
+        return urls
+
+    def _create(self):
+
+        # Retry connection errors for all methods but anything else only for idempotent ones
+        retries = Retry(
+            total=settings.HTTP_RETRIES,
+            backoff_factor=settings.HTTP_RETRY_BACKOFF,
+            status_forcelist=SessionRegistry.RETRY_STATUSES,
+            allowed_methods=SessionRegistry.IDEMPOTENT_METHODS,
+            raise_on_status=False,
+        )
+        adapter = KeepAliveAdapter(
+            keepalive=settings.HTTP_KEEPALIVE,
+            pool_connections=1,
+            pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            pool_block=settings.HTTP_POOL_BLOCK,
+            max_retries=retries,
+        )
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+
+# The shared sessions for this process
+sessions = SessionRegistry()
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data body that streams the form fields followed by one
+    file straight from a buffer. It is read in slices of memoryviews, so the
+    file is never copied into an encoded body the way `requests` does with
+    `files=`, and its length is known up front so it is not sent chunked.
+    The file comes last, as S3 presigned POSTs require.
+    """
+
+    def __init__(self, fields, name, content, filename=None, content_type=None):
+        self.boundary = uuid.uuid4().hex
+
+        # Encode everything but the file itself
+        head = ''.join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+            for key, value in fields.items()
+        )
+        head += f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename or name}"\r\n'
+        head += f'Content-Type: {content_type}\r\n\r\n' if content_type else '\r\n'
+        tail = f'\r\n--{self.boundary}--\r\n'
+
+        self._parts = [memoryview(head.encode('utf-8')), memoryview(content).cast('B'), memoryview(tail.encode('utf-8'))]
+        self._length = sum(part.nbytes for part in self._parts)
+        self._part = 0
+        self._offset = 0
+
+    @property
+    def content_type(self):
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        """
+        Returns up to `size` bytes of the body as a memoryview, or all of the
+        current part if `size` is negative. Returns b'' once exhausted.
+        """
+        while self._part < len(self._parts):
+            part = self._parts[self._part]
+            if self._offset < part.nbytes:
+                end = part.nbytes if size is None or size < 0 else min(self._offset + size, part.nbytes)
+                chunk = part[self._offset:end]
+                self._offset = end
+                return chunk
+
+            self._part += 1
+            self._offset = 0
+
+        return b''
+
+
+class PooledHAPIFHIR(HAPIFHIR):
+    """
+    Sends HAPI-FHIR requests through the pooled sessions
+    """
+
+    def request(self, method, url, **kwargs):
+        return sessions.request(method, url, **kwargs)
+
+
+class PooledGCPHealthcareAPI(GCPHealthcareAPI):
+    """
+    Sends GCP Healthcare API requests through the pooled sessions. The parent
+    class still manages the OAuth token; only its headers are used here.
+    """
+
+    def request(self, method, url, **kwargs):
+
+        # Merge the authorization headers with any passed
+        headers = dict(self.session.headers, **(kwargs.pop('headers', None) or {}))
+        response = sessions.request(method, url, headers=headers, **kwargs)
+
+        # Check for a token reset
+        if response is not None and response.status_code in [401, 403]:
+            headers.update(self.session.headers)
+            response = sessions.request(method, url, headers=headers, **kwargs)
+
+        return response
+
+
+def install():
+    """
+    Routes ppmutils' FHIR requests through the pooled sessions. Backends that
+    cannot be pooled are left as they are.
+    """
+    backend = Backend.instance(url=PPM.fhir_url())
+    if type(backend) is HAPIFHIR:
+        PPMFHIR._backend = PooledHAPIFHIR()
+    elif type(backend) is GCPHealthcareAPI:
+        PPMFHIR._backend = PooledGCPHealthcareAPI()
+    else:
+        logger.debug(f'PPM/HTTP: FHIR backend "{type(backend).__name__}" does not support pooling')
+
+
+class P2MD(PPMP2MD):
+    """
+    The ppmutils P2MD client with the requests made by this app sent through
+    the pooled sessions.
+    """
+
+    @classmethod
+    def headers(cls, request=None, content_type="application/json"):
+
+        # Without a user's JWT, only send the service token if one is set
+        if not (request and cls.get_jwt(request)) and not settings.P2MD_AUTH_TOKEN:
+            raise SystemError('No request with JWT and no P2MD_AUTH_TOKEN set, cannot authenticate with P2MD')
+
+        return super(P2MD, cls).headers(request, content_type)
+
+    @classmethod
+    def post(cls, request=None, path="/", data=None, raw=False):
+        try:
+            response = sessions.post(cls._build_url(path), headers=cls.headers(request), data=json.dumps(data or {}))
+
+            return response if raw else response.json()
+
+        except Exception as e:
+            logger.exception("{} error: {}".format(cls.service, e), exc_info=True, extra={
+                "data": data,
+                "path": path,
+            })
+
+        return None
+
+    @classmethod
+    def patch(cls, request=None, path="/", data=None, raw=False):
+        try:
+            response = sessions.request('patch', cls._build_url(path), headers=cls.headers(request),
+                                        data=json.dumps(data or {}))
+
+            return response if raw else response.ok
+
+        except Exception as e:
+            logger.exception("{} error: {}".format(cls.service, e), exc_info=True, extra={
+                "data": data,
+                "path": path,
+            })
+
+        return False
+
+    @classmethod
+    def delete(cls, request=None, path="/", data=None, raw=False):
+        try:
+            response = sessions.request('delete', cls._build_url(path), headers=cls.headers(request),
+                                        data=json.dumps(data or {}))
+
+            return response if raw else response.ok
+
+        except Exception as e:
+            logger.exception("{} error: {}".format(cls.service, e), exc_info=True, extra={
+                "path": path,
+            })
+
+        return False
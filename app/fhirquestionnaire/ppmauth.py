@@ -1,6 +1,7 @@
 from django.core.exceptions import PermissionDenied
 from rest_framework.permissions import BasePermission
-from ppmutils.fhir import FHIR
+
+from fhirquestionnaire.cache import patients
 
 from dbmi_client.authz import is_admin
 
@@ -14,8 +15,15 @@ def _ppm_id_for_email(request, email):
     will be used to confirm requests by a user are only operating on resources owned by that user.
     :return: str
     """
-    # Get the ID
-    ppm_id = FHIR.get_ppm_id(email=email)
+    # Get the ID, denying the request if FHIR could not be searched
+    try:
+        ppm_id = patients.get_id(email)
+    except Exception as e:
+        logger.exception(f'PPM ID lookup error: {e}', exc_info=True, extra={
+            'request': request,
+        })
+        return None
+
     if ppm_id:
         return ppm_id
     else:
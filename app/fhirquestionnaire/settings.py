@@ -52,6 +52,7 @@ INSTALLED_APPS = [
     'crispy_forms',
     'health_check',
     'dbmi_client',
+    'rest_framework',
     'api',
     'pdf',
     'bootstrap_datepicker_plus',
@@ -191,6 +192,83 @@ REST_FRAMEWORK = {
 RETURN_URL = get_str("RETURN_URL", required=True)
 PPM_P2MD_URL = get_str("PPM_P2MD_URL", required=True)
 
+# Token for P2MD calls made without a user's JWT, e.g. by render jobs resumed after a restart
+P2MD_AUTH_TOKEN = get_str("P2MD_AUTH_TOKEN", required=False)
+
+# Seconds a cached Questionnaire is served before being revalidated with FHIR
+QUESTIONNAIRE_CACHE_TTL = get_int("QUESTIONNAIRE_CACHE_TTL", default=300)
+
+# Size and lifetimes (seconds) of cached email to Patient lookups
+PATIENT_CACHE_SIZE = get_int("PATIENT_CACHE_SIZE", default=1024)
+PATIENT_CACHE_TTL = get_int("PATIENT_CACHE_TTL", default=60)
+PATIENT_CACHE_NEGATIVE_TTL = get_int("PATIENT_CACHE_NEGATIVE_TTL", default=10)
+
+# Outbound HTTP connection pooling, per upstream host
+HTTP_POOL_MAXSIZE = get_int("HTTP_POOL_MAXSIZE", default=10)
+HTTP_POOL_BLOCK = get_bool("HTTP_POOL_BLOCK", default=False)
+HTTP_KEEPALIVE = get_int("HTTP_KEEPALIVE", default=60)
+HTTP_RETRIES = get_int("HTTP_RETRIES", default=3)
+HTTP_RETRY_BACKOFF = get_float("HTTP_RETRY_BACKOFF", default=0.3)
+HTTP_CONNECT_TIMEOUT = get_int("HTTP_CONNECT_TIMEOUT", default=5)
+HTTP_READ_TIMEOUT = get_int("HTTP_READ_TIMEOUT", default=60)
+HTTP_WARMUP = get_bool("HTTP_WARMUP", default=True)
+
+# Serve the submission views asynchronously (requires an ASGI server) and the
+# number of threads blocking FHIR calls are handed off to
+ASYNC_VIEWS = get_bool("ASYNC_VIEWS", default=False)
+FHIR_ASYNC_WORKERS = get_int("FHIR_ASYNC_WORKERS", default=20)
+
+# Submission outbox: whether this process runs a writer, how often it polls,
+# how long a delivery may take, and the retry schedule before dead-lettering
+OUTBOX_WORKER = get_bool("OUTBOX_WORKER", default=True)
+OUTBOX_BATCH_SIZE = get_int("OUTBOX_BATCH_SIZE", default=50)
+OUTBOX_POLL_INTERVAL = get_int("OUTBOX_POLL_INTERVAL", default=5)
+OUTBOX_LEASE = get_int("OUTBOX_LEASE", default=120)
+OUTBOX_MAX_ATTEMPTS = get_int("OUTBOX_MAX_ATTEMPTS", default=8)
+OUTBOX_BACKOFF = get_int("OUTBOX_BACKOFF", default=5)
+OUTBOX_MAX_BACKOFF = get_int("OUTBOX_MAX_BACKOFF", default=600)
+
+# Days delivered submissions are kept before they are deleted
+OUTBOX_RETENTION = get_int("OUTBOX_RETENTION", default=7)
+
+# Milliseconds the writer waits for questionnaire responses to group into one
+# FHIR batch, and the most it puts in a batch
+OUTBOX_GROUP_WINDOW = get_int("OUTBOX_GROUP_WINDOW", default=30)
+OUTBOX_GROUP_SIZE = get_int("OUTBOX_GROUP_SIZE", default=20)
+
+# Seconds the consent PDF render waits for the consent to reach FHIR
+OUTBOX_RENDER_WAIT = get_int("OUTBOX_RENDER_WAIT", default=120)
+
+# Consent renders, past the queue size background renders overflow to render jobs
+RENDER_WORKERS = get_int("RENDER_WORKERS", default=4)
+RENDER_QUEUE_SIZE = get_int("RENDER_QUEUE_SIZE", default=50)
+
+# Bulk consent render jobs, which may use this many of the render workers
+RENDER_JOB_WORKERS = get_int("RENDER_JOB_WORKERS", default=max(1, RENDER_WORKERS - 1))
+RENDER_JOB_LEASE = get_int("RENDER_JOB_LEASE", default=600)
+RENDER_JOB_RESUME = get_bool("RENDER_JOB_RESUME", default=True)
+
+# A directory shared by every worker process to hold their per-participant render lock files, if more than one
+RENDER_LOCK_DIR = get_str("RENDER_LOCK_DIR", default=None)
+
+# Consent admin endpoints list participants from a local snapshot synced with FHIR, rebuilt when older than this
+PARTICIPANT_SNAPSHOT_MAX_AGE = get_int("PARTICIPANT_SNAPSHOT_MAX_AGE", default=86400)
+
+# Send the consent PDF's MD5 with its upload for S3 to verify, needs P2MD's upload policy to allow it
+CONSENT_UPLOAD_CONTENT_MD5 = get_bool("CONSENT_UPLOAD_CONTENT_MD5", default=False)
+
+# PDF rendering, the rest of the options are in pdf/settings.py. The WeasyPrint backend
+# (pdf.backends.WeasyPrintBackend) is opt-in and needs "weasyprint" and Pango installed
+PDF_GENERATOR = {
+    'BACKEND': get_str("PDF_BACKEND", default='pdf.backends.PhantomJSBackend'),
+    'CACHE_MAX_SIZE': get_int("PDF_CACHE_MAX_SIZE", default=256) * 1024 * 1024,
+    'ASSEMBLED_TEMPLATES': ['consent/pdf/consent.html'] if get_bool("PDF_ASSEMBLE", default=True) else [],
+    'ASSET_ALIASES': {
+        # Serve the consent templates' Bootstrap from the copy shipped with DRF (3.4.1, a drop-in for 3.3.7)
+        'https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css': 'rest_framework/css/bootstrap.min.css',
+    },
+}
+
 # Crispy forms
 CRISPY_TEMPLATE_PACK = 'bootstrap3'
 
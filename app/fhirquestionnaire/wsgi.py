@@ -14,3 +14,19 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fhirquestionnaire.settings")
 
 application = get_wsgi_application()
+
+# Open connections to upstreams before this worker takes requests
+from django.conf import settings  # noqa: E402
+from fhirquestionnaire.http import sessions  # noqa: E402
+from api.outbox import outbox  # noqa: E402
+from api.jobs import jobs  # noqa: E402
+
+if settings.HTTP_WARMUP:
+    sessions.warmup()
+
+# Deliver any submissions left queued by earlier workers
+outbox.start()
+
+# Pick up bulk consent renders left unfinished by earlier workers
+if settings.RENDER_JOB_RESUME:
+    jobs.resume()
@@ -0,0 +1,42 @@
+import functools
+import io
+
+from .cache import PDFBuffer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def available():
+    """
+    Returns whether PDFs can be merged, i.e. whether "pypdf" is installed
+    """
+    try:
+        import pypdf  # noqa: F401
+        return True
+
+    except ImportError:
+        logger.warning('PDF/Assembly: "pypdf" is not installed, assembled templates will be rendered in full')
+        return False
+
+
+def merge_pdfs(parts):
+    """
+    Concatenates the pages of the given PDFs into one.
+
+    :param parts: The PDFs, in order
+    :type parts: list
+    :return: The merged PDF
+    :rtype: bytes
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(PdfReader(io.BytesIO(part)))
+
+    output = PDFBuffer()
+    writer.write(output)
+
+    return output.getvalue()
@@ -0,0 +1,131 @@
+import base64
+import mimetypes
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+
+from .settings import pdf_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AssetInliner(object):
+    """
+    Inlines the stylesheets and images referenced by HTML about to be rendered
+    so the renderer makes no network requests. References are resolved with
+    the staticfiles finders, either by their STATIC_URL path or through the
+    ASSET_ALIASES setting that maps remote URLs, e.g. a CDN's, to a local
+    static path. Stylesheets become <style> blocks, with their own url()
+    references pointed at the local files, and images become data URIs.
+    Encoded assets are cached for the life of the process.
+    """
+
+    # Stylesheet links and image sources
+    LINK = re.compile(r'<link\b[^>]*\brel=["\']stylesheet["\'][^>]*>', re.IGNORECASE)
+    HREF = re.compile(r'\bhref=["\']([^"\']+)["\']', re.IGNORECASE)
+    IMG = re.compile(r'(<img\b[^>]*\bsrc=)(["\'])([^"\']+)\2', re.IGNORECASE)
+    CSS_URL = re.compile(r'url\(\s*(["\']?)([^)"\']+)\1\s*\)')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._assets = {}
+
+    def inline(self, html):
+        """
+        Returns the HTML with every local asset it references inlined. Assets
+        that cannot be found locally are left as they are.
+
+        :param html: The HTML
+        :type html: str
+        :return: The HTML with assets inlined
+        :rtype: str
+        """
+        html = AssetInliner.LINK.sub(self._inline_stylesheet, html)
+        return AssetInliner.IMG.sub(self._inline_image, html)
+
+    def clear(self):
+        with self._lock:
+            self._assets.clear()
+
+    def _inline_stylesheet(self, match):
+        href = AssetInliner.HREF.search(match.group(0))
+        css = self._asset(href.group(1), self._encode_stylesheet) if href else None
+
+        return f'<style>{css}</style>' if css is not None else match.group(0)
+
+    def _inline_image(self, match):
+        uri = self._asset(match.group(3), self._encode_image)
+
+        return f'{match.group(1)}{match.group(2)}{uri}{match.group(2)}' if uri else match.group(0)
+
+    def _asset(self, url, encode):
+        try:
+            return self._assets[url]
+
+        except KeyError:
+            pass
+
+        # Encode it once, remembering misses as well
+        asset = None
+        path = AssetInliner.find(url)
+        try:
+            asset = encode(path) if path else None
+            if not path:
+                logger.debug(f'PDF/Assets: No local copy of {url}')
+
+        except (OSError, ValueError) as e:
+            logger.warning(f'PDF/Assets: Could not inline {url}: {e}')
+
+        with self._lock:
+            self._assets[url] = asset
+
+        return asset
+
+    @staticmethod
+    def find(url):
+        """
+        Returns the local path of the asset at the URL, if there is one
+
+        :param url: The URL of the asset
+        :type url: str
+        :return: The absolute path of the asset or None
+        :rtype: str
+        """
+        static_path = pdf_settings.ASSET_ALIASES.get(url)
+        if static_path is None and url.startswith(settings.STATIC_URL):
+            static_path = url[len(settings.STATIC_URL):].split('?')[0].split('#')[0]
+
+        return finders.find(static_path) if static_path else None
+
+    @staticmethod
+    def _encode_stylesheet(path):
+        with open(path, encoding='utf-8') as f:
+            css = f.read()
+
+        # Point relative references, e.g. fonts, at the files next to it
+        directory = os.path.dirname(path)
+
+        def local(match):
+            reference = match.group(2)
+            if re.match(r'^([a-z]+:|/|#)', reference, re.IGNORECASE):
+                return match.group(0)
+
+            target = os.path.normpath(os.path.join(directory, reference.split('?')[0].split('#')[0]))
+            suffix = reference[len(reference.split('?')[0].split('#')[0]):]
+            return f'url("file://{target}{suffix}")'
+
+        return AssetInliner.CSS_URL.sub(local, css)
+
+    @staticmethod
+    def _encode_image(path):
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        with open(path, 'rb') as f:
+            return f'data:{mimetype};base64,{base64.b64encode(f.read()).decode("ascii")}'
+
+
+# The inlined assets for this process
+assets = AssetInliner()
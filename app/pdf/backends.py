@@ -0,0 +1,126 @@
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .cache import PDFBuffer
+from .settings import pdf_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PDFBackend(object):
+    """
+    Renders HTML to PDF. Backends are selected with the PDF_GENERATOR
+    'BACKEND' setting and must be safe to share across threads.
+    """
+
+    # A short name for logs and benchmarks
+    name = None
+
+    def render(self, html, paperformat='A4', zoom=1, base_url=None):
+        """
+        Renders the HTML to a PDF.
+
+        :param html: The HTML to render
+        :type html: str
+        :param paperformat: The paper format, e.g. 'A4' or 'Letter', or 'width*height'
+        :type paperformat: str
+        :param zoom: The zoom factor
+        :type zoom: float
+        :param base_url: The URL relative references in the HTML resolve against
+        :type base_url: str
+        :return: The PDF
+        :rtype: bytes
+        """
+        raise NotImplementedError
+
+
+class PhantomJSBackend(PDFBackend):
+    """
+    Renders with PhantomJS, on the pool of persistent workers where possible
+    """
+    name = 'phantomjs'
+
+    def render(self, html, paperformat='A4', zoom=1, base_url=None):
+        from .generators import PDFGenerator
+
+        return PDFGenerator(html, paperformat=paperformat, zoom=zoom).get_data()
+
+
+class WeasyPrintBackend(PDFBackend):
+    """
+    Renders in-process with WeasyPrint, without spawning anything. It lays
+    out with its own CSS engine, which handles the simple, text-heavy consent
+    documents well but does not run JavaScript.
+
+    This backend is opt-in and is not installed with the app or its image:
+    it needs the "weasyprint" package and the Pango libraries it renders with
+    (e.g. Debian's libpango-1.0-0 and libpangoft2-1.0-0) installed alongside.
+    """
+    name = 'weasyprint'
+
+    def __init__(self):
+        try:
+            import weasyprint
+
+        except (ImportError, OSError) as e:
+
+            # OSError is raised when the package is installed but its libraries are not
+            raise ImproperlyConfigured('The WeasyPrint PDF backend is opt-in and needs the "weasyprint" package and '
+                                       f'the Pango libraries installed: {e}')
+
+        self.weasyprint = weasyprint
+        self._stylesheets = {}
+
+    def render(self, html, paperformat='A4', zoom=1, base_url=None):
+        document = self.weasyprint.HTML(string=html, base_url=base_url or pdf_settings.DEFAULT_TEMP_DIR + os.sep)
+
+        # Hash it as WeasyPrint writes it out
+        buffer = PDFBuffer()
+        document.write_pdf(buffer, stylesheets=[self._page_stylesheet(paperformat)], zoom=zoom)
+
+        return buffer.getvalue()
+
+    def _page_stylesheet(self, paperformat):
+
+        # Match the page setup of rasterize.js
+        stylesheet = self._stylesheets.get(paperformat)
+        if stylesheet is None:
+            size = paperformat.split('*')
+            if len(size) == 2:
+                css = f'@page {{ size: {size[0]} {size[1]}; margin: 0 }}'
+            else:
+                css = f'@page {{ size: {paperformat} portrait; margin: 1.5cm }}'
+
+            stylesheet = self._stylesheets[paperformat] = self.weasyprint.CSS(string=css)
+
+        return stylesheet
+
+
+# Backends by their dotted path
+_backends = {}
+_lock = threading.Lock()
+
+
+def get_backend(path=None):
+    """
+    Returns the shared instance of the given backend, defaulting to the one
+    configured in the PDF_GENERATOR 'BACKEND' setting.
+
+    :param path: The dotted path of the backend class
+    :type path: str
+    :return: The backend
+    :rtype: PDFBackend
+    """
+    path = path or pdf_settings.BACKEND
+    backend = _backends.get(path)
+    if backend is None:
+        with _lock:
+            backend = _backends.get(path)
+            if backend is None:
+                backend = _backends[path] = import_string(path)()
+
+    return backend
@@ -0,0 +1,221 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+
+from .settings import pdf_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RenderedPDF(bytes):
+    """
+    A rendered PDF along with the MD5 it was hashed to as it was written
+    """
+
+    def __new__(cls, data, md5):
+        pdf = super().__new__(cls, data)
+        pdf.md5 = md5
+        return pdf
+
+
+class PDFBuffer(io.BytesIO):
+    """
+    Collects a PDF as a renderer writes it out, hashing each chunk as it is
+    written, so the MD5 needed for the upload is ready along with the PDF
+    rather than taking another pass over it. It must only be appended to.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._md5 = hashlib.md5()
+
+    def write(self, chunk):
+        self._md5.update(chunk)
+        return super().write(chunk)
+
+    def getvalue(self):
+        """
+        :return: The PDF, along with its MD5
+        :rtype: RenderedPDF
+        """
+        return RenderedPDF(super().getvalue(), self._md5.hexdigest())
+
+
+class RenderCache(object):
+    """
+    A content-addressed, size-bounded cache of rendered PDFs on local disk.
+    Entries are keyed by a hash of everything that determines the PDF, i.e.
+    the rendered HTML, backend and render options, and store the PDF along
+    with its MD5 so identical re-renders skip both rendering and hashing.
+    The least recently used entries are evicted once the cache outgrows
+    CACHE_MAX_SIZE; a CACHE_MAX_SIZE of 0 disables it.
+
+    Consent PDFs hold participants' details, so the cache directory is kept
+    private to the user running the app (0700, with 0600 files) and is not
+    used at all if it belongs to anyone else, e.g. if someone else created it
+    first in a shared temp directory.
+    """
+
+    def __init__(self, directory=None, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return self._directory or pdf_settings.CACHE_DIR
+
+    @property
+    def max_size(self):
+        return self._max_size if self._max_size is not None else pdf_settings.CACHE_MAX_SIZE
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def key(html, backend, options=None):
+        """
+        Returns the cache key for rendering the HTML with the given backend and options
+
+        :param html: The HTML to render
+        :type html: str
+        :param backend: The dotted path of the backend
+        :type backend: str
+        :param options: The render options
+        :type options: dict
+        :return: The key
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([backend, options or {}], sort_keys=True, default=str).encode('utf-8'))
+        digest.update(html.encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached PDF and its MD5 for the key, if any
+
+        :param key: The cache key
+        :type key: str
+        :return: The PDF and its MD5, or None
+        :rtype: (bytes, str)
+        """
+        if not self.enabled or not self._private():
+            return None
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                md5 = f.readline().strip().decode('ascii')
+                data = f.read()
+
+            # Mark it as recently used
+            os.utime(path)
+
+        except OSError:
+            return None
+
+        logger.debug(f'PDF/Cache: Hit {key[:12]}')
+        return data, md5
+
+    def put(self, key, data):
+        """
+        Stores the PDF under the key, evicting old entries as needed, and
+        returns its MD5, reusing the one hashed as it was rendered if any.
+
+        :param key: The cache key
+        :type key: str
+        :param data: The PDF
+        :type data: RenderedPDF or bytes
+        :return: The MD5 of the PDF
+        :rtype: str
+        """
+        md5 = getattr(data, 'md5', None) or hashlib.md5(data).hexdigest()
+        if not self.enabled:
+            return md5
+
+        try:
+            if not self._private():
+                return md5
+
+            # Write it aside and move it in place so readers never see part of it
+            temp = os.path.join(self.directory, f'.{uuid.uuid4().hex}.tmp')
+            with os.fdopen(os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+                f.write(md5.encode('ascii') + b'\n')
+                f.write(data)
+            os.replace(temp, self._path(key))
+
+            self._evict()
+
+        except OSError as e:
+            logger.warning(f'PDF/Cache: Could not store {key[:12]}: {e}')
+
+        return md5
+
+    def clear(self):
+        """
+        Removes all cached PDFs
+        """
+        for entry in self._entries():
+            self._remove(entry.path)
+
+    def _private(self):
+        """
+        Creates the cache directory if need be and returns whether only this
+        user can use it.
+        """
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            info = os.stat(self.directory)
+            if info.st_uid != os.getuid():
+                logger.warning(f'PDF/Cache: {self.directory} belongs to another user, not caching')
+                return False
+
+            # Tighten it up if it was created or loosened elsewhere
+            if info.st_mode & 0o077:
+                os.chmod(self.directory, 0o700)
+
+            return True
+
+        except OSError as e:
+            logger.warning(f'PDF/Cache: Could not use {self.directory}: {e}')
+            return False
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def _entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.pdf')]
+        except OSError:
+            return []
+
+    def _evict(self):
+        with self._lock:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._entries()]
+            size = sum(entry[1] for entry in entries)
+
+            # Drop the least recently used until it fits
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+
+                self._remove(path)
+                size -= entry_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# The render cache for this process
+render_cache = RenderCache()
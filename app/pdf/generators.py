@@ -1,62 +1,108 @@
 import subprocess
 import os
+import json
 import random
 
+from .cache import PDFBuffer
 from .settings import pdf_settings
+from .metrics import metrics
+from .pool import pool, RendererError, RenderTimeout, RendererBusy
 from django.http import HttpResponse
 from django.core.files.base import ContentFile
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 class PDFGenerator(object):
+    """
+    Renders HTML to PDF entirely in memory: the HTML is handed to PhantomJS
+    over a pipe and the PDF bytes come back the same way, so no temporary
+    files are written or left behind. Relative references in the HTML resolve
+    against `temp_dir`, as they did when the HTML was written there.
+    """
     def __init__(self, html, paperformat='A4', zoom=1, script=pdf_settings.DEFAULT_RASTERIZE_SCRIPT,
                  temp_dir=pdf_settings.DEFAULT_TEMP_DIR):
         self.script = script
         self.temp_dir = temp_dir
         self.html = html
-        self.html_file = self.__get_html_filepath()
-        self.pdf_file = self.__get_pdf_filepath()
         self.paperformat = paperformat
         self.zoom = zoom
         self.pdf_data = None
 
-        self.__write_html()
         self.__generate()
-        self.__set_pdf_data()
-        self.__remove_source_file()
 
-    def __write_html(self):
-        with open(self.html_file, 'w') as f:
-            f.write(self.html)
-            f.close()
+    @property
+    def base_url(self):
+        return 'file://{}/'.format(os.path.abspath(self.temp_dir))
+
+    def __generate(self):
+        """
+        Renders on a pooled PhantomJS worker, falling back to spawning one for
+        custom scripts or when the pool is disabled (RENDERER_POOL_SIZE = 0)
+        """
+        if self.script == pdf_settings.DEFAULT_RASTERIZE_SCRIPT and pdf_settings.RENDERER_POOL_SIZE > 0:
+            try:
+                self.pdf_data = pool.render(self.html, self.paperformat, self.zoom, base=self.base_url)
+                return
+
+            except RenderTimeout:
 
-    def __get_html_filepath(self):
-        return os.path.join(self.temp_dir, '{}.html'.format(PDFGenerator.get_random_filename(25)))
+                # The page itself is likely what hangs, so a spawned renderer would too
+                raise
 
-    def __get_pdf_filepath(self):
-        return os.path.join(self.temp_dir, '{}.pdf'.format(PDFGenerator.get_random_filename(25)))
+            except RendererBusy:
 
-    def __generate(self):
+                # Spawning more PhantomJS processes would only add to the load that saturated the pool
+                raise
+
+            except RendererError as e:
+                logger.warning(f'PDF/Renderer: Pooled render failed, spawning instead: {e}')
+
+        self.pdf_data = self.__spawn()
+
+    def __spawn(self):
         """
-        call the following command:
-            phantomjs rasterize.js URL filename [paperwidth*paperheight|paperformat] [zoom]
+        call the following command, passing the HTML on stdin and reading the PDF from stdout:
+            phantomjs rasterize.js - - [paperwidth*paperheight|paperformat] [zoom]
         """
         phantomjs_env = os.environ.copy()
         phantomjs_env["OPENSSL_CONF"] = "/etc/openssl/"
+        phantomjs_env["PDF_BASE_URL"] = self.base_url
+        phantomjs_env["PDF_READY_TIMEOUT"] = str(pdf_settings.RENDERER_READY_TIMEOUT * 1000)
         command = [
             pdf_settings.PHANTOMJS_BIN_PATH,
             '--ssl-protocol=any',
             '--ignore-ssl-errors=yes',
             self.script,
-            self.html_file,
-            self.pdf_file,
+            '-',
+            '-',
             self.paperformat,
             str(self.zoom)
         ]
-        return subprocess.call(command, env=phantomjs_env)
+        try:
+            result = subprocess.run(command, input=self.html.encode('utf-8'), stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=phantomjs_env, timeout=pdf_settings.RENDERER_TIMEOUT)
+
+        except subprocess.TimeoutExpired:
+            metrics.failed(timeout=True)
+            raise RenderTimeout(f'PhantomJS timed out after {pdf_settings.RENDERER_TIMEOUT}s and was killed')
+
+        if result.returncode != 0 or not result.stdout:
+            metrics.failed()
+            raise RendererError(f'PhantomJS exited with {result.returncode}: '
+                                f'{result.stderr.decode("utf-8", "replace")[:2000]}')
 
-    def __set_pdf_data(self):
-        with open(self.pdf_file, "rb") as pdf:
-            self.pdf_data = pdf.read()
+        # The script reports its timings on the last line of stderr
+        try:
+            metrics.record(json.loads(result.stderr.decode('utf-8').strip().splitlines()[-1]))
+        except (ValueError, IndexError):
+            metrics.record({})
+
+        buffer = PDFBuffer()
+        buffer.write(result.stdout)
+
+        return buffer.getvalue()
 
     def get_content_file(self, filename):
         return ContentFile(self.pdf_data, name=filename)
@@ -65,15 +111,12 @@ class PDFGenerator(object):
         return self.pdf_data
 
     def get_http_response(self, filename):
+
+        # The response wraps the rendered bytes as they are, without a copy
         response = HttpResponse(self.pdf_data, content_type='application/pdf')
         response['Content-Disposition'] = 'attachment; filename="{}.pdf"'.format(filename)
         return response
 
-    def __remove_source_file(self):
-        html_rm = subprocess.call(['rm', self.html_file])
-        pdf_rm = subprocess.call(['rm', self.pdf_file])
-        return html_rm & pdf_rm
-
     @staticmethod
     def get_random_filename(nb=50):
         choices = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
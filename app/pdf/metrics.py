@@ -0,0 +1,76 @@
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RenderMetrics(object):
+    """
+    Process-wide counters for PDF renders: how many succeeded, failed or hit
+    their deadline, how many were rendered before the page reported ready,
+    and the total and slowest durations of each phase reported by the
+    renderer (page load, layout and render) in milliseconds.
+    """
+
+    PHASES = ('load', 'layout', 'render')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = {'renders': 0, 'failures': 0, 'timeouts': 0, 'not_ready': 0}
+            self._totals = dict.fromkeys(RenderMetrics.PHASES, 0)
+            self._maximums = dict.fromkeys(RenderMetrics.PHASES, 0)
+
+    def record(self, result):
+        """
+        Records a completed render from the result the renderer reported
+
+        :param result: The renderer's result, with 'ready' and 'timings'
+        :type result: dict
+        """
+        timings = result.get('timings') or {}
+        with self._lock:
+            self._counts['renders'] += 1
+            if result.get('ready') is False:
+                self._counts['not_ready'] += 1
+
+            for phase in RenderMetrics.PHASES:
+                duration = timings.get(phase) or 0
+                self._totals[phase] += duration
+                self._maximums[phase] = max(self._maximums[phase], duration)
+
+        logger.debug(f'PDF/Renderer: Rendered in {sum(timings.values()) if timings else "?"} ms', extra={
+            'timings': timings, 'ready': result.get('ready'),
+        })
+
+    def failed(self, timeout=False):
+        """
+        Records a render that failed, or that was killed at its deadline
+
+        :param timeout: Whether it hit its deadline
+        :type timeout: bool
+        """
+        with self._lock:
+            self._counts['timeouts' if timeout else 'failures'] += 1
+
+    def stats(self):
+        """
+        Returns the counters along with the mean and slowest duration of each phase
+
+        :rtype: dict
+        """
+        with self._lock:
+            renders = self._counts['renders']
+            stats = dict(self._counts)
+            for phase in RenderMetrics.PHASES:
+                stats[f'{phase}_mean_ms'] = self._totals[phase] / renders if renders else 0
+                stats[f'{phase}_max_ms'] = self._maximums[phase]
+
+        return stats
+
+
+# The render metrics for this process
+metrics = RenderMetrics()
@@ -0,0 +1,346 @@
+import contextlib
+import json
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+from .cache import PDFBuffer
+from .metrics import metrics
+from .settings import pdf_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The size of the pieces a rendered PDF is read and hashed in
+CHUNK_SIZE = 64 * 1024
+
+
+class RendererError(Exception):
+    pass
+
+
+class RenderTimeout(RendererError):
+    """
+    The render did not finish by its deadline and the renderer was killed
+    """
+    pass
+
+
+class RendererBusy(RendererError):
+    """
+    Every renderer stayed busy past the deadline, so the render was not attempted
+    """
+    pass
+
+
+@contextlib.contextmanager
+def output_buffer():
+    """
+    Yields a path a renderer can write a PDF to and a callable returning what
+    was written, hashed as it is read (see `PDFBuffer`). On Linux this is an anonymous in-memory file that the renderer
+    reaches through /proc, so nothing touches the disk; elsewhere it falls
+    back to a temporary file that is removed on exit.
+    """
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('pdf')
+        path = f'/proc/{os.getpid()}/fd/{fd}'
+    else:
+        fd, path = tempfile.mkstemp(suffix='.pdf', dir=pdf_settings.DEFAULT_TEMP_DIR)
+
+    def read():
+        buffer = PDFBuffer()
+        while True:
+            chunk = os.pread(fd, CHUNK_SIZE, buffer.tell())
+            if not chunk:
+                return buffer.getvalue()
+
+            buffer.write(chunk)
+
+    try:
+        yield path, read
+    finally:
+        os.close(fd)
+        if not path.startswith('/proc/'):
+            os.remove(path)
+
+
+class Renderer(object):
+    """
+    A long-lived PhantomJS process running the worker script, taking one
+    render job at a time over its stdin and answering on its stdout.
+    """
+
+    def __init__(self):
+        self.jobs = 0
+        self.result = None
+        self.last_used = time.monotonic()
+        self._ids = 0
+        self._lines = queue.Queue()
+
+        # Start it
+        phantomjs_env = os.environ.copy()
+        phantomjs_env["OPENSSL_CONF"] = "/etc/openssl/"
+        self.process = subprocess.Popen(
+            [
+                pdf_settings.PHANTOMJS_BIN_PATH,
+                '--ssl-protocol=any',
+                '--ignore-ssl-errors=yes',
+                pdf_settings.RENDERER_SCRIPT,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=phantomjs_env,
+            text=True,
+            bufsize=1,
+        )
+
+        # Read its output in the background so waits can time out
+        threading.Thread(target=self._read, name=f'renderer-{self.process.pid}', daemon=True).start()
+        try:
+            self._receive(None, pdf_settings.RENDERER_TIMEOUT)
+
+        except BaseException:
+
+            # It never became ready, so stop it rather than leave it running
+            logger.error(f'PDF/Renderer: {self.process.pid} failed to start, killing it')
+            self.close(kill=True)
+            raise
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def render(self, html, paperformat='A4', zoom=1, timeout=None, base=None):
+        """
+        Renders the HTML to a PDF. The HTML is passed in the job itself and the
+        PDF is written to an in-memory buffer, so neither goes through disk.
+
+        :param html: The HTML to render
+        :type html: str
+        :param paperformat: The paper format or 'width*height'
+        :type paperformat: str
+        :param zoom: The zoom factor
+        :type zoom: float
+        :param timeout: Seconds to wait for the render, defaults to RENDERER_TIMEOUT
+        :type timeout: float
+        :param base: The URL relative references in the HTML resolve against
+        :type base: str
+        :raises RendererError: If the render failed or timed out
+        :return: The PDF
+        :rtype: bytes
+        """
+        self.jobs += 1
+        with output_buffer() as (output, read):
+            job = {
+                'html': html,
+                'base': base,
+                'output': output,
+                'paperformat': paperformat,
+                'zoom': zoom,
+                'ready_timeout': pdf_settings.RENDERER_READY_TIMEOUT * 1000,
+            }
+            self.result = self._send(job, timeout or pdf_settings.RENDERER_TIMEOUT)
+
+            return read()
+
+    def ping(self, timeout=5):
+        """
+        Checks that the renderer is still responsive
+
+        :return: Whether it answered in time
+        :rtype: bool
+        """
+        try:
+            self._send({'ping': True}, timeout)
+            return True
+
+        except RendererError:
+            return False
+
+    def close(self, kill=False):
+        """
+        Stops the renderer, killing it if asked to or if it does not exit on its own
+
+        :param kill: Whether to kill it outright, e.g. when it is wedged
+        :type kill: bool
+        """
+        if not kill:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=2)
+                return
+
+            except Exception:
+                pass
+
+        self.process.kill()
+        self.process.wait()
+
+    def _send(self, job, timeout):
+        self._ids += 1
+        job['id'] = self._ids
+        self.last_used = time.monotonic()
+        try:
+            self.process.stdin.write(json.dumps(job) + '\n')
+            self.process.stdin.flush()
+
+        except (BrokenPipeError, OSError) as e:
+            raise RendererError(f'Renderer exited: {e}')
+
+        return self._receive(job['id'], timeout)
+
+    def _receive(self, job_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                result = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise RenderTimeout(f'Renderer timed out after {timeout}s')
+
+            if result is None:
+                raise RendererError('Renderer exited')
+
+            # Skip anything left over from an earlier job
+            if result.get('id') != job_id:
+                continue
+
+            if result.get('status') == 'error':
+                raise RendererError(result.get('error'))
+
+            return result
+
+    def _read(self):
+        for line in self.process.stdout:
+
+            # Ignore anything that is not a result, e.g. console output
+            if line.startswith('{'):
+                try:
+                    self._lines.put(json.loads(line))
+                except ValueError:
+                    logger.debug(f'PDF/Renderer: Unreadable output: {line}')
+
+        self._lines.put(None)
+
+
+class RendererPool(object):
+    """
+    A fixed-size pool of PhantomJS renderers. Renderers are started lazily,
+    replaced when they die, time out or fail a health check, and recycled
+    after RENDERER_MAX_JOBS renders to bound their memory.
+    """
+
+    def __init__(self, size=None):
+        self._size = size
+        self._lock = threading.Condition()
+        self._idle = []
+        self._started = 0
+
+    @property
+    def size(self):
+        return self._size if self._size is not None else pdf_settings.RENDERER_POOL_SIZE
+
+    def render(self, html, paperformat='A4', zoom=1, timeout=None, base=None):
+        """
+        Renders the HTML to a PDF on the next free renderer, waiting for one if
+        all are busy.
+
+        :raises RendererBusy: If no renderer freed up in time
+        :raises RendererError: If the render failed or timed out
+        :return: The PDF
+        :rtype: bytes
+        """
+        renderer = self._acquire()
+        try:
+            pdf = renderer.render(html, paperformat, zoom, timeout, base)
+
+        except RenderTimeout:
+
+            # It is wedged, kill it rather than wait on it
+            logger.error(f'PDF/Renderer: {renderer.process.pid} missed its deadline, killing it')
+            metrics.failed(timeout=True)
+            self._discard(renderer, kill=True)
+            raise
+
+        except BaseException:
+
+            # It may be wedged, start afresh
+            metrics.failed()
+            self._discard(renderer)
+            raise
+
+        metrics.record(renderer.result)
+        self._release(renderer)
+
+        return pdf
+
+    def close(self):
+        """
+        Stops all idle renderers
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for renderer in idle:
+            self._discard(renderer)
+
+    def _acquire(self):
+        deadline = time.monotonic() + pdf_settings.RENDERER_TIMEOUT
+        while True:
+
+            # Wait for a renderer to be freed, or for room to start another
+            with self._lock:
+                while not self._idle and self._started >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise RendererBusy(f'No renderer freed up within {pdf_settings.RENDERER_TIMEOUT}s')
+                    self._lock.wait(remaining)
+
+                renderer = self._idle.pop() if self._idle else None
+                if renderer is None:
+                    self._started += 1
+
+            # Start another, outside the lock as it takes a while
+            if renderer is None:
+                try:
+                    return Renderer()
+                except Exception:
+                    self._free()
+                    raise
+
+            # Check on renderers that have sat idle for a while
+            idle = time.monotonic() - renderer.last_used
+            if renderer.alive and (idle < pdf_settings.RENDERER_HEALTHCHECK_INTERVAL or renderer.ping()):
+                return renderer
+
+            logger.warning(f'PDF/Renderer: {renderer.process.pid} failed health check, replacing it')
+            self._discard(renderer)
+
+    def _release(self, renderer):
+
+        # Recycle it once it has done its share
+        if renderer.jobs >= pdf_settings.RENDERER_MAX_JOBS:
+            logger.debug(f'PDF/Renderer: Recycling {renderer.process.pid} after {renderer.jobs} jobs')
+            self._discard(renderer)
+            return
+
+        with self._lock:
+            self._idle.append(renderer)
+            self._lock.notify()
+
+    def _discard(self, renderer, kill=False):
+        renderer.close(kill=kill)
+        self._free()
+
+    def _free(self):
+
+        # Let a waiter start a replacement
+        with self._lock:
+            self._started -= 1
+            self._lock.notify()
+
+
+# The renderers for this process
+pool = RendererPool()
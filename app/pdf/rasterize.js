@@ -1,8 +1,14 @@
 // https://github.com/ariya/phantomjs/blob/master/examples/rasterize.js
+// Pass "-" as the URL to read the HTML from stdin and "-" as the filename to
+// write the PDF to stdout; messages then go to stderr to keep stdout clean.
+// The page is rendered once its images, fonts and window.PDF_READY flag are
+// in (see ready.js), and the load, layout and render durations are written
+// to stderr as a JSON line.
 "use strict";
 var page = require('webpage').create(),
     system = require('system'),
-    address, output, size, pageWidth, pageHeight;
+    whenReady = require('./ready').whenReady,
+    address, output, size, pageWidth, pageHeight, log = console.log, started;
 
 if (system.args.length < 3 || system.args.length > 5) {
     console.log('Usage: rasterize.js URL filename [paperwidth*paperheight|paperformat] [zoom]');
@@ -12,9 +18,12 @@ if (system.args.length < 3 || system.args.length > 5) {
     phantom.exit(1);
 } else {
     address = system.args[1];
-    output = system.args[2];
+    output = system.args[2] === '-' ? '/dev/stdout' : system.args[2];
+    if (output === '/dev/stdout') {
+        log = function (message) { system.stderr.writeLine(message); };
+    }
     page.viewportSize = { width: 600, height: 600 };
-    if (system.args.length > 3 && system.args[2].substr(-4) === ".pdf") {
+    if (system.args.length > 3 && (system.args[2].substr(-4) === ".pdf" || system.args[2] === '-')) {
         size = system.args[3].split('*');
         page.paperSize = size.length === 2 ? { width: size[0], height: size[1], margin: '0px' }
                                            : { format: system.args[3], orientation: 'portrait', margin: '1.5cm' };
@@ -36,15 +45,28 @@ if (system.args.length < 3 || system.args.length > 5) {
     if (system.args.length > 4) {
         page.zoomFactor = system.args[4];
     }
-    page.open(address, function (status) {
+    page.onLoadFinished = function (status) {
+        var loaded = Date.now();
+        page.onLoadFinished = null;
         if (status !== 'success') {
-            console.log('Unable to load the address!');
+            log('Unable to load the address!');
             phantom.exit(1);
         } else {
-            window.setTimeout(function () {
-                page.render(output);
+            whenReady(page, parseInt(system.env.PDF_READY_TIMEOUT || '5000', 10), function (isReady) {
+                var laidOut = Date.now();
+                page.render(output, { format: output === '/dev/stdout' ? 'pdf' : output.split('.').pop() });
+                system.stderr.writeLine(JSON.stringify({
+                    ready: isReady,
+                    timings: { load: loaded - started, layout: laidOut - loaded, render: Date.now() - laidOut }
+                }));
                 phantom.exit();
-            }, 200);
+            });
         }
-    });
+    };
+    started = Date.now();
+    if (address === '-') {
+        page.setContent(system.stdin.read(), system.env.PDF_BASE_URL || 'about:blank');
+    } else {
+        page.open(address);
+    }
 }
\ No newline at end of file
@@ -0,0 +1,36 @@
+// Shared by worker.js and rasterize.js: waits for a page to be ready to render,
+// i.e. for its images, fonts and own window.PDF_READY flag to be in.
+"use strict";
+
+// Returns whether the page's images, fonts and own ready flag are all in
+function ready(page) {
+    return page.evaluate(function () {
+        var images = document.images, i;
+        if (document.readyState !== 'complete' || window.PDF_READY === false) {
+            return false;
+        }
+        for (i = 0; i < images.length; i++) {
+            if (!images[i].complete) {
+                return false;
+            }
+        }
+        return !document.fonts || document.fonts.status === 'loaded';
+    });
+}
+
+// Calls back once the page is ready, or after the wait runs out regardless
+function whenReady(page, wait, callback) {
+    var deadline = Date.now() + wait;
+    (function poll() {
+        if (ready(page)) {
+            return callback(true);
+        }
+        if (Date.now() >= deadline) {
+            return callback(false);
+        }
+        setTimeout(poll, 10);
+    })();
+}
+
+exports.ready = ready;
+exports.whenReady = whenReady;
@@ -1,12 +1,81 @@
+from django.http import HttpResponse
 from django.template import loader
 
-from .generators import PDFGenerator
+from .assembly import available as assembly_available, merge_pdfs
+from .assets import assets
+from .backends import get_backend
+from .cache import render_cache
+from .settings import pdf_settings
+
+
+def render_pdf_content(request, template_name, context=None, using=None, options={}):
+    """
+    Renders the template to a PDF, reusing an identical earlier render from
+    the render cache when there is one. Local assets the HTML references are
+    inlined first (see `pdf.assets`).
+
+    Templates listed in ASSEMBLED_TEMPLATES are rendered in two parts that
+    are merged: the pages that are the same for everyone (`pdf_part` is
+    'static') and the pages specific to this render (`pdf_part` is
+    'dynamic'). The static part is cached like any render, so only the
+    dynamic pages are rendered per participant.
+
+    :return: The PDF and its MD5
+    :rtype: (bytes, str)
+    """
+    if template_name in pdf_settings.ASSEMBLED_TEMPLATES and assembly_available():
+        return _render_assembled(request, template_name, context, using, options)
+
+    content = _render_html(request, template_name, context, using)
+
+    return _render(content, options)
+
+
+def _render_html(request, template_name, context, using):
+    content = loader.render_to_string(template_name, context, request, using=using)
+
+    # Inline local assets so the renderer does not fetch them
+    if pdf_settings.INLINE_ASSETS:
+        content = assets.inline(content)
+
+    return content
+
+
+def _render(content, options):
+
+    # Check for an identical render
+    key = render_cache.key(content, pdf_settings.BACKEND, options)
+    cached = render_cache.get(key)
+    if cached:
+        return cached
+
+    pdf = get_backend().render(content, **options)
+
+    return pdf, render_cache.put(key, pdf)
+
+
+def _render_assembled(request, template_name, context, using, options):
+    parts = [
+        _render_html(request, template_name, dict(context or {}, pdf_part=part), using)
+        for part in ('static', 'dynamic')
+    ]
+
+    # Check for an identical assembly
+    key = render_cache.key(''.join(parts), pdf_settings.BACKEND, dict(options, assembled=True))
+    cached = render_cache.get(key)
+    if cached:
+        return cached
+
+    pdf = merge_pdfs([_render(part, options)[0] for part in parts])
+
+    return pdf, render_cache.put(key, pdf)
 
 
 def render_pdf(filename, request, template_name, context=None, using=None, options={}):
 
     # Render to file.
-    content = loader.render_to_string(template_name, context, request, using=using)
-    pdf = PDFGenerator(content, **options)
+    pdf, md5 = render_pdf_content(request, template_name, context, using=using, options=options)
 
-    return pdf.get_http_response(filename)
+    response = HttpResponse(pdf, content_type='application/pdf')
+    response['Content-Disposition'] = 'attachment; filename="{}.pdf"'.format(filename)
+    return response
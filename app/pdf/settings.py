@@ -12,6 +12,7 @@ back to the defaults.
 """
 from __future__ import unicode_literals
 import os
+import tempfile
 from django.conf import settings
 from django.test.signals import setting_changed
 
@@ -19,11 +20,23 @@ from django.test.signals import setting_changed
 PDF_GENERATOR_DIR = os.path.dirname(os.path.abspath(__file__))
 
 DEFAULTS = {
+    'BACKEND': 'pdf.backends.PhantomJSBackend',
     'UPLOAD_TO': 'pdfs',
     'PHANTOMJS_BIN_PATH': 'phantomjs',
     'DEFAULT_RASTERIZE_SCRIPT': os.path.join(PDF_GENERATOR_DIR, 'rasterize.js'),
     'DEFAULT_TEMP_DIR': os.path.join(PDF_GENERATOR_DIR, 'temp'),
-    'TEMPLATES_DIR': os.path.join(PDF_GENERATOR_DIR, 'templates/pdf_generator')
+    'TEMPLATES_DIR': os.path.join(PDF_GENERATOR_DIR, 'templates/pdf_generator'),
+    'RENDERER_SCRIPT': os.path.join(PDF_GENERATOR_DIR, 'worker.js'),
+    'RENDERER_POOL_SIZE': os.cpu_count() or 1,
+    'RENDERER_MAX_JOBS': 100,
+    'RENDERER_TIMEOUT': 60,
+    'RENDERER_HEALTHCHECK_INTERVAL': 60,
+    'RENDERER_READY_TIMEOUT': 5,
+    'CACHE_DIR': os.path.join(tempfile.gettempdir(), 'pdf-cache'),
+    'CACHE_MAX_SIZE': 256 * 1024 * 1024,
+    'ASSEMBLED_TEMPLATES': [],
+    'INLINE_ASSETS': True,
+    'ASSET_ALIASES': {},
 }
 
 
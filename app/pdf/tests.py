@@ -1,3 +1,306 @@
-from django.test import TestCase
+import hashlib
+import os
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from pdf import renderers
+from pdf.assets import AssetInliner
+from pdf.cache import RenderCache, RenderedPDF
+from pdf.generators import PDFGenerator
+from pdf.pool import Renderer, RendererPool, RendererError, RendererBusy, RenderTimeout
+from pdf.settings import pdf_settings
+
+
+class FakeRenderer(object):
+    """
+    Stands in for a PhantomJS renderer, rendering once `go` is set.
+    """
+
+    go = None
+    fail = False
+
+    def __init__(self):
+        self.jobs = 0
+        self.result = None
+        self.alive = True
+        self.last_used = 0
+        self.process = mock.Mock(pid=1)
+        self.closed = False
+
+    def render(self, html, *args):
+        FakeRenderer.go.wait(5)
+        self.jobs += 1
+        self.result = {'ready': True, 'timings': {}}
+        if FakeRenderer.fail:
+            raise OSError('Renderer died')
+        return html
+
+    def ping(self):
+        return True
+
+    def close(self, kill=False):
+        self.closed = True
+
+
+class RendererPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        FakeRenderer.go, FakeRenderer.fail = threading.Event(), False
+        patcher = mock.patch('pdf.pool.Renderer', FakeRenderer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(FakeRenderer.go.set)
+
+        self.pool = RendererPool(size=1)
+
+    def render_in_background(self, html):
+        results = []
+
+        def render():
+            try:
+                results.append(self.pool.render(html))
+            except Exception as e:
+                results.append(e)
+
+        thread = threading.Thread(target=render, daemon=True)
+        thread.start()
+        return thread, results
+
+    def test_waiters_get_released_renderers(self):
+        first, first_results = self.render_in_background('first')
+        second, second_results = self.render_in_background('second')
+
+        FakeRenderer.go.set()
+        for thread in (first, second):
+            thread.join(5)
+
+        self.assertEqual(sorted(first_results + second_results), ['first', 'second'])
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_waiters_are_woken_by_discards(self):
+        FakeRenderer.fail = True
+        first, first_results = self.render_in_background('first')
+        second, second_results = self.render_in_background('second')
+
+        # The failed renderer is replaced for whoever is waiting rather than leaving them to time out
+        FakeRenderer.go.set()
+        first.join(5)
+        second.join(5)
+        self.assertFalse(first.is_alive() or second.is_alive())
+        self.assertIsInstance(first_results[0], OSError)
+        self.assertIsInstance(second_results[0], OSError)
+        self.assertEqual(self.pool._started, 0)
+
+    def test_recycles_renderers(self):
+        FakeRenderer.go.set()
+        with mock.patch.object(pdf_settings, 'RENDERER_MAX_JOBS', 2):
+            self.pool.render('first')
+            renderer = self.pool._idle[0]
+            self.pool.render('second')
+
+        self.assertTrue(renderer.closed)
+        self.assertEqual((self.pool._idle, self.pool._started), ([], 0))
+
+    def test_replaces_renderers_failing_health_checks(self):
+        FakeRenderer.go.set()
+        self.pool.render('first')
+        renderer = self.pool._idle[0]
+
+        # It sat idle long enough to be checked, and did not answer
+        renderer.last_used = float('-inf')
+        renderer.ping = lambda: False
+        self.pool.render('second')
+
+        self.assertTrue(renderer.closed)
+        self.assertIsNot(self.pool._idle[0], renderer)
+
+    def test_gives_up_when_saturated(self):
+        first, _ = self.render_in_background('first')
+
+        with mock.patch.object(pdf_settings, 'RENDERER_TIMEOUT', 0.1):
+            with self.assertRaises(RendererBusy):
+                self.pool.render('second')
+
+        FakeRenderer.go.set()
+        first.join(5)
+
+
+@mock.patch.object(pdf_settings, 'RENDERER_TIMEOUT', 0.1)
+class RendererTests(SimpleTestCase):
+
+    def start(self, *lines):
+        self.process = mock.Mock(pid=1, stdout=iter(lines))
+        with mock.patch('pdf.pool.subprocess.Popen', return_value=self.process):
+            return Renderer()
+
+    def test_starts_once_ready(self):
+        renderer = self.start('{"id": null, "status": "ready"}\n')
+
+        self.assertIs(renderer.process, self.process)
+        self.process.kill.assert_not_called()
+
+    def test_kills_renderers_that_exit_before_ready(self):
+        with self.assertRaises(RendererError):
+            self.start()
+
+        self.process.kill.assert_called_once()
+        self.process.wait.assert_called_once()
+
+    def test_kills_renderers_that_never_answer(self):
+        with mock.patch('pdf.pool.Renderer._read'), self.assertRaises(RenderTimeout):
+            self.start()
+
+        self.process.kill.assert_called_once()
+        self.process.wait.assert_called_once()
+
+
+@mock.patch.object(pdf_settings, 'RENDERER_POOL_SIZE', 1)
+class PDFGeneratorTests(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch('pdf.generators.PDFGenerator._PDFGenerator__spawn', return_value=b'spawned')
+        self.spawn = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def generate(self, error):
+        with mock.patch('pdf.generators.pool.render', side_effect=error):
+            return PDFGenerator('<html></html>')
+
+    def test_spawns_when_the_pooled_render_fails(self):
+        self.assertEqual(self.generate(RendererError('Renderer exited')).get_data(), b'spawned')
+
+    def test_does_not_spawn_when_saturated(self):
+        with self.assertRaises(RendererBusy):
+            self.generate(RendererBusy('No renderer freed up'))
+
+        self.spawn.assert_not_called()
+
+    def test_does_not_spawn_after_timeouts(self):
+        with self.assertRaises(RenderTimeout):
+            self.generate(RenderTimeout('Renderer timed out'))
+
+        self.spawn.assert_not_called()
+
+
+class RenderCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = os.path.join(temp.name, 'cache')
+        self.cache = RenderCache(self.directory, max_size=1024)
+
+    def test_keys_on_everything_that_shapes_the_pdf(self):
+        key = RenderCache.key('<html></html>', 'pdf.backends.PhantomJSBackend', {'zoom': 1})
+
+        self.assertEqual(RenderCache.key('<html></html>', 'pdf.backends.PhantomJSBackend', {'zoom': 1}), key)
+        self.assertNotEqual(RenderCache.key('<html> </html>', 'pdf.backends.PhantomJSBackend', {'zoom': 1}), key)
+        self.assertNotEqual(RenderCache.key('<html></html>', 'pdf.backends.WeasyPrintBackend', {'zoom': 1}), key)
+        self.assertNotEqual(RenderCache.key('<html></html>', 'pdf.backends.PhantomJSBackend', {'zoom': 2}), key)
+
+    def test_stores_pdfs_with_their_md5(self):
+        self.assertIsNone(self.cache.get('a'))
+
+        md5 = self.cache.put('a', b'%PDF-a')
+        self.assertEqual(md5, hashlib.md5(b'%PDF-a').hexdigest())
+        self.assertEqual(self.cache.get('a'), (b'%PDF-a', md5))
+
+        # The MD5 hashed as it was rendered is reused
+        self.assertEqual(self.cache.put('b', RenderedPDF(b'%PDF-b', 'rendered')), 'rendered')
+
+    def test_is_private(self):
+        self.cache.put('a', b'%PDF-a')
+
+        self.assertEqual(os.stat(self.directory).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(os.path.join(self.directory, 'a.pdf')).st_mode & 0o777, 0o600)
+
+        # Directories that belong to someone else are not used
+        with mock.patch('pdf.cache.os.getuid', return_value=os.getuid() + 1):
+            self.assertIsNone(self.cache.get('a'))
+
+    def test_evicts_least_recently_used(self):
+
+        # Two entries fit, so each put past that drops whichever was used longest ago
+        self.cache = RenderCache(self.directory, max_size=150)
+        for key, used in (('a', 1), ('b', 3), ('c', 2)):
+            self.cache.put(key, b'%PDF' * 10)
+            os.utime(os.path.join(self.directory, f'{key}.pdf'), (used, used))
+
+        self.cache.put('d', b'%PDF' * 10)
+
+        self.assertEqual(sorted(os.listdir(self.directory)), ['b.pdf', 'd.pdf'])
+
+    def test_can_be_disabled(self):
+        self.cache = RenderCache(self.directory, max_size=0)
+
+        self.cache.put('a', b'%PDF-a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertFalse(os.path.exists(self.directory))
+
+    def test_identical_renders_skip_the_backend(self):
+        backend = mock.Mock()
+        backend.render.return_value = RenderedPDF(b'%PDF-a', 'rendered')
+
+        with mock.patch('pdf.renderers.render_cache', self.cache), \
+                mock.patch('pdf.renderers.get_backend', return_value=backend):
+            first = renderers._render('<html></html>', {})
+            second = renderers._render('<html></html>', {})
+
+        self.assertEqual(first, second)
+        self.assertEqual(second, (b'%PDF-a', 'rendered'))
+        backend.render.assert_called_once()
+
+
+class AssetInlinerTests(SimpleTestCase):
+
+    def setUp(self):
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.directory = temp.name
+        for name, content in (('css/site.css', b'@font-face { src: url("../fonts/a.woff?v=1"); } '
+                                               b'a { background: url(data:image/png;base64,AA==); }'),
+                              ('img/logo.png', b'PNG')):
+            os.makedirs(os.path.dirname(os.path.join(self.directory, name)), exist_ok=True)
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(content)
+
+        patcher = mock.patch('pdf.assets.finders.find', side_effect=self.find)
+        self.finds = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.assets = AssetInliner()
+
+    def find(self, path):
+        path = os.path.join(self.directory, path)
+        return path if os.path.exists(path) else None
+
+    def test_inlines_stylesheets(self):
+        html = self.assets.inline('<link rel="stylesheet" href="/static/css/site.css?v=2">')
+
+        # References relative to the stylesheet point at the local files
+        self.assertTrue(html.startswith('<style>@font-face'))
+        self.assertIn(f'url("file://{self.directory}/fonts/a.woff?v=1")', html)
+        self.assertIn('url(data:image/png;base64,AA==)', html)
+
+    def test_inlines_images(self):
+        html = self.assets.inline("<img alt='Logo' src='/static/img/logo.png'>")
+
+        self.assertEqual(html, "<img alt='Logo' src='data:image/png;base64,UE5H'>")
+
+    def test_inlines_aliased_urls(self):
+        with mock.patch.object(pdf_settings, 'ASSET_ALIASES', {'https://cdn.example.com/logo.png': 'img/logo.png'}):
+            html = self.assets.inline('<img src="https://cdn.example.com/logo.png">')
+
+        self.assertEqual(html, '<img src="data:image/png;base64,UE5H">')
+
+    def test_leaves_what_it_cannot_find(self):
+        html = '<link rel="stylesheet" href="/static/css/missing.css"><img src="https://example.com/a.png">'
+
+        self.assertEqual(self.assets.inline(html), html)
+        self.assertEqual(self.assets.inline(html), html)
+
+        # Misses are remembered too
+        self.finds.assert_called_once_with('css/missing.css')
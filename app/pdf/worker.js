@@ -0,0 +1,75 @@
+// A long-lived rasterize.js: reads one JSON job per line from stdin, renders
+// it and writes one JSON result per line to stdout. Jobs look like
+//   {"id": 1, "html": "<html>...", "base": "file:///app/", "output": "/proc/1/fd/5", "paperformat": "A4", "zoom": 1}
+// where output is usually an in-memory file of the pool's process, and a {"id": 2, "ping": true} job is answered straight away for health checks.
+"use strict";
+var webpage = require('webpage'),
+    system = require('system'),
+    whenReady = require('./ready').whenReady;
+
+function reply(result) {
+    system.stdout.writeLine(JSON.stringify(result));
+    system.stdout.flush();
+}
+
+function configure(page, job) {
+    var size;
+    page.viewportSize = { width: 600, height: 600 };
+    size = (job.paperformat || 'A4').split('*');
+    page.paperSize = size.length === 2 ? { width: size[0], height: size[1], margin: '0px' }
+                                       : { format: job.paperformat || 'A4', orientation: 'portrait', margin: '1.5cm' };
+    if (job.zoom) {
+        page.zoomFactor = job.zoom;
+    }
+}
+
+function next() {
+    var line = system.stdin.readLine(), job, page, started;
+
+    // The pool closed our stdin
+    if (line === null || line === undefined || (line === '' && system.stdin.atEnd())) {
+        phantom.exit(0);
+        return;
+    }
+
+    try {
+        job = JSON.parse(line);
+    } catch (e) {
+        reply({ id: null, status: 'error', error: 'Invalid job: ' + e });
+        return setTimeout(next, 0);
+    }
+
+    if (job.ping) {
+        reply({ id: job.id, status: 'pong' });
+        return setTimeout(next, 0);
+    }
+
+    page = webpage.create();
+    configure(page, job);
+    started = Date.now();
+    page.onLoadFinished = function (status) {
+        var loaded = Date.now();
+        page.onLoadFinished = null;
+        if (status !== 'success') {
+            reply({ id: job.id, status: 'error', error: 'Unable to load the page!' });
+            page.close();
+            return setTimeout(next, 0);
+        }
+        whenReady(page, job.ready_timeout || 5000, function (isReady) {
+            var laidOut = Date.now();
+            page.render(job.output, { format: 'pdf' });
+            page.close();
+            reply({
+                id: job.id,
+                status: 'ok',
+                ready: isReady,
+                timings: { load: loaded - started, layout: laidOut - loaded, render: Date.now() - laidOut }
+            });
+            setTimeout(next, 0);
+        });
+    };
+    page.setContent(job.html, job.base || 'about:blank');
+}
+
+reply({ id: null, status: 'ready' });
+next();
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class QuestionnaireConfig(AppConfig):
     name = 'questionnaire'
+
+    def ready(self):
+
+        # Send FHIR requests through the pooled sessions
+        from fhirquestionnaire import http
+        http.install()
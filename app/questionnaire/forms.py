@@ -10,11 +10,10 @@ from crispy_forms.layout import Layout, Fieldset, ButtonHolder, Submit, HTML, Di
 from bootstrap_datepicker_plus.widgets import DatePickerInput, MonthPickerInput
 from django.utils.translation import gettext_lazy as _
 
-from fhirclient.models.questionnaire import Questionnaire
 from ppmutils.ppm import PPM
-from ppmutils.fhir import FHIR as PPMFHIR
 
 from fhirquestionnaire.fhir import FHIR
+from questionnaire.schema import FieldSpec, QuestionnaireIndex, schemas
 
 import logging
 logger = logging.getLogger(__name__)
@@ -50,7 +49,7 @@ class FHIRQuestionnaireForm(forms.Form):
 
         try:
             # Get the questionnaire
-            questionnaire = Questionnaire(PPMFHIR.fhir_read("Questionnaire", questionnaire_id))
+            questionnaire = FHIR.get_questionnaire(questionnaire_id)
 
             # Retain it
             self.questionnaire_id = questionnaire_id
@@ -60,8 +59,13 @@ class FHIRQuestionnaireForm(forms.Form):
             logger.exception(f"PPM/FHIR: Questionnaire/{questionnaire_id} not found: {e}", exc_info=True)
             raise FHIR.QuestionnaireDoesNotExist
 
+        # Get the schema compiled for this version of the questionnaire
+        schema = schemas.get((self.__class__, questionnaire_id), questionnaire, self._compile)
+
+        self.index = schema.index
+
         # Get fields
-        self.fields = self._get_form_fields(questionnaire, questionnaire_id)
+        self.fields = schema.build_fields()
         self.fields['questionnaire_id'] = forms.CharField(empty_value=questionnaire_id, widget=forms.HiddenInput)
 
         # Create the crispy helper
@@ -69,65 +73,50 @@ class FHIRQuestionnaireForm(forms.Form):
         self.helper.form_method = 'POST'
 
         # Set the layout
-        self.helper.layout = self._get_form_layout(self.questionnaire.item)
-
-        # Add a submit button
-        self.helper.layout.append(ButtonHolder(Submit('submit', 'Submit', css_class='btn btn-primary')))
+        self.helper.layout = schema.layout
 
-    def _get_parent_item(self, linkId, parent=None):
+    def _compile(self):
         """
-        Searches the FHIR questionnaire and returns the parent of the given item if it exists
+        Walks the questionnaire once and returns the index, field specs and
+        layout that every request for this version of it will share.
         """
-        logger.debug(f'Searching: {parent.linkId if parent else None} for {linkId}')
-        # Iterate items
-        if not parent:
-            for item in self.questionnaire.item:
+        # Index the items
+        self.index = QuestionnaireIndex(self.questionnaire)
 
-                # Check for root
-                if item.linkId == linkId:
-                    return None
+        # Get field specs
+        fields = self._get_field_specs(self.questionnaire, self.questionnaire_id)
 
-                # Search list
-                parent = self.questionnaire
-
-        # Return parent if found
-        for item in parent.item:
-            if item.linkId == linkId:
-                return parent
+        # Get the layout and add a submit button
+        layout = self._get_form_layout(self.questionnaire.item)
+        layout.append(ButtonHolder(Submit('submit', 'Submit', css_class='btn btn-primary')))
 
-            # Check for children
-            if item.item:
-                parent_item = self._get_parent_item(linkId, item)
-                if parent_item:
-                    return parent_item
+        return self.index, fields, layout
 
-    def _get_dependent_items(self, linkId, parent=None):
+    def _get_parent_item(self, linkId):
         """
-        Searches the FHIR questionnaire and returns the items which depend on the passed item
+        Returns the parent of the given item if it exists
         """
-        # Collect items
-        items = []
-
-        # Iterate items
-        if not parent:
-
-            # Search list
-            parent = self.questionnaire
-
-        # Return parent if found
-        for item in parent.item:
+        return self.index.parent(linkId)
 
-            # Check sub items
-            if item.item:
-                items.extend(self._get_dependent_items(linkId, item))
+    def _get_dependent_items(self, linkId):
+        """
+        Returns the items which depend on the passed item
+        """
+        return self.index.dependents(linkId)
 
-            # Check for dependency
-            if item.enableWhen and next((e for e in item.enableWhen if e.question == linkId), None):
-                items.append(item)
+    def _get_choices(self, item, questionnaire_id):
+        """
+        Returns the choices for an item's answer options
+        """
+        # Assume valueString
+        for option in item.answerOption:
+            if not option.valueString:
+                logger.error('Unsupported choice type for question on Questionnaire',
+                             extra={'questionnaire': questionnaire_id, 'question': item.linkId,})
 
-        return items
+        return [(option.valueString, option.valueString) for option in item.answerOption if option.valueString]
 
-    def _get_form_fields(self, parent, questionnaire_id):
+    def _get_field_specs(self, parent, questionnaire_id):
 
         # Set fields
         fields = {}
@@ -158,23 +147,12 @@ class FHIRQuestionnaireForm(forms.Form):
             # Check type
             if (item.type == 'string' or item.type == 'text') and item.answerOption:
 
-                # Set the choices
-                choices = ()
-                for option in item.answerOption:
-
-                    # Assume valueString
-                    if not option.valueString:
-                        logger.error('Unsupported choice type for question on Questionnaire',
-                                        extra={'questionnaire': questionnaire_id, 'question': item.linkId,})
-                    else:
-                        choices = choices + ((option.valueString, option.valueString),)
-
                 # Set the input
-                fields[item.linkId] = forms.TypedChoiceField(
-                    label=item.text,
-                    choices=choices,
-                    widget=forms.RadioSelect(attrs=attrs),
-                    required=required
+                fields[item.linkId] = FieldSpec(
+                    forms.TypedChoiceField,
+                    {'label': item.text, 'choices': self._get_choices(item, questionnaire_id), 'required': required},
+                    forms.RadioSelect,
+                    {'attrs': attrs},
                 )
 
             elif item.type == 'string' or item.type == 'text' or (item.type == 'question' and not item.answerOption):
@@ -182,10 +160,11 @@ class FHIRQuestionnaireForm(forms.Form):
                 if item.initial:
 
                     # Make this a textbox-style input with minimum width
-                    fields[item.linkId] = forms.CharField(
-                        label=item.text,
-                        required=required,
-                        widget=forms.Textarea(attrs={**{
+                    fields[item.linkId] = FieldSpec(
+                        forms.CharField,
+                        {'label': item.text, 'required': required},
+                        forms.Textarea,
+                        {'attrs': {**{
                             'placeholder': next((i.valueString for i in item.initial), ""),
                             'pattern': ".{6,}",
                             'title': 'Please be as descriptive as possible for this question',
@@ -193,16 +172,17 @@ class FHIRQuestionnaireForm(forms.Form):
                                         "descriptive as possible for "
                                         "this question')",
                             'oninput': "setCustomValidity('')",
-                        }, **attrs})
+                        }, **attrs}},
                     )
 
                 else:
 
                     # Plain old text field
-                    fields[item.linkId] = forms.CharField(
-                        label=item.text,
-                        required=required,
-                        widget=forms.TextInput(attrs=attrs)
+                    fields[item.linkId] = FieldSpec(
+                        forms.CharField,
+                        {'label': item.text, 'required': required},
+                        forms.TextInput,
+                        {'attrs': attrs},
                     )
 
             elif item.type == 'date':
@@ -218,28 +198,8 @@ class FHIRQuestionnaireForm(forms.Form):
                         if code == 'month-year':
                             month_year = True
 
-                # Set options
-                max_date = timezone.now().replace(hour=23, minute=59).strftime("%Y-%m-%dT%H:%M:%S")
-                options = {
-                    'maxDate': max_date,
-                    'useCurrent': False,
-                }
-
-                # Create widget
-                if month_year:
-                    widget = MonthPickerInput(
-                        format='%m/%Y',
-                        options=options,
-                        attrs=attrs,
-                    )
-                else:
-                    widget = DatePickerInput(
-                        format='%m/%d/%Y',
-                        options=options,
-                        attrs=attrs,
-                    )
-
                 # Check for coding on ranges
+                links = []
                 if item.code:
                     for code in [c.code for c in item.code if c.system == FHIR.input_range_system]:
 
@@ -247,104 +207,72 @@ class FHIRQuestionnaireForm(forms.Form):
                         if code.startswith('start-of|'):
 
                             # Set it
-                            widget = widget.start_of(code.split('|')[1])
+                            links.append(('start_of', code.split('|')[1]))
 
                         elif code.startswith('end-of|'):
 
                             # Set it
-                            widget = widget.end_of(code.split('|')[1])
-
+                            links.append(('end_of', code.split('|')[1]))
 
                 # Check for date or month field
                 if month_year:
                     # Setup the month field
-                    fields[item.linkId] = forms.DateField(
-                        input_formats=["%m/%Y"],
-                        widget=widget,
-                        label=item.text,
-                        required=required
+                    fields[item.linkId] = FieldSpec(
+                        forms.DateField,
+                        {'input_formats': ["%m/%Y"], 'label': item.text, 'required': required},
+                        MonthPickerInput,
+                        {'format': '%m/%Y', 'attrs': attrs},
+                        dated=True,
+                        links=links,
                     )
 
                 else:
                     # Setup the date field
-                    fields[item.linkId] = forms.DateField(
-                        widget=widget,
-                        label=item.text,
-                        required=required
+                    fields[item.linkId] = FieldSpec(
+                        forms.DateField,
+                        {'label': item.text, 'required': required},
+                        DatePickerInput,
+                        {'format': '%m/%d/%Y', 'attrs': attrs},
+                        dated=True,
+                        links=links,
                     )
 
             elif item.type == 'boolean':
 
-                fields[item.linkId] = forms.TypedChoiceField(
-                    label=item.text,
-                    coerce=lambda x: bool(int(x)),
-                    choices=((1, 'Yes'), (0, 'No')),
-                    widget=forms.RadioSelect(attrs=attrs),
-                    required=required
+                fields[item.linkId] = FieldSpec(
+                    forms.TypedChoiceField,
+                    {
+                        'label': item.text,
+                        'coerce': lambda x: bool(int(x)),
+                        'choices': ((1, 'Yes'), (0, 'No')),
+                        'required': required,
+                    },
+                    forms.RadioSelect,
+                    {'attrs': attrs},
                 )
 
-            elif item.type == 'choice':
+            elif item.type == 'choice' or (item.type == 'question' and item.answerOption):
 
                 # Set the choices
-                choices = ()
-                for option in item.answerOption:
-
-                    # Assume valueString
-                    if not option.valueString:
-                        logger.error('Unsupported choice type for question on Questionnaire',
-                                     extra={'questionnaire': questionnaire_id, 'question': item.linkId,})
-                    else:
-                        choices = choices + ((option.valueString, option.valueString),)
-
-                # Check if repeats
-                if item.repeats:
-                    # Set the input
-                    fields[item.linkId] = forms.MultipleChoiceField(
-                        label=item.text,
-                        choices=choices,
-                        widget=forms.CheckboxSelectMultiple(attrs=attrs),
-                        required=required
-                    )
-
-                else:
-                    # Set the input
-                    fields[item.linkId] = forms.TypedChoiceField(
-                        label=item.text,
-                        choices=choices,
-                        widget=forms.RadioSelect(attrs=attrs),
-                        required=required
-                    )
-
-            elif item.type == 'question' and item.answerOption:
-
-                # Set the choices
-                choices = ()
-                for option in item.answerOption:
-
-                    # Assume valueString
-                    if not option.valueString:
-                        logger.error('Unsupported choice type for question on Questionnaire',
-                                    extra={'questionnaire': questionnaire_id, 'question': item.linkId,})
-                    else:
-                        choices = choices + ((option.valueString, option.valueString),)
+                choices = self._get_choices(item, questionnaire_id)
 
                 # Check if repeats
                 if item.repeats:
                     # Set the input
-                    fields[item.linkId] = forms.MultipleChoiceField(
-                        label=item.text,
-                        choices=choices,
-                        widget=forms.CheckboxSelectMultiple(attrs=attrs),
-                        required=required
+                    fields[item.linkId] = FieldSpec(
+                        forms.MultipleChoiceField,
+                        {'label': item.text, 'choices': choices, 'required': required},
+                        forms.CheckboxSelectMultiple,
+                        {'attrs': attrs},
                     )
 
                 else:
                     # Set the input
-                    fields[item.linkId] = forms.TypedChoiceField(
-                        label=item.text,
-                        choices=choices,
-                        widget=forms.RadioSelect(attrs=attrs),
-                        required=required
+                    fields[item.linkId] = FieldSpec(
+                        forms.TypedChoiceField,
+                        {'label': item.text, 'choices': choices, 'required': required},
+                        forms.RadioSelect,
+                        {'attrs': attrs},
                     )
 
             elif item.type == 'display' or item.type == 'group':
@@ -361,7 +289,7 @@ class FHIRQuestionnaireForm(forms.Form):
             if item.item:
 
                 # Process the group
-                fields.update(self._get_form_fields(item, questionnaire_id))
+                fields.update(self._get_field_specs(item, questionnaire_id))
 
         return fields
 
@@ -0,0 +1,166 @@
+import threading
+from collections import namedtuple
+
+from django.utils import timezone
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class QuestionnaireIndex(object):
+    """
+    Lookups over a Questionnaire's item tree, built in a single pass: items
+    and their parents by linkId, and the items enabled by each question via
+    `enableWhen`.
+    """
+
+    def __init__(self, questionnaire):
+        self.items = {}
+        self.parents = {}
+        self._dependents = {}
+
+        # Walk the tree once
+        stack = [(item, None) for item in reversed(questionnaire.item or [])]
+        while stack:
+            item, parent = stack.pop()
+
+            self.items[item.linkId] = item
+            self.parents[item.linkId] = parent
+            for enable_when in item.enableWhen or []:
+                self._dependents.setdefault(enable_when.question, []).append(item)
+
+            stack.extend((child, item) for child in reversed(item.item or []))
+
+    def item(self, linkId):
+        """
+        Returns the item for the linkId, if any
+        """
+        return self.items.get(linkId)
+
+    def parent(self, linkId):
+        """
+        Returns the parent item of the linkId, or None for root items
+        """
+        return self.parents.get(linkId)
+
+    def dependents(self, linkId):
+        """
+        Returns the items whose `enableWhen` refers to the linkId
+        """
+        return self._dependents.get(linkId, [])
+
+
+class FieldSpec(namedtuple('FieldSpec', ['field_class', 'field_kwargs', 'widget_class', 'widget_kwargs',
+                                         'dated', 'links'])):
+    """
+    The compiled description of a single form field. Everything derived from
+    the Questionnaire item is computed once; building the Django field from it
+    is just a pair of constructor calls.
+
+    `dated` marks date pickers, whose maximum date must be computed per request,
+    and `links` holds the (method, linkId) pairs tying ranged pickers together.
+    """
+
+    def __new__(cls, field_class, field_kwargs, widget_class, widget_kwargs, dated=False, links=()):
+        return super(FieldSpec, cls).__new__(cls, field_class, field_kwargs, widget_class, widget_kwargs,
+                                             dated, tuple(links))
+
+    def build(self):
+        """
+        Instantiates the Django field described by this spec
+
+        :return: The form field
+        :rtype: forms.Field
+        """
+        widget_kwargs = self.widget_kwargs
+        if self.dated:
+
+            # Pickers never allow dates in the future
+            max_date = timezone.now().replace(hour=23, minute=59).strftime("%Y-%m-%dT%H:%M:%S")
+            widget_kwargs = dict(widget_kwargs, options={
+                'maxDate': max_date,
+                'useCurrent': False,
+            })
+
+        # Create the widget and link it to any other pickers
+        widget = self.widget_class(**widget_kwargs)
+        for method, link_id in self.links:
+            widget = getattr(widget, method)(link_id)
+
+        return self.field_class(widget=widget, **self.field_kwargs)
+
+
+class CompiledQuestionnaire(object):
+    """
+    The form schema compiled from a single version of a Questionnaire: its
+    index, the field specs and the crispy layout. The layout is shared between
+    requests and must be treated as read-only.
+    """
+
+    def __init__(self, questionnaire, version_id, index, fields, layout):
+        self.questionnaire = questionnaire
+        self.version_id = version_id
+        self.index = index
+        self.fields = fields
+        self.layout = layout
+
+    def build_fields(self):
+        """
+        Instantiates a fresh set of Django fields from the compiled specs
+
+        :return: The form fields keyed by linkId
+        :rtype: dict
+        """
+        return {name: spec.build() for name, spec in self.fields.items()}
+
+    def is_current(self, questionnaire, version_id):
+        """
+        Returns whether this was compiled from the given Questionnaire. When
+        the resource carries no version, only the exact same object matches.
+        """
+        if version_id is not None:
+            return version_id == self.version_id
+
+        return questionnaire is self.questionnaire
+
+
+class SchemaCache(object):
+    """
+    Holds the current compiled schema per form class and Questionnaire ID.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schemas = {}
+
+    def get(self, key, questionnaire, compile):
+        """
+        Returns the compiled schema for the key, compiling it if this version
+        of the Questionnaire has not been seen before.
+
+        :param key: The form class and Questionnaire ID
+        :type key: tuple
+        :param questionnaire: The Questionnaire the form is built from
+        :type questionnaire: Questionnaire
+        :param compile: Callable returning the index, field specs and layout
+        :type compile: callable
+        :return: The compiled schema
+        :rtype: CompiledQuestionnaire
+        """
+        version_id = questionnaire.meta.versionId if questionnaire.meta else None
+
+        schema = self._schemas.get(key)
+        if schema and schema.is_current(questionnaire, version_id):
+            return schema
+
+        logger.debug(f'PPM/Questionnaire: Compiling {key[1]} (version {version_id}) for {key[0].__name__}')
+        index, fields, layout = compile()
+        schema = CompiledQuestionnaire(questionnaire, version_id, index, fields, layout)
+        with self._lock:
+            self._schemas[key] = schema
+
+        return schema
+
+
+# The shared schemas for this process
+schemas = SchemaCache()
@@ -1,3 +1,391 @@
-from django.test import TestCase
+import threading
+from datetime import datetime
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, RequestFactory
+
+from fhirclient.models.bundle import Bundle
+from fhirclient.models.questionnaire import Questionnaire
+
+from fhirquestionnaire.cache import QuestionnaireCache, PatientCache
+from fhirquestionnaire.fhir import FHIR
+from questionnaire.forms import NEERQuestionnaireForm
+from questionnaire.schema import FieldSpec, QuestionnaireIndex, SchemaCache
+from questionnaire.views import render_patient_does_not_exist
+
+
+PATIENT = {'resourceType': 'Patient', 'id': '1'}
+QUESTIONNAIRE = {'resourceType': 'Questionnaire', 'id': 'ppm-neer-registration-questionnaire', 'status': 'active'}
+
+FORM = {'resourceType': 'Questionnaire', 'id': 'ppm-neer-registration-questionnaire', 'status': 'active', 'item': [
+    {'linkId': 'q1', 'text': 'Were you diagnosed?', 'type': 'boolean', 'required': True, 'item': [
+        {'linkId': 'g1', 'type': 'group', 'enableWhen': [{'question': 'q1', 'operator': '=', 'answerBoolean': True}],
+         'item': [{'linkId': 'q1a', 'text': 'When?', 'type': 'string', 'required': True}]},
+    ]},
+    {'linkId': 'q2', 'text': 'Which?', 'type': 'choice', 'required': True,
+     'answerOption': [{'valueString': 'A'}, {'valueString': 'B'}]},
+    {'linkId': 'q3', 'text': 'Since?', 'type': 'date'},
+    {'linkId': 'q4', 'text': 'Why A?', 'type': 'string', 'required': True,
+     'enableWhen': [{'question': 'q2', 'operator': '=', 'answerString': 'A'}]},
+]}
+
+
+def searchset(*resources):
+    return {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [{'resource': r} for r in resources]}
+
+
+def batch(*entries):
+    """
+    Builds a batch-response Bundle from (status, resource) pairs.
+    """
+    return Bundle({'resourceType': 'Bundle', 'type': 'batch-response', 'entry': [
+        dict({'response': {'status': status}}, **({'resource': resource} if resource else {}))
+        for status, resource in entries
+    ]})
+
+
+class FormSchemaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.questionnaire = Questionnaire(dict(FORM, meta={'versionId': '1'}))
+        for target, new in (('questionnaire.forms.schemas', SchemaCache()),
+                            ('questionnaire.forms.FHIR.get_questionnaire', lambda *args: self.questionnaire)):
+            patcher = mock.patch(target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        compile = NEERQuestionnaireForm._compile
+        patcher = mock.patch.object(NEERQuestionnaireForm, '_compile', autospec=True, side_effect=compile)
+        self.compile = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def form(self):
+        return NEERQuestionnaireForm(FORM['id'])
+
+    def test_compiles_each_version_once(self):
+        first, second = self.form(), self.form()
+        self.assertEqual(self.compile.call_count, 1)
+
+        # Each form gets its own fields but shares the layout
+        self.assertIsNot(first.fields['q1'], second.fields['q1'])
+        self.assertIs(first.helper.layout, second.helper.layout)
+
+        self.questionnaire = Questionnaire(dict(FORM, meta={'versionId': '2'}))
+        self.form()
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_builds_fields(self):
+        fields = self.form().fields
+
+        self.assertEqual(fields['q2'].choices, [('A', 'A'), ('B', 'B')])
+        self.assertIs(fields['q1'].coerce('1'), True)
+        self.assertEqual(fields['questionnaire_id'].empty_value, FORM['id'])
+
+        # Only root items without conditions are enforced
+        self.assertTrue(fields['q1'].required)
+        self.assertFalse(fields['q1a'].required)
+        self.assertFalse(fields['q4'].required)
+
+    def test_date_pickers_are_limited_to_today(self):
+        widget = mock.Mock()
+        spec = FieldSpec(mock.Mock(), {}, widget, {'format': '%m/%d/%Y'}, dated=True, links=[('end_of', 'q0')])
+
+        with mock.patch('questionnaire.schema.timezone.now', return_value=datetime(2026, 1, 2, 3, 4)):
+            spec.build()
+
+        self.assertEqual(widget.call_args.kwargs['options']['maxDate'], '2026-01-02T23:59:00')
+        widget.return_value.end_of.assert_called_once_with('q0')
+
+
+class QuestionnaireIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = QuestionnaireIndex(Questionnaire(FORM))
+
+    def test_indexes_items_and_parents(self):
+        self.assertEqual(list(self.index.items), ['q1', 'g1', 'q1a', 'q2', 'q3', 'q4'])
+        self.assertEqual(self.index.parent('q1a').linkId, 'g1')
+        self.assertEqual(self.index.parent('g1').linkId, 'q1')
+        self.assertIsNone(self.index.parent('q1'))
+        self.assertIsNone(self.index.item('q5'))
+
+    def test_indexes_dependents(self):
+        self.assertEqual([item.linkId for item in self.index.dependents('q1')], ['g1'])
+        self.assertEqual([item.linkId for item in self.index.dependents('q2')], ['q4'])
+        self.assertEqual(self.index.dependents('q3'), [])
+
+    def test_forms_mark_dependencies(self):
+        with mock.patch('questionnaire.forms.schemas', SchemaCache()), \
+                mock.patch('questionnaire.forms.FHIR.get_questionnaire', return_value=Questionnaire(FORM)):
+            fields = NEERQuestionnaireForm(FORM['id']).fields
+
+        self.assertEqual(fields['q2'].widget.attrs['data-details'], 'q2')
+        self.assertNotIn('data-details', fields['q3'].widget.attrs)
+        self.assertEqual(fields['q4'].widget.attrs['data-enabled-when'], 'q2=A')
+
+
+def fetched(status, resource=None, etag=None):
+    """
+    Builds a stand-in for FHIR's response to a read.
+    """
+    return mock.Mock(status_code=status, headers={'ETag': etag} if etag else {}, json=mock.Mock(return_value=resource))
+
+
+class QuestionnaireCacheTests(SimpleTestCase):
+
+    questionnaire_id = QUESTIONNAIRE['id']
+
+    def setUp(self):
+        self.cache = QuestionnaireCache(ttl=60)
+        patcher = mock.patch('fhirquestionnaire.cache.PPMFHIR.get')
+        self.read = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def version(self, version_id):
+        return dict(QUESTIONNAIRE, meta={'versionId': version_id})
+
+    def expire(self):
+        with self.cache._lock:
+            for questionnaire_id, entry in self.cache._entries.items():
+                self.cache._entries[questionnaire_id] = entry._replace(expires=0)
+
+    def test_serves_from_memory_until_expired(self):
+        self.read.return_value = fetched(200, self.version('1'))
+
+        self.assertEqual(self.cache.get(self.questionnaire_id).id, self.questionnaire_id)
+        self.assertIs(self.cache.get(self.questionnaire_id), self.cache.peek(self.questionnaire_id))
+        self.read.assert_called_once()
+        self.assertIsNone(self.read.call_args.kwargs['headers'])
+
+    def test_revalidates_with_the_version(self):
+        self.read.return_value = fetched(200, self.version('1'))
+        questionnaire = self.cache.get(self.questionnaire_id)
+        self.expire()
+
+        # An unchanged Questionnaire is kept
+        self.read.return_value = fetched(304)
+        self.assertIs(self.cache.get(self.questionnaire_id), questionnaire)
+        self.assertEqual(self.read.call_args.kwargs['headers'], {'If-None-Match': 'W/"1"'})
+        self.assertIs(self.cache.peek(self.questionnaire_id), questionnaire)
+
+    def test_replaces_changed_versions(self):
+        self.read.return_value = fetched(200, self.version('1'))
+        self.cache.get(self.questionnaire_id)
+        self.expire()
+
+        self.read.return_value = fetched(200, self.version('2'), etag='W/"2"')
+        self.assertEqual(self.cache.get(self.questionnaire_id).meta.versionId, '2')
+        self.assertEqual(self.cache._entries[self.questionnaire_id].etag, 'W/"2"')
+
+    def test_serves_stale_copies_when_revalidation_fails(self):
+        self.read.return_value = fetched(200, self.version('1'))
+        questionnaire = self.cache.get(self.questionnaire_id)
+        self.expire()
+
+        self.read.return_value = None
+        self.assertIs(self.cache.get(self.questionnaire_id), questionnaire)
+
+    def test_missing_questionnaires(self):
+        self.read.return_value = None
+        self.assertIsNone(self.cache.get(self.questionnaire_id))
+
+    def test_coalesces_concurrent_misses(self):
+        started, release = threading.Event(), threading.Event()
+
+        def read(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return fetched(200, self.version('1'))
+
+        self.read.side_effect = read
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get(self.questionnaire_id)))
+                   for _ in range(3)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.read.assert_called_once()
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result is results[0] for result in results))
+
+
+class PreflightTests(SimpleTestCase):
+
+    questionnaire_id = QUESTIONNAIRE['id']
+    email = 'participant@example.com'
+
+    def setUp(self):
+        self.patients = self.patch('fhirquestionnaire.fhir.patients')
+        self.patch('fhirquestionnaire.fhir.questionnaires', QuestionnaireCache(ttl=60))
+        self.query = self.patch('fhirquestionnaire.fhir.FHIR._query_resources')
+
+    def patch(self, target, new=mock.DEFAULT):
+        patcher = mock.patch(target, new)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def preflight(self, *entries):
+        self.query.return_value = batch(*entries)
+        return FHIR.preflight_questionnaire(self.questionnaire_id, self.email)
+
+    def test_fetches_everything_in_one_batch(self):
+        preflight = self.preflight(
+            ('200 OK', searchset(PATIENT)), ('200 OK', searchset()), ('200 OK', QUESTIONNAIRE)
+        )
+
+        self.assertEqual(preflight.patient.id, '1')
+        self.assertEqual(preflight.questionnaire.id, self.questionnaire_id)
+        self.query.assert_called_once()
+        self.assertEqual(self.query.call_args.kwargs['type'], 'batch')
+
+        # The patient lookup is shared
+        self.patients.put.assert_called_once_with(self.email, PATIENT)
+
+    def test_caches_missing_patients(self):
+        with self.assertRaises(FHIR.PatientDoesNotExist):
+            self.preflight(('200 OK', searchset()), ('200 OK', searchset()), ('200 OK', QUESTIONNAIRE))
+
+        # The miss is kept for other lookups until they are sent to register
+        self.patients.put.assert_called_once_with(self.email, None)
+        self.patients.invalidate.assert_not_called()
+
+    def test_existing_response(self):
+        response = {'resourceType': 'QuestionnaireResponse', 'id': '2', 'status': 'completed'}
+        with self.assertRaises(FHIR.QuestionnaireResponseAlreadyExists):
+            self.preflight(('200 OK', searchset(PATIENT)), ('200 OK', searchset(response)), ('200 OK', QUESTIONNAIRE))
+
+    def test_short_batch_fails(self):
+        with self.assertRaises(SystemError):
+            self.preflight(('200 OK', searchset()), ('200 OK', searchset()))
+
+        self.patients.put.assert_not_called()
+
+    def test_empty_batch_fails(self):
+        self.query.return_value = None
+        with self.assertRaises(SystemError):
+            FHIR.preflight_questionnaire(self.questionnaire_id, self.email)
+
+        self.patients.put.assert_not_called()
+
+    def test_failed_search_fails(self):
+
+        # A failed search is not taken to mean they have no patient or response
+        with self.assertRaises(SystemError):
+            self.preflight(('500 Internal Server Error', None), ('200 OK', searchset()), ('200 OK', QUESTIONNAIRE))
+
+        with self.assertRaises(SystemError):
+            self.preflight(('200 OK', searchset(PATIENT)), ('503 Unavailable', None), ('200 OK', QUESTIONNAIRE))
+
+        self.patients.put.assert_not_called()
+
+    def test_missing_questionnaire(self):
+        with self.assertRaises(FHIR.QuestionnaireDoesNotExist):
+            self.preflight(('200 OK', searchset(PATIENT)), ('200 OK', searchset()), ('404 Not Found', None))
+
+        # Only a wholly successful batch is cached
+        self.patients.put.assert_not_called()
+
+
+class ConsentPreflightTests(SimpleTestCase):
+
+    email = 'participant@example.com'
+
+    def setUp(self):
+        for target, new in (('fhirquestionnaire.fhir.patients', mock.DEFAULT),
+                            ('fhirquestionnaire.fhir.questionnaires', QuestionnaireCache(ttl=60))):
+            patcher = mock.patch(target, new)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch('fhirquestionnaire.fhir.FHIR._query_resources')
+        self.query = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_fetches_the_consent_questionnaire_in_the_batch(self):
+        signature = {'resourceType': 'Questionnaire', 'id': 'neer-signature-v3', 'status': 'active'}
+        self.query.return_value = batch(('200 OK', searchset(PATIENT)), ('200 OK', searchset()), ('200 OK', signature))
+
+        preflight = FHIR.preflight_consent('neer', self.email)
+
+        self.assertEqual(preflight.questionnaire.id, 'neer-signature-v3')
+        self.assertEqual(len(self.query.call_args.args[0]), 3)
+
+    def test_existing_consent(self):
+        composition = {'resourceType': 'Composition', 'id': '2', 'status': 'final', 'type': {'text': 'Consent'},
+                       'date': '2026-01-01', 'author': [{'reference': 'Patient/1'}], 'title': 'Consent'}
+        self.query.return_value = batch(('200 OK', searchset(PATIENT)), ('200 OK', searchset(composition)))
+
+        with self.assertRaises(FHIR.ConsentAlreadyExists):
+            FHIR.preflight_consent('rant', self.email)
+
+        self.query.assert_called_once()
+
+
+class PatientCacheTests(SimpleTestCase):
+
+    email = 'participant@example.com'
+
+    def setUp(self):
+        self.cache = PatientCache(size=2, ttl=60, negative_ttl=60)
+        patcher = mock.patch('fhirquestionnaire.cache.PPMFHIR.fhir_get')
+        self.search = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_caches_patients(self):
+        self.search.return_value = searchset(PATIENT)
+
+        self.assertEqual(self.cache.get_id(self.email), '1')
+        self.assertEqual(self.cache.get(self.email.upper()), PATIENT)
+        self.search.assert_called_once()
+
+    def test_caches_misses(self):
+        self.search.return_value = searchset()
+
+        # Repeated lookups for someone with no Patient do not each search
+        self.assertIsNone(self.cache.get(self.email))
+        self.assertIsNone(self.cache.get(self.email))
+        self.search.assert_called_once()
+
+    def test_misses_expire(self):
+        self.cache = PatientCache(ttl=60, negative_ttl=0)
+        self.search.return_value = searchset()
+
+        self.cache.get(self.email)
+        self.cache.get(self.email)
+        self.assertEqual(self.search.call_count, 2)
+
+    def test_does_not_cache_failed_searches(self):
+        self.search.return_value = None
+        with self.assertRaises(SystemError):
+            self.cache.get(self.email)
+
+        self.search.return_value = searchset(PATIENT)
+        self.assertEqual(self.cache.get(self.email), PATIENT)
+
+    def test_evicts_least_recently_used(self):
+        self.search.return_value = searchset(PATIENT)
+        for email in ('a@example.com', 'b@example.com', 'a@example.com', 'c@example.com', 'a@example.com'):
+            self.cache.get(email)
+
+        # b was evicted, a stayed
+        self.assertEqual(self.search.call_count, 3)
+
+    def test_registration_drops_the_miss(self):
+        self.search.return_value = searchset()
+        self.cache.get(self.email)
+
+        request = RequestFactory().get('/')
+        with mock.patch('questionnaire.views.patients', self.cache):
+            response = render_patient_does_not_exist(request, self.email)
+
+        self.assertContains(response, 'Patient Does Not Exist')
+
+        # They are found once they have registered
+        self.search.return_value = searchset(PATIENT)
+        self.assertEqual(self.cache.get(self.email), PATIENT)
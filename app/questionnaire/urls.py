@@ -1,12 +1,16 @@
+from django.conf import settings
 from django.urls import re_path
 
 from questionnaire import views
 
 app_name = "questionnaire"
 
+# Use the async submission views when served by ASGI
+QuestionnaireView = views.AsyncQuestionnaireView if settings.ASYNC_VIEWS else views.QuestionnaireView
+
 # Add views.
 urlpatterns = [
     re_path(r'^p/(?P<study>[a-z\-_]+)/$', views.StudyView.as_view(), name='study'),
-    re_path(r'^q/(?P<study>[a-z\-_]+)/$', views.QuestionnaireView.as_view(), name='questionnaire'),
+    re_path(r'^q/(?P<study>[a-z\-_]+)/$', QuestionnaireView.as_view(), name='questionnaire'),
     re_path(r'^$', views.IndexView.as_view(), name='index'),
 ]
@@ -1,6 +1,9 @@
+import asyncio
 import base64
 from distutils.util import strtobool
 
+from asgiref.sync import sync_to_async
+
 from django.shortcuts import render, reverse, redirect
 from django.conf import settings
 from django.utils.decorators import method_decorator
@@ -14,6 +17,8 @@ from dbmi_client.settings import dbmi_settings
 
 from questionnaire import forms
 from fhirquestionnaire.fhir import FHIR
+from fhirquestionnaire.asyncfhir import AsyncFHIR, run
+from fhirquestionnaire.cache import patients
 
 
 import logging
@@ -178,6 +183,94 @@ class QuestionnaireView(View):
         # Proceed with super's implementation.
         return super(QuestionnaireView, self).dispatch(request, *args, **kwargs)
 
+    def form_response(self, request, form):
+        """
+        Renders the questionnaire's form, filled out or not.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param form: The questionnaire's form
+        :type form: Form
+        :return: The response
+        :rtype: HttpResponse
+        """
+        # Prepare the context
+        context = {
+            'study': self.study,
+            'questionnaire_id': self.questionnaire_id,
+            'form': form,
+            'return_url': self.return_url,
+        }
+
+        # Get the passed parameters
+        return render(request, template_name='questionnaire/{}.html'.format(self.study), context=context)
+
+    def success_response(self, request, submission):
+        """
+        Renders the page shown once the questionnaire was submitted.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param submission: The queued submission, if any
+        :type submission: Submission
+        :return: The response
+        :rtype: HttpResponse
+        """
+        # Get the return URL
+        logger.debug(f'PPM/{self.study}: Success, returning user to: {self.return_url}')
+        context = {
+            'questionnaire_id': self.questionnaire_id,
+            'return_url': self.return_url,
+            'demo': self.demo(request),
+            'queued': submission is not None,
+        }
+
+        # Get the passed parameters
+        return render(request, template_name='questionnaire/success.html', context=context)
+
+    def error_response(self, request, error, patient_email, action):
+        """
+        Renders the error page for an exception raised while handling the
+        questionnaire.
+
+        :param request: The current HttpRequest object
+        :type request: HttpRequest
+        :param error: The exception raised
+        :type error: Exception
+        :param patient_email: The current user's email
+        :type patient_email: str
+        :param action: What was being done, for logging
+        :type action: str
+        :return: The response
+        :rtype: HttpResponse
+        """
+        if isinstance(error, FHIR.PatientDoesNotExist):
+            return render_patient_does_not_exist(request, patient_email)
+
+        if isinstance(error, FHIR.QuestionnaireDoesNotExist):
+            logger.warning('Questionnaire does not exist: {}'.format(self.questionnaire_id))
+            return render_error(request,
+                                title='Questionnaire Does Not Exist',
+                                message='The requested questionnaire does not exist!',
+                                support=False)
+
+        if isinstance(error, FHIR.QuestionnaireResponseAlreadyExists):
+            logger.warning('Questionnaire already finished')
+            return render_error(request,
+                                title='Questionnaire Already Completed',
+                                message='You have already filled out and submitted this '
+                                        'questionnaire.',
+                                support=False)
+
+        logger.error("Error while {} questionnaire: {}".format(action, error), exc_info=error, extra={
+            'request': request, 'project': self.study,
+        })
+        return render_error(request,
+                            title='Application Error',
+                            message='The application has experienced an unknown error{}'
+                            .format(': {}'.format(error) if settings.DEBUG else '.'),
+                            support=False)
+
     @method_decorator(dbmi_user)
     def get(self, request, *args, **kwargs):
         logger.debug(f'PPM/{self.study}: GET questionnaire')
@@ -189,84 +282,104 @@ class QuestionnaireView(View):
             # If demo mode, disable checks for participant and past submissions
             if not self.demo(request):
 
-                # Check the current patient
-                FHIR.check_patient(patient_email)
-
-                # Check response
-                FHIR.check_response(self.questionnaire_id, patient_email)
+                # Check the current patient, their response and the questionnaire in one request
+                FHIR.preflight_questionnaire(self.questionnaire_id, patient_email)
 
             # Create the form
-            form = self.Form(self.questionnaire_id)
+            return self.form_response(request, self.Form(self.questionnaire_id))
 
-            # Prepare the context
-            context = {
-                'study': self.study,
-                'questionnaire_id': self.questionnaire_id,
-                'form': form,
-                'return_url': self.return_url,
-            }
+        except Exception as e:
+            return self.error_response(request, e, patient_email, 'rendering')
 
-            # Get the passed parameters
-            return render(request, template_name='questionnaire/{}.html'.format(self.study), context=context)
+    @method_decorator(dbmi_user)
+    def post(self, request, *args, **kwargs):
+        logger.debug(f'PPM/{self.study}: POST questionnaire')
 
-        except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist: {}'.format(patient_email[:3]+'****'+patient_email[-4:]))
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
+        # Get the patient email
+        patient_email = get_jwt_email(request=request, verify=False)
 
-        except FHIR.QuestionnaireDoesNotExist:
-            logger.warning('Questionnaire does not exist: {}'.format(self.questionnaire_id))
-            return render_error(request,
-                                title='Questionnaire Does Not Exist',
-                                message='The requested questionnaire does not exist!',
-                                support=False)
+        # create a form instance and populate it with data from the request:
+        form = self.Form(self.questionnaire_id, request.POST)
 
-        except FHIR.QuestionnaireResponseAlreadyExists:
-            logger.warning('Questionnaire already finished')
-            return render_error(request,
-                                title='Questionnaire Already Completed',
-                                message='You have already filled out and submitted this '
-                                        'questionnaire.',
-                                support=False)
+        # check whether it's valid:
+        if not form.is_valid():
+            logger.debug(f'PPM/{self.study}: Form was invalid: {form.errors.as_json()}')
+
+            # Return with errors
+            return self.form_response(request, form)
+
+        else:
+            logger.debug(f'PPM/{self.study}: Form was valid')
+
+        # Process the form
+        try:
+
+            # Submit the form
+            submission = FHIR.submit_questionnaire(self.study, patient_email, form.cleaned_data, dry=self.demo(request))
+
+            return self.success_response(request, submission)
 
         except Exception as e:
-            logger.error("Error while rendering questionnaire: {}".format(e), exc_info=True, extra={
-                'request': request, 'project': self.study,
-            })
-            return render_error(request,
-                                title='Application Error',
-                                message='The application has experienced an unknown error {}'
-                                .format(': {}'.format(e) if settings.DEBUG else '.'),
-                                support=False)
+            return self.error_response(request, e, patient_email, 'submitting')
 
-    @method_decorator(dbmi_user)
-    def post(self, request, *args, **kwargs):
+
+class AsyncViewMixin(object):
+    """
+    Lets a view with async handlers reuse its synchronous `dispatch`. The
+    dispatch, which authenticates the user and reads the session, runs in a
+    worker thread and the handler coroutine it returns is awaited on the loop.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        response = await sync_to_async(super(AsyncViewMixin, self).dispatch)(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+
+        return response
+
+
+class AsyncQuestionnaireView(AsyncViewMixin, QuestionnaireView):
+    """
+    QuestionnaireView for ASGI deployments: waiting on FHIR does not hold a
+    worker thread. Only the FHIR calls differ; responses are built by the
+    synchronous view's helpers.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        logger.debug(f'PPM/{self.study}: GET questionnaire')
+
+        # Get the patient email and ensure they exist
+        patient_email = get_jwt_email(request=request, verify=False)
+
+        try:
+            # If demo mode, disable checks for participant and past submissions
+            if not self.demo(request):
+
+                # Check the current patient, their response and the questionnaire in one request
+                await AsyncFHIR.preflight_questionnaire(self.questionnaire_id, patient_email)
+
+            # Create the form
+            form = await run(self.Form, self.questionnaire_id)
+            return await sync_to_async(self.form_response)(request, form)
+
+        except Exception as e:
+            return await sync_to_async(self.error_response)(request, e, patient_email, 'rendering')
+
+    async def post(self, request, *args, **kwargs):
         logger.debug(f'PPM/{self.study}: POST questionnaire')
 
         # Get the patient email
         patient_email = get_jwt_email(request=request, verify=False)
 
         # create a form instance and populate it with data from the request:
-        form = self.Form(self.questionnaire_id, request.POST)
+        form = await run(self.Form, self.questionnaire_id, request.POST)
 
         # check whether it's valid:
         if not form.is_valid():
             logger.debug(f'PPM/{self.study}: Form was invalid: {form.errors.as_json()}')
 
             # Return with errors
-            context = {
-                'study': self.study,
-                'form': form,
-                'questionnaire_id': self.questionnaire_id,
-                'return_url': self.return_url,
-            }
-
-            # Get the passed parameters
-            return render(request, template_name='questionnaire/{}.html'.format(self.study), context=context)
+            return await sync_to_async(self.form_response)(request, form)
 
         else:
             logger.debug(f'PPM/{self.study}: Form was valid')
@@ -275,43 +388,39 @@ class QuestionnaireView(View):
         try:
 
             # Submit the form
-            FHIR.submit_questionnaire(self.study, patient_email, form.cleaned_data, dry=self.demo(request))
+            submission = await AsyncFHIR.submit_questionnaire(self.study, patient_email, form.cleaned_data,
+                                                              dry=self.demo(request))
 
-            # Get the return URL
-            logger.debug(f'PPM/{self.study}: Success, returning user to: {self.return_url}')
-            context = {
-                'questionnaire_id': self.questionnaire_id,
-                'return_url': self.return_url,
-                'demo': self.demo(request)
-            }
+            return await sync_to_async(self.success_response)(request, submission)
 
-            # Get the passed parameters
-            return render(request, template_name='questionnaire/success.html', context=context)
+        except Exception as e:
+            return await sync_to_async(self.error_response)(request, e, patient_email, 'submitting')
 
-        except FHIR.QuestionnaireDoesNotExist:
-            logger.warning('Questionnaire does not exist: {}'.format(self.questionnaire_id))
-            return render_error(request,
-                                title='Questionnaire Does Not Exist',
-                                message='The requested questionnaire does not exist!',
-                                support=False)
 
-        except FHIR.PatientDoesNotExist:
-            logger.warning('Patient does not exist: {}'.format(patient_email[:3]+'****'+patient_email[-4:]))
-            return render_error(request,
-                                title='Patient Does Not Exist',
-                                message='A FHIR resource does not yet exist for the current user. '
-                                        'Please sign into the People-Powered dashboard to '
-                                        'create your user.',
-                                support=False)
-        except Exception as e:
-            logger.error("Error while submitting questionnaire: {}".format(e), exc_info=True, extra={
-                'project': self.study,
-            })
-            return render_error(request,
-                                title='Application Error',
-                                message='The application has experienced an unknown error{}'
-                                .format(': {}'.format(e) if settings.DEBUG else '.'),
-                                support=False)
+def render_patient_does_not_exist(request, patient_email, render=None):
+    """
+    Sends a participant with no Patient to the PPM dashboard to register.
+    Their lookup is dropped from the patient cache so they are found once
+    they have, rather than being told to register until the miss expires.
+
+    :param request: The current HttpRequest object
+    :type request: HttpRequest
+    :param patient_email: The current user's email
+    :type patient_email: str
+    :param render: The view's error renderer, defaults to this module's
+    :type render: callable
+    :returns: The response
+    :rtype: HttpResponse
+    """
+    logger.warning('Patient does not exist: {}'.format(FHIR.obfuscate_email(patient_email)))
+    patients.invalidate(patient_email)
+
+    return (render or render_error)(request,
+                                    title='Patient Does Not Exist',
+                                    message='A FHIR resource does not yet exist for the current user. '
+                                            'Please sign into the People-Powered dashboard to '
+                                            'create your user.',
+                                    support=False)
 
 
 def render_error(request, title=None, message=None, support=False):
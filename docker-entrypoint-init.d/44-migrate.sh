@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# Create or update the app's tables, e.g. the submission outbox and render jobs
+python ${DBMI_APP_ROOT}/manage.py migrate --noinput
+
+# The app writes to the database, and SQLite writes its journal alongside it
+chown $DBMI_NGINX_USER:$DBMI_NGINX_USER $DBMI_APP_ROOT $DBMI_APP_ROOT/db.sqlite3
+
+echo "Database is migrated!"